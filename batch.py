@@ -0,0 +1,171 @@
+import json
+import os
+import time
+from datetime import datetime
+from pathlib import Path
+
+from result_cache import hash_file
+
+JOURNAL_NAME = '.enhance_journal.jsonl'
+
+SUPPORTED_EXTENSIONS = ('.jpg', '.jpeg', '.png', '.bmp', '.tiff', '.tif')
+
+
+def scan_images(root, recursive=False, extensions=SUPPORTED_EXTENSIONS, exclude=None):
+    """
+    Обходит каталог через os.scandir и по одному отдает os.DirEntry
+    изображений. Расширения сравниваются без учета регистра. В памяти
+    держится только стек еще не пройденных подкаталогов, список файлов не
+    строится. Каталог exclude (например, выходной внутри входного) пропускается.
+    """
+    extensions = tuple(ext.lower() for ext in extensions)
+    exclude = os.path.realpath(exclude) if exclude else None
+    stack = [os.fspath(root)]
+    while stack:
+        directory = stack.pop()
+        try:
+            entries = os.scandir(directory)
+        except OSError as e:
+            print(f"⚠️ Не удалось прочитать каталог {directory}: {str(e)}")
+            continue
+        with entries:
+            for entry in entries:
+                try:
+                    if entry.is_dir(follow_symlinks=False):
+                        if recursive and os.path.realpath(entry.path) != exclude:
+                            stack.append(entry.path)
+                    elif entry.name.lower().endswith(extensions) and entry.is_file():
+                        yield entry
+                except OSError:
+                    continue
+
+
+class BatchJournal:
+    """
+    Журнал пакетной обработки в выходном каталоге (JSON lines).
+    Каждый обработанный файл дописывается отдельной строкой сразу после
+    обработки: путь, размер, время изменения и хэш входа, метод и хэш
+    конфигурации. Повторный запуск (в том числе после падения) обрабатывает
+    только файлы, у которых что-то из этого изменилось.
+    """
+
+    def __init__(self, output_dir):
+        self.path = Path(output_dir) / JOURNAL_NAME
+        self._entries = {}
+        lines = self._load()
+        # Журнал только дописывается, поэтому время от времени его сжимаем
+        if lines > 2 * len(self._entries) + 100:
+            self._compact()
+        self._file = open(self.path, 'a', encoding='utf-8')
+
+    def _load(self):
+        """Читает журнал, последняя запись по файлу и методу побеждает"""
+        if not self.path.exists():
+            return 0
+        lines = 0
+        with open(self.path, 'r', encoding='utf-8') as f:
+            for line in f:
+                lines += 1
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    # Последняя строка могла не дописаться при падении
+                    continue
+                self._entries[(entry.get('input'), entry.get('method'))] = entry
+        return lines
+
+    def _compact(self):
+        tmp_path = self.path.with_name(self.path.name + '.tmp')
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            for entry in self._entries.values():
+                f.write(json.dumps(entry, ensure_ascii=False) + '\n')
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, self.path)
+
+    def needs_processing(self, input_path, method, config_hash, output_path, stat):
+        """
+        Нужно ли обрабатывать файл: нет успешной записи, изменились метод,
+        конфигурация или вход, либо пропал результат. Хэш содержимого
+        считается, только если размер тот же, а время изменения другое.
+        """
+        entry = self._entries.get((str(input_path), method))
+        if (entry is None or entry.get('status') != 'done'
+                or entry.get('config') != config_hash
+                or entry.get('output') != str(output_path)
+                or entry.get('size') != stat.st_size
+                or not os.path.exists(output_path)):
+            return True
+        if entry.get('mtime_ns') == stat.st_mtime_ns:
+            return False
+        # Файл перезаписан тем же содержимым: запоминаем новое время
+        if hash_file(input_path) != entry.get('hash'):
+            return True
+        self._write(dict(entry, mtime_ns=stat.st_mtime_ns))
+        return False
+
+    def record(self, input_path, output_path, method, success, seconds,
+               config_hash=None, stat=None, input_hash=None):
+        entry = {
+            'input': str(input_path),
+            'output': str(output_path),
+            'method': method,
+            'status': 'done' if success else 'error',
+            'size': stat.st_size if stat else None,
+            'mtime_ns': stat.st_mtime_ns if stat else None,
+            'hash': input_hash,
+            'config': config_hash,
+            'seconds': round(seconds, 3),
+            'time': datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
+        }
+        self._write(entry)
+
+    def _write(self, entry):
+        self._file.write(json.dumps(entry, ensure_ascii=False) + '\n')
+        self._file.flush()
+        os.fsync(self._file.fileno())
+        self._entries[(entry['input'], entry['method'])] = entry
+
+    def close(self):
+        self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+class BatchProgress:
+    """Счетчики и пропускная способность пакетной обработки"""
+
+    def __init__(self):
+        self.processed = 0
+        self.failed = 0
+        self.skipped = 0
+        self.start_time = time.perf_counter()
+
+    def elapsed(self):
+        return time.perf_counter() - self.start_time
+
+    def throughput(self):
+        """Обработанных файлов в секунду"""
+        elapsed = self.elapsed()
+        return (self.processed + self.failed) / elapsed if elapsed > 0 else 0.0
+
+    def skip(self):
+        self.skipped += 1
+
+    def update(self, name, success, seconds):
+        if success:
+            self.processed += 1
+        else:
+            self.failed += 1
+        mark = '✅' if success else '❌'
+        print(f"📈 [{self.processed + self.failed}] {mark} {name} - {seconds:.2f} с, "
+              f"{self.throughput():.2f} файл/с, ошибок: {self.failed}, пропущено: {self.skipped}")
+
+    def summary(self):
+        print(f"⏱️ Время: {self.elapsed():.1f} с, {self.throughput():.2f} файл/с")
+        if self.skipped:
+            print(f"⏭️ Пропущено без изменений: {self.skipped}")
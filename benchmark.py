@@ -0,0 +1,305 @@
+"""
+Замеры производительности обработки на синтетических документах.
+
+    python benchmark.py scaling --method smooth_quality --size 2480x3508 --workers 1,2,4,8
+    python benchmark.py suite --sizes phone,a4_300 --json results.json
+    python benchmark.py suite --baseline baseline.json
+
+scaling - время обработки одного изображения в зависимости от числа
+потоков, обрабатывающих его полосами (ENHANCE_INTRA_WORKERS).
+
+suite - все методы на документах нескольких размеров: время, процессорное
+время, пиковый RSS и размер результата. Каждый замер выполняется в
+отдельном процессе, чтобы пиковый RSS относился только к нему. С --baseline
+результаты сравниваются с сохраненными, и при регрессии скрипт завершается
+с кодом 1. Кэш результатов в замерах отключен, сеть не нужна.
+"""
+import argparse
+import contextlib
+import io
+import json
+import multiprocessing
+import os
+import platform
+import resource
+import sys
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import cv2
+import numpy as np
+import PIL
+
+from enhance_script import enhance_image, ALL_METHODS
+
+# Размеры документов: от фото с телефона до A4 в 600 dpi
+DOCUMENT_SIZES = {
+    'small': (1240, 1754),      # A4, 150 dpi
+    'phone': (3024, 4032),      # фото 12 Мп
+    'a4_300': (2480, 3508),     # A4, 300 dpi
+    'a4_600': (4960, 7016),     # A4, 600 dpi
+}
+
+
+def make_document(width, height, seed=0):
+    """Синтетический скан документа: строки текста на неровном фоне с шумом"""
+    rng = np.random.default_rng(seed)
+    img = np.full((height, width, 3), 235, dtype=np.uint8)
+    line_height = max(20, height // 60)
+    font_scale = line_height / 40
+    thickness = max(1, line_height // 14)
+    # Шрифты Hershey в OpenCV содержат только ASCII
+    alphabet = list('abcdefghijklmnopqrstuvwxyz0123456789')
+    for y in range(line_height * 2, height - line_height, line_height):
+        text = ' '.join(''.join(rng.choice(alphabet, size=rng.integers(2, 9)))
+                        for _ in range(12))
+        cv2.putText(img, text, (line_height, y), cv2.FONT_HERSHEY_SIMPLEX,
+                    font_scale, (30, 30, 30), thickness, cv2.LINE_AA)
+    # Неравномерное освещение и шум сканера, полосами, чтобы не держать
+    # весь документ во float32
+    gradient = np.linspace(-20, 10, width, dtype=np.float32)[None, :, None]
+    for y0 in range(0, height, 512):
+        band = img[y0:y0 + 512]
+        noisy = band.astype(np.float32) + gradient + \
+            rng.normal(0, 6, band.shape).astype(np.float32)
+        band[:] = np.clip(noisy, 0, 255).astype(np.uint8)
+    return img
+
+
+def parse_size(value):
+    if value in DOCUMENT_SIZES:
+        return DOCUMENT_SIZES[value]
+    width, height = value.lower().split('x')
+    return int(width), int(height)
+
+
+def time_method(img, method, config, repeats):
+    """Лучшее время из repeats запусков и путь к последнему результату"""
+    output_path = os.path.join(tempfile.gettempdir(), f"benchmark_{os.getpid()}_{method}.jpg")
+    best = None
+    for _ in range(repeats):
+        start = time.perf_counter()
+        # Обработка подробно пишет в stdout, в таблице замеров это не нужно
+        with contextlib.redirect_stdout(io.StringIO()):
+            ok = enhance_image(img, output_path, method, config)
+        elapsed = time.perf_counter() - start
+        if not ok:
+            raise RuntimeError(f"Ошибка обработки методом {method}")
+        best = elapsed if best is None else min(best, elapsed)
+    return best, output_path
+
+
+def run_scaling(args):
+    width, height = args.size
+    img = make_document(width, height)
+    workers_list = [int(n) for n in args.workers.split(',')]
+
+    print(f"📐 {args.method}, {width}x{height}, ядер: {os.cpu_count()}")
+    print(f"{'потоков':>8} {'время, с':>10} {'ускорение':>10} {'эффективность':>14} {'макс. откл.':>12}")
+
+    results = []
+    baseline_time = None
+    baseline_img = None
+    for workers in workers_list:
+        config = {'intra_workers': workers}
+        elapsed, output_path = time_method(img, args.method, config, args.repeats)
+        result_img = cv2.imread(output_path)
+        os.remove(output_path)
+
+        if baseline_time is None:
+            baseline_time, baseline_img = elapsed, result_img
+        speedup = baseline_time / elapsed
+        # Расхождение с первым замером: полосы не должны менять результат
+        max_diff = int(np.abs(result_img.astype(np.int16) - baseline_img).max())
+        results.append({
+            'workers': workers,
+            'seconds': round(elapsed, 4),
+            'speedup': round(speedup, 3),
+            'efficiency': round(speedup / workers * workers_list[0], 3),
+            'max_diff': max_diff,
+        })
+        print(f"{workers:>8} {elapsed:>10.3f} {speedup:>9.2f}x "
+              f"{results[-1]['efficiency']:>14.2f} {max_diff:>12}")
+
+    if args.json:
+        with open(args.json, 'w', encoding='utf-8') as f:
+            json.dump({'method': args.method, 'size': [width, height],
+                       'cpu_count': os.cpu_count(), 'results': results},
+                      f, ensure_ascii=False, indent=2)
+        print(f"💾 Результаты сохранены: {args.json}")
+    return results
+
+
+def _measure_case(input_path, output_path, method):
+    """
+    Выполняется в отдельном процессе: декодирование и обработка одним
+    методом. Возвращает время, процессорное время, пиковый RSS и размер
+    """
+    os.environ['RESULT_CACHE_DIR'] = ''
+    from enhance_script import enhance_document_quality
+
+    wall_start = time.perf_counter()
+    cpu_start = time.process_time()
+    with contextlib.redirect_stdout(io.StringIO()):
+        ok = enhance_document_quality(input_path, output_path, method, {}, use_cache=False)
+    wall = time.perf_counter() - wall_start
+    cpu = time.process_time() - cpu_start
+    # ru_maxrss в Linux - в килобайтах
+    peak_rss_mb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+    output_bytes = os.path.getsize(output_path) if ok else 0
+    return {'ok': bool(ok), 'wall_seconds': wall, 'cpu_seconds': cpu,
+            'peak_rss_mb': peak_rss_mb, 'output_bytes': output_bytes}
+
+
+def run_case(input_path, method, repeats):
+    """Лучшее время из repeats запусков, каждый в новом процессе"""
+    best = None
+    context = multiprocessing.get_context('spawn')
+    with tempfile.TemporaryDirectory(prefix='benchmark_') as tmp_dir:
+        output_path = os.path.join(tmp_dir, f"{method}.jpg")
+        for _ in range(repeats):
+            with ProcessPoolExecutor(max_workers=1, mp_context=context) as pool:
+                result = pool.submit(_measure_case, input_path, output_path, method).result()
+            if not result['ok']:
+                raise RuntimeError(f"Ошибка обработки методом {method}")
+            if best is None:
+                best = result
+            else:
+                best['wall_seconds'] = min(best['wall_seconds'], result['wall_seconds'])
+                best['cpu_seconds'] = min(best['cpu_seconds'], result['cpu_seconds'])
+                best['peak_rss_mb'] = max(best['peak_rss_mb'], result['peak_rss_mb'])
+    return {
+        'wall_seconds': round(best['wall_seconds'], 4),
+        'cpu_seconds': round(best['cpu_seconds'], 4),
+        'peak_rss_mb': round(best['peak_rss_mb'], 1),
+        'output_bytes': best['output_bytes'],
+    }
+
+
+def environment_info():
+    return {
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'cpu_count': os.cpu_count(),
+        'opencv': cv2.__version__,
+        'numpy': np.__version__,
+        'pillow': PIL.__version__,
+        'intra_workers': os.environ.get('ENHANCE_INTRA_WORKERS', '1'),
+        'memory_limit_mb': os.environ.get('ENHANCE_MEMORY_LIMIT_MB', '2048'),
+    }
+
+
+def compare_with_baseline(results, baseline, time_tolerance, rss_tolerance, size_tolerance,
+                          min_seconds=0.05):
+    """
+    Список регрессий относительно baseline: (случай, показатель, было, стало).
+    Рост времени меньше min_seconds не считается: на коротких замерах это шум
+    """
+    regressions = []
+    checks = (('wall_seconds', time_tolerance, min_seconds),
+              ('cpu_seconds', time_tolerance, min_seconds),
+              ('peak_rss_mb', rss_tolerance, 0))
+    for case, current in results.items():
+        previous = baseline.get('results', {}).get(case)
+        if previous is None:
+            continue
+        for metric, tolerance, min_delta in checks:
+            if (current[metric] > previous[metric] * (1 + tolerance)
+                    and current[metric] - previous[metric] > min_delta):
+                regressions.append((case, metric, previous[metric], current[metric]))
+        # Размер результата меняется только при изменении самой обработки
+        if abs(current['output_bytes'] - previous['output_bytes']) > \
+                previous['output_bytes'] * size_tolerance:
+            regressions.append((case, 'output_bytes', previous['output_bytes'],
+                                current['output_bytes']))
+    return regressions
+
+
+def run_suite(args):
+    sizes = args.sizes.split(',')
+    methods = ALL_METHODS if args.methods == 'all' else args.methods.split(',')
+    for method in methods:
+        if method not in ALL_METHODS:
+            raise SystemExit(f"Неизвестный метод: {method}")
+
+    baseline = None
+    if args.baseline:
+        with open(args.baseline, 'r', encoding='utf-8') as f:
+            baseline = json.load(f)
+
+    results = {}
+    print(f"{'случай':<36} {'время, с':>9} {'CPU, с':>9} {'RSS, МБ':>9} {'размер, КБ':>11}")
+    with tempfile.TemporaryDirectory(prefix='benchmark_') as tmp_dir:
+        for size_name in sizes:
+            width, height = parse_size(size_name)
+            # PNG без потерь: все методы получают один и тот же документ
+            input_path = os.path.join(tmp_dir, f"{size_name}.png")
+            cv2.imwrite(input_path, make_document(width, height, seed=args.seed))
+
+            for method in methods:
+                case = f"{size_name}/{method}"
+                result = run_case(input_path, method, args.repeats)
+                result['size'] = [width, height]
+                results[case] = result
+                print(f"{case:<36} {result['wall_seconds']:>9.3f} {result['cpu_seconds']:>9.3f} "
+                      f"{result['peak_rss_mb']:>9.1f} {result['output_bytes'] / 1024:>11.1f}")
+            os.remove(input_path)
+
+    report = {'environment': environment_info(), 'seed': args.seed, 'results': results}
+    if args.json:
+        with open(args.json, 'w', encoding='utf-8') as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+        print(f"💾 Результаты сохранены: {args.json}")
+
+    if baseline is not None:
+        if baseline.get('environment', {}).get('cpu_count') != os.cpu_count():
+            print("⚠️ Базовые замеры сделаны на машине с другим числом ядер")
+        regressions = compare_with_baseline(results, baseline, args.time_tolerance,
+                                            args.rss_tolerance, args.size_tolerance,
+                                            args.min_seconds)
+        if regressions:
+            print(f"\n❌ Регрессии относительно {args.baseline}:")
+            for case, metric, previous, current in regressions:
+                print(f"   {case}: {metric} {previous} → {current}")
+            sys.exit(1)
+        print(f"\n✅ Регрессий относительно {args.baseline} нет")
+    return results
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Замеры производительности обработки')
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    scaling = commands.add_parser('scaling', help='Ускорение одного изображения от числа потоков')
+    scaling.add_argument('--method', '-m', default='smooth_quality', choices=ALL_METHODS,
+                         help='Метод улучшения')
+    scaling.add_argument('--size', type=parse_size, default=(2480, 3508),
+                         help='Размер документа ШИРИНАxВЫСОТА (по умолчанию A4 300 dpi)')
+    scaling.add_argument('--workers', default=','.join(
+                             str(n) for n in sorted({1, 2, 4, os.cpu_count() or 1})),
+                         help='Список числа потоков через запятую')
+    scaling.add_argument('--repeats', type=int, default=3, help='Повторов на замер')
+    scaling.add_argument('--json', help='Сохранить результаты в JSON')
+    scaling.set_defaults(func=run_scaling)
+
+    suite = commands.add_parser('suite', help='Все методы на документах нескольких размеров')
+    suite.add_argument('--sizes', default='small,phone',
+                       help=f"Размеры через запятую: {', '.join(DOCUMENT_SIZES)} или ШИРИНАxВЫСОТА")
+    suite.add_argument('--methods', default='all', help='Методы через запятую или all')
+    suite.add_argument('--repeats', type=int, default=1, help='Повторов на замер')
+    suite.add_argument('--seed', type=int, default=0, help='Зерно генератора документов')
+    suite.add_argument('--json', help='Сохранить результаты в JSON (можно использовать как baseline)')
+    suite.add_argument('--baseline', help='JSON с прошлыми результатами для сравнения')
+    suite.add_argument('--time-tolerance', type=float, default=0.25,
+                       help='Допустимый рост времени (доля), по умолчанию 0.25')
+    suite.add_argument('--rss-tolerance', type=float, default=0.15,
+                       help='Допустимый рост пикового RSS (доля), по умолчанию 0.15')
+    suite.add_argument('--size-tolerance', type=float, default=0.02,
+                       help='Допустимое изменение размера результата (доля), по умолчанию 0.02')
+    suite.add_argument('--min-seconds', type=float, default=0.05,
+                       help='Рост времени меньше этого порога не считается регрессией')
+    suite.set_defaults(func=run_suite)
+
+    args = parser.parse_args()
+    args.func(args)
@@ -5,6 +5,18 @@ import argparse
 from PIL import Image, ImageEnhance, ImageFilter, ImageOps
 from pathlib import Path
 import json
+import io
+import time
+import contextlib
+import threading
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from concurrent.futures.process import BrokenProcessPool
+from result_cache import ResultCache, hash_file, hash_config
+from batch import BatchJournal, BatchProgress, scan_images
+from variant_pool import (get_worker_count, get_variant_pool, _reset_variant_pool,
+                          _to_shared_memory, _run_shared, add_method_listener, _notify_method)
+import profiling
+from profiling import stage
 
 def load_config():
     """Загрузка конфигурации если есть"""
@@ -14,6 +26,30 @@ def load_config():
             return json.load(f)
     return {}
 
+_result_cache = None
+_result_cache_failed = False
+_result_cache_lock = threading.Lock()
+
+def get_result_cache():
+    """
+    Общий кэш результатов. Каталог задается RESULT_CACHE_DIR (пустое значение
+    отключает кэш), лимит объема - RESULT_CACHE_MAX_MB.
+    """
+    global _result_cache, _result_cache_failed
+    cache_dir = os.environ.get('RESULT_CACHE_DIR', '/app/cache')
+    if not cache_dir:
+        return None
+    with _result_cache_lock:
+        if _result_cache is None and not _result_cache_failed:
+            max_mb = int(os.environ.get('RESULT_CACHE_MAX_MB', 1024))
+            try:
+                _result_cache = ResultCache(cache_dir, max_bytes=max_mb * 1024 * 1024)
+            except OSError as e:
+                # Без каталога кэша продолжаем работать без него
+                print(f"⚠️ Кэш результатов отключен: {str(e)}")
+                _result_cache_failed = True
+        return _result_cache
+
 def upscale_image(image_path, scale_factor=2.0):
     """Увеличивает разрешение изображения с высоким качеством"""
     try:
@@ -30,63 +66,523 @@ def upscale_image(image_path, scale_factor=2.0):
         print(f"❌ Ошибка апскейла: {str(e)}")
         return None, None, None
 
-def enhance_document_quality(image_path, output_path, method='smooth_quality', config=None):
-    """Улучшает качество документа с сохранением деталей"""
+def upscale_array(img, scale_factor=2.0):
+    """Увеличивает разрешение уже декодированного изображения прямо в памяти"""
+    height, width = img.shape[:2]
+    new_size = (int(width * scale_factor), int(height * scale_factor))
+    
+    # LANCZOS из PIL, как в upscale_image. Фильтр применяется к каждому каналу
+    # отдельно, поэтому BGR можно передать как есть, без конвертации в RGB
+    with stage('upscale'):
+        upscaled = Image.fromarray(img).resize(new_size, Image.LANCZOS)
+        return np.asarray(upscaled)
+
+def parse_method(method):
+    """Разбирает имя метода на базовый метод и коэффициент увеличения"""
+    if method.endswith('_2x'):
+        return method[:-len('_2x')], 2.0
+    if method.endswith('_3x'):
+        return method[:-len('_3x')], 3.0
+    return method, 1.0
+
+def run_method(img, output_path, base_method, config=None):
+    """
+    Выполняет базовый метод над изображением. Если обработка целиком не
+    укладывается в лимит памяти или включена параллельная обработка полосами,
+    изображение обрабатывается по тайлам
+    """
+    import tiled
+    
+    intra_workers = tiled.get_intra_workers(config)
+    if intra_workers > 1 or tiled.should_tile(img.shape, base_method, config):
+        return tiled.enhance_array_tiled(img, output_path, base_method, config,
+                                         workers=intra_workers)
+    
+    enhance_fn = ENHANCE_METHODS.get(base_method, enhance_smooth_quality)
+    return enhance_fn(img, output_path, config)
+
+# Наибольшая сторона превью для выбора варианта
+PREVIEW_MAX_SIDE = 480
+
+def load_preview_proxy(image_path, max_side=PREVIEW_MAX_SIDE):
+    """
+    Уменьшенная копия изображения (BGR) для превью. JPEG сразу декодируется
+    в уменьшенном масштабе (draft), полное разрешение не разворачивается
+    """
+    with Image.open(image_path) as img:
+        img.draft('RGB', (max_side, max_side))
+        # cv2.imread учитывает ориентацию из EXIF, превью должно совпадать
+        proxy = ImageOps.exif_transpose(img).convert('RGB')
+    proxy.thumbnail((max_side, max_side), Image.LANCZOS)
+    return cv2.cvtColor(np.asarray(proxy), cv2.COLOR_RGB2BGR)
+
+def enhance_preview(proxy, output_path, method='smooth_quality', config=None):
+    """
+    Превью варианта: метод выполняется над уменьшенной копией оригинала.
+    Для методов с увеличением копия дополнительно уменьшается в scale раз,
+    чтобы превью всех вариантов были одного размера
+    """
+    _, scale_factor = parse_method(method)
+    if scale_factor > 1:
+        height, width = proxy.shape[:2]
+        proxy = cv2.resize(proxy, (max(1, round(width / scale_factor)),
+                                   max(1, round(height / scale_factor))),
+                           interpolation=cv2.INTER_AREA)
+    return _enhance_image(proxy, output_path, method, config)
+
+def enhance_image(img, output_path, method='smooth_quality', config=None):
+    """Улучшает декодированное изображение (BGR ndarray) без временных файлов"""
+    start = time.perf_counter()
+    result = _enhance_image(img, output_path, method, config)
+    _notify_method(method, result, time.perf_counter() - start)
+    return result
+
+def _enhance_image(img, output_path, method, config):
+    import tiled
+    
     if config is None:
         config = {}
     
-    try:
-        print(f"Обработка: {os.path.basename(image_path)}")
+    base_method, scale_factor = parse_method(method)
+    
+    # Большое увеличенное изображение не собираем в памяти целиком:
+    # увеличение и обработка идут по тайлам через буфер на диске
+    scaled_shape = (int(img.shape[0] * scale_factor), int(img.shape[1] * scale_factor))
+    if scale_factor > 1.0 and tiled.should_tile(scaled_shape, base_method, config):
+        return tiled.enhance_array_tiled(img, output_path, base_method, config,
+                                         scale_factor=scale_factor,
+                                         workers=tiled.get_intra_workers(config))
+    
+    # Увеличиваем разрешение в памяти, без промежуточного JPEG
+    if scale_factor > 1.0:
+        original_size = (img.shape[1], img.shape[0])
+        img = upscale_array(img, scale_factor)
+        new_size = (img.shape[1], img.shape[0])
+        print(f"✅ Разрешение увеличено: {original_size} → {new_size} (x{scale_factor})")
+    
+    # Применяем основной метод улучшения
+    return run_method(img, output_path, base_method, config)
+
+def _tiled_level(shape, scale_factor, base_methods, config):
+    """
+    Не помещается ли уровень увеличения в лимит памяти. Такой уровень не
+    собирается в памяти целиком: каждый метод увеличивает оригинал по тайлам сам
+    """
+    import tiled
+    
+    if scale_factor <= 1.0:
+        return False
+    scaled_shape = (int(shape[0] * scale_factor), int(shape[1] * scale_factor))
+    return any(tiled.should_tile(scaled_shape, base_method, config) for base_method in base_methods)
+
+def enhance_variants(img, outputs, config=None, on_result=None):
+    """
+    Строит несколько вариантов из одного декодированного изображения.
+    outputs - словарь {метод: путь к результату}. Каждый уровень увеличения
+    вычисляется один раз и используется всеми методами этого уровня.
+    on_result(method, success) вызывается сразу после каждого варианта.
+    """
+    if config is None:
+        config = {}
+    
+    # Группируем методы по коэффициенту увеличения
+    by_scale = {}
+    for method in sorted(outputs, key=method_cost):
+        base_method, scale_factor = parse_method(method)
+        by_scale.setdefault(scale_factor, []).append((method, base_method))
+    
+    results = {}
+    for scale_factor in sorted(by_scale):
+        if _tiled_level(img.shape, scale_factor, [base for _, base in by_scale[scale_factor]], config):
+            for method, _ in by_scale[scale_factor]:
+                print(f"Обработка методом: {method}")
+                start = time.perf_counter()
+                results[method] = _enhance_image(img, outputs[method], method, config)
+                _notify_method(method, results[method], time.perf_counter() - start)
+                if on_result is not None:
+                    on_result(method, results[method])
+            continue
         
-        # Определяем, нужно ли увеличивать разрешение
-        scale_factor = 1.0
-        base_method = method
+        if scale_factor > 1.0:
+            scaled = upscale_array(img, scale_factor)
+            print(f"✅ Разрешение увеличено: {(img.shape[1], img.shape[0])} → "
+                  f"{(scaled.shape[1], scaled.shape[0])} (x{scale_factor})")
+        else:
+            scaled = img
         
-        if method.endswith('_2x'):
-            scale_factor = 2.0
-            base_method = method.replace('_2x', '')
-        elif method.endswith('_3x'):
-            scale_factor = 3.0
-            base_method = method.replace('_3x', '')
+        for method, base_method in by_scale[scale_factor]:
+            print(f"Обработка методом: {method}")
+            start = time.perf_counter()
+            results[method] = run_method(scaled, outputs[method], base_method, config)
+            _notify_method(method, results[method], time.perf_counter() - start)
+            if on_result is not None:
+                on_result(method, results[method])
         
-        # Сначала увеличиваем разрешение если нужно
-        if scale_factor > 1.0:
-            upscaled_img, original_size, new_size = upscale_image(image_path, scale_factor)
-            if upscaled_img is None:
-                return False
+        # Освобождаем буфер уровня до перехода к следующему
+        del scaled
+    
+    return results
+
+def _upscale_collecting(img, scale_factor, pending, collect):
+    """
+    Увеличивает уровень в отдельном потоке (LANCZOS в PIL отпускает GIL) и,
+    пока он считается, сообщает о вариантах, готовых в пуле: collect(done)
+    вызывается в вызывающем потоке сразу, а не после увеличения
+    """
+    profile = profiling.current()
+    
+    def upscale():
+        with profiling.attach(profile):
+            return upscale_array(img, scale_factor)
+    
+    with ThreadPoolExecutor(max_workers=1, thread_name_prefix='enhance-upscale') as executor:
+        future = executor.submit(upscale)
+        while not future.done():
+            done, _ = wait(list(pending) + [future], return_when=FIRST_COMPLETED)
+            done.discard(future)
+            if done:
+                collect(done)
+        return future.result()
+
+def _enhance_shared_variant(shm_name, shape, dtype, base_method, output_path, config):
+    """Строит в процессе пула один вариант по уже увеличенному изображению"""
+    return _run_shared(shm_name, shape, dtype, run_method, output_path, base_method, config)
+
+def _enhance_shared_image(shm_name, shape, dtype, method, output_path, config):
+    """
+    Строит в процессе пула один вариант по оригиналу вместе с увеличением
+    разрешения (по тайлам, если увеличенное изображение не помещается в лимит)
+    """
+    return _run_shared(shm_name, shape, dtype, _enhance_image, output_path, method, config)
+
+def enhance_variants_parallel(img, outputs, config=None, workers=None, on_result=None):
+    """
+    Параллельная версия enhance_variants на пуле процессов.
+    Каждый уровень увеличения вычисляется один раз в основном процессе и
+    передается в процессы через разделяемую память. Пока пул обрабатывает
+    текущий уровень, следующий уже готовится. Уровень, не помещающийся в
+    лимит памяти, процессы строят по тайлам из оригинала.
+    """
+    if config is None:
+        config = {}
+    if workers is None:
+        workers = get_worker_count(config)
+    
+    by_scale = {}
+    for method in sorted(outputs, key=method_cost):
+        base_method, scale_factor = parse_method(method)
+        by_scale.setdefault(scale_factor, []).append((method, base_method))
+    
+    pool = get_variant_pool(workers)
+    segments = {}
+    pending = {}
+    results = {}
+    # Замеры из процессов пула добавляются к замерам вызывающего потока
+    profile = profiling.current()
+    
+    def collect(done):
+        for future in done:
+            method, level = pending.pop(future)
+            try:
+                results[method], stages, seconds = future.result()
+                if profile is not None:
+                    profile.merge(stages)
+                _notify_method(method, results[method], seconds)
+            except BrokenProcessPool:
+                raise
+            except Exception as e:
+                print(f"❌ Ошибка в процессе для {method}: {str(e)}")
+                results[method] = False
+            if on_result is not None:
+                on_result(method, results[method])
+            # Сегмент уровня больше не нужен, когда все его методы готовы
+            if not any(s == level for _, s in pending.values()):
+                shm = segments.pop(level, None)
+                if shm is not None:
+                    shm.close()
+                    shm.unlink()
+    
+    try:
+        for scale_factor in sorted(by_scale):
+            methods = by_scale[scale_factor]
+            tiled_level = _tiled_level(img.shape, scale_factor, [base for _, base in methods], config)
+            # Уровень по тайлам использует сегмент оригинала
+            level = 1.0 if tiled_level else scale_factor
+            scaled = _upscale_collecting(img, scale_factor, pending, collect) if level > 1.0 else img
+            if level not in segments:
+                segments[level] = _to_shared_memory(scaled)
+            shm = segments[level]
             
-            # Сохраняем временное увеличенное изображение
-            temp_path = output_path.replace('.jpg', '_temp.jpg')
-            upscaled_img.save(temp_path, 'JPEG', quality=95)
+            for method, base_method in methods:
+                print(f"Обработка методом: {method}")
+                if tiled_level:
+                    future = pool.submit(_enhance_shared_image, shm.name, scaled.shape,
+                                         scaled.dtype.str, method, outputs[method], config)
+                else:
+                    future = pool.submit(_enhance_shared_variant, shm.name, scaled.shape,
+                                         scaled.dtype.str, base_method, outputs[method], config)
+                pending[future] = (method, level)
+            del scaled
             
-            # Теперь применяем основной метод к увеличенному изображению
-            img = cv2.imread(temp_path)
-            print(f"✅ Разрешение увеличено: {original_size} → {new_size} (x{scale_factor})")
-        else:
-            img = cv2.imread(image_path)
+            # Забираем уже готовые результаты, не дожидаясь остальных
+            done = [future for future in pending if future.done()]
+            collect(done)
+        
+        while pending:
+            done, _ = wait(list(pending), return_when=FIRST_COMPLETED)
+            collect(done)
+    except BrokenProcessPool:
+        # Процесс пула упал: следующий вызов создаст новый пул
+        _reset_variant_pool()
+        raise
+    finally:
+        for shm in segments.values():
+            shm.close()
+            shm.unlink()
+    
+    return results
+
+def enhance_document_variants(image_path, outputs, config=None, workers=None, on_result=None,
+                              use_cache=True):
+    """
+    Декодирует документ один раз и строит по нему все запрошенные варианты.
+    Варианты, уже лежащие в кэше результатов, берутся из него без обработки.
+    """
+    if config is None:
+        config = {}
+    if workers is None:
+        workers = get_worker_count(config)
+    
+    cache = get_result_cache() if use_cache else None
+    cache_keys = {}
+    
+    # Запоминаем готовые варианты, чтобы при ошибке не потерять их результаты
+    reported = {}
+    
+    def report(method, success):
+        reported[method] = success
+        if success and method in cache_keys:
+            cache.put(cache_keys[method], outputs[method])
+        if on_result is not None:
+            on_result(method, success)
+    
+    try:
+        print(f"Обработка: {os.path.basename(image_path)}")
+        
+        pending = dict(outputs)
+        if cache is not None:
+            input_hash = hash_file(image_path)
+            for method in sorted(outputs, key=method_cost):
+                key = cache.make_key(input_hash, method, config,
+                                     os.path.splitext(outputs[method])[1])
+                if cache.get(key, outputs[method]):
+                    print(f"✅ Из кэша: {method}")
+                    del pending[method]
+                    report(method, True)
+                else:
+                    cache_keys[method] = key
+            if not pending:
+                return dict(reported)
         
+        with stage('decode'):
+            img = cv2.imread(image_path)
         if img is None:
             raise ValueError(f"Не удалось загрузить изображение: {image_path}")
         
-        # Применяем основной метод улучшения
-        if base_method == 'smooth_quality':
-            result = enhance_smooth_quality(img, output_path, config)
-        elif base_method == 'natural_enhance':
-            result = enhance_natural_enhance_pil(img, output_path, config)
-        elif base_method == 'soft_contrast':
-            result = enhance_soft_contrast(img, output_path, config)
-        elif base_method == 'professional_gentle':
-            result = enhance_professional_gentle(img, output_path, config)
+        if workers > 1 and len(pending) > 1:
+            enhance_variants_parallel(img, pending, config, workers, report)
         else:
-            result = enhance_smooth_quality(img, output_path, config)
+            enhance_variants(img, pending, config, report)
+        return dict(reported)
         
-        # Удаляем временный файл если он был создан
-        if scale_factor > 1.0:
-            temp_path = output_path.replace('.jpg', '_temp.jpg')
-            if os.path.exists(temp_path):
-                os.remove(temp_path)
+    except Exception as e:
+        print(f"❌ Ошибка при обработке {image_path}: {str(e)}")
+        for method in outputs:
+            if method not in reported:
+                report(method, False)
+        return dict(reported)
+
+def enhance_batch_variants(documents, config=None, workers=None, on_result=None, use_cache=True):
+    """
+    Строит варианты сразу для нескольких документов на общем пуле процессов.
+    documents - список (image_path, outputs), on_result(index, method, success)
+    вызывается в вызывающем потоке по готовности каждого варианта.
+
+    Пары документ-метод идут в пул в порядке стоимости: сначала варианты без
+    увеличения у всех документов, затем 2x, затем 3x, поэтому первые
+    результаты по каждому документу появляются быстро, а дорогие варианты
+    загружают пул до конца пакета. Уровень увеличения документа вычисляется
+    один раз и лежит в разделяемой памяти, пока его методы не готовы; в работе
+    не больше двух пар на процесс, поэтому память не растет с размером пакета.
+    Уровень, не помещающийся в лимит памяти, процессы строят по тайлам из
+    оригинала.
+    """
+    if config is None:
+        config = {}
+    if workers is None:
+        workers = get_worker_count(config)
+    
+    cache = get_result_cache() if use_cache else None
+    results = [{} for _ in documents]
+    profile = profiling.current()
+    
+    def report(index, method, success, cache_key=None):
+        results[index][method] = success
+        if success and cache_key:
+            cache.put(cache_key, documents[index][1][method])
+        if on_result is not None:
+            on_result(index, method, success)
+    
+    # Уровни (коэффициент увеличения, номер документа) с их методами
+    levels = {}
+    for index, (image_path, outputs) in enumerate(documents):
+        input_hash = None
+        if cache is not None:
+            try:
+                input_hash = hash_file(image_path)
+            except OSError as e:
+                print(f"❌ Не удалось прочитать {image_path}: {str(e)}")
+                for method in outputs:
+                    report(index, method, False)
+                continue
+        for method in sorted(outputs, key=method_cost):
+            cache_key = None
+            if input_hash is not None:
+                cache_key = cache.make_key(input_hash, method, config,
+                                           os.path.splitext(outputs[method])[1])
+                if cache.get(cache_key, outputs[method]):
+                    report(index, method, True)
+                    continue
+            base_method, scale_factor = parse_method(method)
+            levels.setdefault((scale_factor, index), []).append((method, base_method, cache_key))
+    
+    pool = get_variant_pool(workers)
+    segments = {}
+    pending = {}
+    
+    def release(level):
+        segment = segments.get(level)
+        if segment is not None:
+            segment[1] -= 1
+            if segment[1] == 0:
+                del segments[level]
+                segment[0].close()
+                segment[0].unlink()
+    
+    def finish(future):
+        index, method, level, cache_key = pending.pop(future)
+        broken = False
+        try:
+            success, stages, seconds = future.result()
+            if profile is not None:
+                profile.merge(stages)
+            _notify_method(method, success, seconds)
+        except BrokenProcessPool:
+            print(f"❌ Процесс обработки аварийно завершился: {method}")
+            success, broken = False, True
+        except Exception as e:
+            print(f"❌ Ошибка в процессе для {method}: {str(e)}")
+            success = False
+        release(level)
+        report(index, method, success, cache_key)
+        return broken
+    
+    def collect(done):
+        nonlocal pool
+        broken = False
+        for future in done:
+            broken = finish(future) or broken
+        if broken:
+            # Вместе с упавшим пулом потеряны и остальные пары в работе
+            for future in list(pending):
+                finish(future)
+            _reset_variant_pool()
+            pool = get_variant_pool(workers)
+    
+    def submit_level(level):
+        scale_factor, index = level
+        image_path, outputs = documents[index]
+        with stage('decode'):
+            img = cv2.imread(image_path)
+        if img is None:
+            print(f"❌ Не удалось загрузить изображение: {image_path}")
+            for method, _, _ in levels[level]:
+                report(index, method, False)
+            return
+        tiled_level = _tiled_level(img.shape, scale_factor,
+                                   [base for _, base, _ in levels[level]], config)
+        if scale_factor > 1.0 and not tiled_level:
+            scaled = _upscale_collecting(img, scale_factor, pending, collect)
+        else:
+            scaled = img
+        del img
+        shm = _to_shared_memory(scaled)
+        segments[level] = [shm, len(levels[level])]
+        for method, base_method, cache_key in levels[level]:
+            print(f"Обработка {os.path.basename(image_path)} методом: {method}")
+            if tiled_level:
+                future = pool.submit(_enhance_shared_image, shm.name, scaled.shape,
+                                     scaled.dtype.str, method, outputs[method], config)
+            else:
+                future = pool.submit(_enhance_shared_variant, shm.name, scaled.shape,
+                                     scaled.dtype.str, base_method, outputs[method], config)
+            pending[future] = (index, method, level, cache_key)
+    
+    try:
+        for level in sorted(levels):
+            while len(pending) >= workers * 2:
+                done, _ = wait(list(pending), return_when=FIRST_COMPLETED)
+                collect(done)
+            submit_level(level)
+        
+        while pending:
+            done, _ = wait(list(pending), return_when=FIRST_COMPLETED)
+            collect(done)
+    finally:
+        for shm, _ in segments.values():
+            shm.close()
+            shm.unlink()
+    
+    return results
+
+def enhance_document_quality(image_path, output_path, method='smooth_quality', config=None,
+                             use_cache=True, source_hash=None):
+    """
+    Улучшает качество документа с сохранением деталей. Многостраничный TIFF
+    обрабатывается постранично (см. multipage.py). source_hash - уже
+    посчитанный хэш входного файла, чтобы не читать его для кэша повторно
+    """
+    import multipage
+    
+    if config is None:
+        config = {}
+    
+    try:
+        print(f"Обработка: {os.path.basename(image_path)}")
+        
+        # Кэш результатов хранит по одному файлу на вариант, страницы в него не попадают
+        if multipage.is_multipage(image_path):
+            return multipage.enhance_multipage(image_path, output_path, method, config)
+        
+        # Повторная обработка того же файла тем же методом берется из кэша
+        cache = get_result_cache() if use_cache else None
+        if cache is not None:
+            cache_key = cache.make_key(source_hash or hash_file(image_path), method, config,
+                                       os.path.splitext(output_path)[1])
+            if cache.get(cache_key, output_path):
+                print(f"✅ Из кэша: {os.path.basename(image_path)}")
+                return True
+        
+        with stage('decode'):
+            img = cv2.imread(image_path)
+        if img is None:
+            raise ValueError(f"Не удалось загрузить изображение: {image_path}")
+        
+        result = enhance_image(img, output_path, method, config)
         
         if result:
+            if cache is not None:
+                cache.put(cache_key, output_path)
             print(f"✅ Успешно: {os.path.basename(image_path)}")
         return result
         
@@ -96,78 +592,117 @@ def enhance_document_quality(image_path, output_path, method='smooth_quality', c
         print(f"🔍 Детали ошибки: {traceback.format_exc()}")
         return False
 
-def enhance_smooth_quality(img, output_path, config):
-    """
-    Плавное улучшение качества без артефактов
-    """
-    try:
-        # 1. Очень легкое шумоподавление
+def smooth_denoise_lab(img):
+    """smooth_quality, шаги 1-2: шумоподавление и перевод в LAB"""
+    # 1. Очень легкое шумоподавление
+    with stage('smooth_quality.denoise'):
         denoised = cv2.fastNlMeansDenoisingColored(img, None, 
                                                   h=3,
                                                   hColor=3, 
                                                   templateWindowSize=5, 
                                                   searchWindowSize=15)
-        
-        # 2. Плавное увеличение контраста через LAB
-        lab = cv2.cvtColor(denoised, cv2.COLOR_BGR2LAB)
-        l, a, b = cv2.split(lab)
-        
+    
+    # 2. Плавное увеличение контраста через LAB
+    with stage('smooth_quality.to_lab'):
+        return cv2.cvtColor(denoised, cv2.COLOR_BGR2LAB)
+
+def smooth_clahe(l):
+    """smooth_quality: CLAHE по яркости (зависит от всего изображения)"""
+    with stage('smooth_quality.clahe'):
         clahe = cv2.createCLAHE(clipLimit=1.5, tileGridSize=(12,12))
-        l_enhanced = clahe.apply(l)
+        return clahe.apply(l)
+
+def smooth_finish(lab, l_enhanced):
+    """smooth_quality, шаги 3-5: смешивание, резкость и гамма"""
+    with stage('smooth_quality.blend'):
+        l, a, b = cv2.split(lab)
         
         # 3. Плавное смешивание
         blend_ratio = 0.6
         l_final = cv2.addWeighted(l_enhanced, blend_ratio, l, 1 - blend_ratio, 0)
-        
         lab_enhanced = cv2.merge([l_final, a, b])
+    
+    with stage('smooth_quality.from_lab'):
         contrast_enhanced = cv2.cvtColor(lab_enhanced, cv2.COLOR_LAB2BGR)
-        
-        # 4. Мягкое увеличение резкости
+    
+    # 4. Мягкое увеличение резкости
+    with stage('smooth_quality.sharpen'):
         blurred = cv2.GaussianBlur(contrast_enhanced, (0, 0), 1.0)
         sharpness_strength = 0.3
         sharpened = cv2.addWeighted(contrast_enhanced, 1.0 + sharpness_strength, 
                                    blurred, -sharpness_strength, 0)
-        
-        # 5. Коррекция гаммы
-        final = adjust_gamma_smooth(sharpened, gamma=0.95)
+    
+    # 5. Коррекция гаммы
+    with stage('smooth_quality.gamma'):
+        return adjust_gamma_smooth(sharpened, gamma=0.95)
+
+def enhance_smooth_quality(img, output_path, config):
+    """
+    Плавное улучшение качества без артефактов
+    """
+    try:
+        lab = smooth_denoise_lab(img)
+        l_enhanced = smooth_clahe(cv2.extractChannel(lab, 0))
+        final = smooth_finish(lab, l_enhanced)
         
         # 6. Сохраняем с максимальным качеством
-        cv2.imwrite(output_path, final, [cv2.IMWRITE_JPEG_QUALITY, 95])
+        with stage('encode'):
+            cv2.imwrite(output_path, final, [cv2.IMWRITE_JPEG_QUALITY, 95])
         return True
         
     except Exception as e:
         print(f"❌ Ошибка в enhance_smooth_quality: {str(e)}")
         return False
 
+def natural_unsharp(pil_img):
+    """natural_enhance, шаг 1: легкий Unsharp Mask"""
+    with stage('natural_enhance.unsharp'):
+        return pil_img.filter(ImageFilter.UnsharpMask(
+            radius=0.5,
+            percent=50,
+            threshold=1
+        ))
+
+def natural_contrast(pil_img, mean=None):
+    """
+    natural_enhance, шаг 2: мягкое увеличение контраста.
+    mean - средняя яркость всего изображения, если она посчитана заранее
+    (так делает ImageEnhance.Contrast, когда видит изображение целиком)
+    """
+    with stage('natural_enhance.contrast'):
+        if mean is None:
+            return ImageEnhance.Contrast(pil_img).enhance(1.2)
+        degenerate = Image.new("L", pil_img.size, mean).convert(pil_img.mode)
+        return Image.blend(degenerate, pil_img, 1.2)
+
+def natural_sharpen(pil_img):
+    """natural_enhance, шаг 3: мягкое увеличение резкости"""
+    with stage('natural_enhance.sharpen'):
+        return ImageEnhance.Sharpness(pil_img).enhance(1.3)
+
 def enhance_natural_enhance_pil(img, output_path, config):
     """
     Естественное улучшение через PIL
     """
     try:
         # Конвертируем OpenCV в PIL
-        img_rgb = cv2.cvtColor(img, cv2.COLOR_BGR2RGB)
-        pil_img = Image.fromarray(img_rgb)
-        
-        # 1. Легкий Unsharp Mask
-        pil_img = pil_img.filter(ImageFilter.UnsharpMask(
-            radius=0.5,
-            percent=50,
-            threshold=1
-        ))
-        
-        # 2. Мягкое увеличение контраста
-        enhancer = ImageEnhance.Contrast(pil_img)
-        pil_img = enhancer.enhance(1.2)
+        with stage('natural_enhance.to_rgb'):
+            img_rgb = cv2.cvtColor(img, cv2.COLOR_BGR2RGB)
+            pil_img = Image.fromarray(img_rgb)
         
-        # 3. Мягкое увеличение резкости
-        enhancer = ImageEnhance.Sharpness(pil_img)
-        pil_img = enhancer.enhance(1.3)
+        pil_img = natural_unsharp(pil_img)
+        pil_img = natural_contrast(pil_img)
+        pil_img = natural_sharpen(pil_img)
         
-        # 4. Сохранение
-        pil_img.save(output_path, 'JPEG', 
-                    quality=95, 
-                    optimize=True, 
-                    subsampling=0)
+        # 4. Сохранение (формат по расширению, как у cv2.imwrite в других методах)
+        with stage('encode'):
+            if Path(output_path).suffix.lower() in ('.jpg', '.jpeg'):
+                pil_img.save(output_path, 'JPEG', 
+                            quality=95, 
+                            optimize=True, 
+                            subsampling=0)
+            else:
+                pil_img.save(output_path)
         
         return True
         
@@ -175,11 +710,22 @@ def enhance_natural_enhance_pil(img, output_path, config):
         print(f"❌ Ошибка в enhance_natural_enhance_pil: {str(e)}")
         return False
 
-def enhance_soft_contrast(img, output_path, config):
+def soft_contrast_levels(img):
     """
-    Мягкое улучшение контраста без артефактов
+    soft_contrast: границы растяжения (2 и 98 перцентили) по каждому каналу.
+    None для канала, который растягивать не нужно
     """
-    try:
+    levels = []
+    with stage('soft_contrast.levels'):
+        for channel in range(3):
+            channel_data = img[:, :, channel].astype(np.float32) / 255.0
+            p2, p98 = np.percentile(channel_data, (2, 98))
+            levels.append((p2, p98) if p98 - p2 > 0.1 else None)
+    return levels
+
+def soft_contrast_apply(img, levels):
+    """soft_contrast: растяжение гистограммы с заданными границами и резкость"""
+    with stage('soft_contrast.stretch'):
         # 1. Конвертация в float32
         img_float = img.astype(np.float32) / 255.0
         result = np.zeros_like(img_float)
@@ -187,8 +733,8 @@ def enhance_soft_contrast(img, output_path, config):
         # 2. Мягкое растяжение гистограммы
         for channel in range(3):
             channel_data = img_float[:, :, channel]
-            p2, p98 = np.percentile(channel_data, (2, 98))
-            if p98 - p2 > 0.1:
+            if levels[channel] is not None:
+                p2, p98 = levels[channel]
                 channel_enhanced = (channel_data - p2) / (p98 - p2)
                 channel_enhanced = np.clip(channel_enhanced, 0, 1)
             else:
@@ -197,41 +743,55 @@ def enhance_soft_contrast(img, output_path, config):
         
         # 3. Преобразование обратно
         result = (result * 255).astype(np.uint8)
-        
-        # 4. Легкое увеличение резкости
+    
+    # 4. Легкое увеличение резкости
+    with stage('soft_contrast.sharpen'):
         kernel = np.array([[0, -0.1, 0],
                           [-0.1, 1.4, -0.1],
                           [0, -0.1, 0]])
-        final = cv2.filter2D(result, -1, kernel)
+        return cv2.filter2D(result, -1, kernel)
+
+def enhance_soft_contrast(img, output_path, config):
+    """
+    Мягкое улучшение контраста без артефактов
+    """
+    try:
+        final = soft_contrast_apply(img, soft_contrast_levels(img))
         
-        cv2.imwrite(output_path, final, [cv2.IMWRITE_JPEG_QUALITY, 95])
+        with stage('encode'):
+            cv2.imwrite(output_path, final, [cv2.IMWRITE_JPEG_QUALITY, 95])
         return True
         
     except Exception as e:
         print(f"❌ Ошибка в enhance_soft_contrast: {str(e)}")
         return False
 
-def enhance_professional_gentle(img, output_path, config):
-    """
-    Профессиональная плавная обработка
-    """
-    try:
-        # 1. Коррекция через YUV
+def gentle_luma(img):
+    """professional_gentle, шаг 1: коррекция яркости через YUV"""
+    with stage('professional_gentle.to_yuv'):
         yuv = cv2.cvtColor(img, cv2.COLOR_BGR2YUV)
         y, u, v = cv2.split(yuv)
-        
+    
+    with stage('professional_gentle.luma'):
         y_float = y.astype(np.float32) / 255.0
         y_enhanced = y_float ** 0.9
         y_enhanced = (y_enhanced * 255).astype(np.uint8)
-        
-        # 2. Мягкий CLAHE
+    return y_enhanced, u, v
+
+def gentle_clahe(y):
+    """professional_gentle, шаг 2: мягкий CLAHE (зависит от всего изображения)"""
+    with stage('professional_gentle.clahe'):
         clahe = cv2.createCLAHE(clipLimit=1.0, tileGridSize=(16,16))
-        y_final = clahe.apply(y_enhanced)
-        
+        return clahe.apply(y)
+
+def gentle_finish(y_final, u, v):
+    """professional_gentle, шаги 3-4: резкость и коррекция цвета"""
+    with stage('professional_gentle.from_yuv'):
         yuv_enhanced = cv2.merge([y_final, u, v])
         result = cv2.cvtColor(yuv_enhanced, cv2.COLOR_YUV2BGR)
-        
-        # 3. Двухэтапное увеличение резкости
+    
+    # 3. Двухэтапное увеличение резкости
+    with stage('professional_gentle.sharpen'):
         kernel_light = np.array([[0, -0.05, 0],
                                 [-0.05, 1.2, -0.05],
                                 [0, -0.05, 0]])
@@ -239,16 +799,27 @@ def enhance_professional_gentle(img, output_path, config):
         
         blurred = cv2.GaussianBlur(stage1, (0, 0), 0.5)
         final = cv2.addWeighted(stage1, 1.1, blurred, -0.1, 0)
-        
-        # 4. Коррекция цвета
+    
+    # 4. Коррекция цвета
+    with stage('professional_gentle.color'):
         hsv = cv2.cvtColor(final, cv2.COLOR_BGR2HSV)
         h, s, v = cv2.split(hsv)
         s = cv2.multiply(s, 1.05)
         
         hsv_final = cv2.merge([h, s, v])
-        final_bgr = cv2.cvtColor(hsv_final, cv2.COLOR_HSV2BGR)
+        return cv2.cvtColor(hsv_final, cv2.COLOR_HSV2BGR)
+
+def enhance_professional_gentle(img, output_path, config):
+    """
+    Профессиональная плавная обработка
+    """
+    try:
+        y_enhanced, u, v = gentle_luma(img)
+        y_final = gentle_clahe(y_enhanced)
+        final_bgr = gentle_finish(y_final, u, v)
         
-        cv2.imwrite(output_path, final_bgr, [cv2.IMWRITE_JPEG_QUALITY, 95])
+        with stage('encode'):
+            cv2.imwrite(output_path, final_bgr, [cv2.IMWRITE_JPEG_QUALITY, 95])
         return True
         
     except Exception as e:
@@ -266,30 +837,248 @@ def adjust_gamma_smooth(image, gamma=1.0):
         print(f"❌ Ошибка в adjust_gamma_smooth: {str(e)}")
         return image
 
-def process_all_images(input_dir='/app/input', output_dir='/app/output', method='smooth_quality'):
-    """Обрабатывает все изображения в директории"""
+# Базовые методы улучшения (без суффиксов _2x/_3x)
+ENHANCE_METHODS = {
+    'smooth_quality': enhance_smooth_quality,
+    'natural_enhance': enhance_natural_enhance_pil,
+    'soft_contrast': enhance_soft_contrast,
+    'professional_gentle': enhance_professional_gentle,
+}
+
+# Относительная стоимость базовых методов: дешевые варианты строятся первыми,
+# чтобы первые результаты появлялись как можно раньше
+BASE_METHOD_COST = {
+    'soft_contrast': 1,
+    'natural_enhance': 2,
+    'professional_gentle': 3,
+    'smooth_quality': 10,
+}
+
+def method_cost(method):
+    """Примерная стоимость варианта с учетом увеличения разрешения"""
+    base_method, scale_factor = parse_method(method)
+    return BASE_METHOD_COST.get(base_method, 10) * scale_factor ** 2
+
+# Все варианты: базовые методы и их комбинации с увеличением разрешения
+ALL_METHODS = [
+    'smooth_quality', 'natural_enhance', 'soft_contrast', 'professional_gentle',
+    'smooth_quality_2x', 'smooth_quality_3x',
+    'natural_enhance_2x', 'natural_enhance_3x',
+    'soft_contrast_2x', 'soft_contrast_3x',
+    'professional_gentle_2x', 'professional_gentle_3x']
+
+def _enhance_batch_file(image_path, output_path, method, config, capture=True):
+    """
+    Обрабатывает один файл пакета и считает хэш входа для журнала.
+    В процессе пула (capture) вывод собирается в строку.
+    Возвращает результат, время, вывод, хэш входа, замеры стадий и
+    обращения к кэшу этого вызова (попадания, промахи).
+    """
+    cache = get_result_cache()
+    lookups_before = (cache.hits, cache.misses) if cache is not None else (0, 0)
+    log = io.StringIO()
+    start = time.perf_counter()
+    with contextlib.redirect_stdout(log) if capture else contextlib.nullcontext(), \
+            profiling.collect() as profile:
+        input_hash = None
+        try:
+            input_hash = hash_file(image_path)
+        except OSError as e:
+            print(f"❌ Не удалось прочитать {image_path}: {str(e)}")
+        result = input_hash is not None and enhance_document_quality(
+            image_path, output_path, method, config, source_hash=input_hash)
+    stages = profile.to_dict() if profiling.is_enabled() else None
+    lookups = (cache.hits - lookups_before[0], cache.misses - lookups_before[1]) \
+        if cache is not None else (0, 0)
+    return result, time.perf_counter() - start, log.getvalue(), input_hash, stages, lookups
+
+def process_batch_parallel(tasks, method, config, workers, on_done):
+    """
+    Обрабатывает поток задач (image_path, output_path) на пуле процессов.
+    Задачи берутся из итератора по мере освобождения процессов, в работе их
+    не больше двух на процесс. on_done(task, success, seconds, log, input_hash, stages)
+    вызывается в основном процессе по завершении каждой задачи. Обращения
+    к кэшу результатов в процессах пула добавляются к статистике кэша
+    основного процесса.
+    """
+    pool = get_variant_pool(workers)
+    cache = get_result_cache()
+    pending = {}
+    
+    def finish(future):
+        task = pending.pop(future)
+        try:
+            result, seconds, log, input_hash, stages, lookups = future.result()
+            if cache is not None:
+                cache.add_lookups(*lookups)
+        except BrokenProcessPool:
+            on_done(task, False, 0.0, "❌ Процесс обработки аварийно завершился\n", None, None)
+            return True
+        except Exception as e:
+            result, seconds, log, input_hash, stages = \
+                False, 0.0, f"❌ Ошибка при обработке {task[0]}: {str(e)}\n", None, None
+        on_done(task, result, seconds, log, input_hash, stages)
+        return False
+    
+    def collect(done):
+        nonlocal pool
+        broken = False
+        for future in done:
+            broken = finish(future) or broken
+        if broken:
+            # Вместе с упавшим пулом потеряны и остальные задачи в работе
+            for future in list(pending):
+                finish(future)
+            _reset_variant_pool()
+            pool = get_variant_pool(workers)
+    
+    for task in tasks:
+        while len(pending) >= workers * 2:
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            collect(done)
+        pending[pool.submit(_enhance_batch_file, task[0], task[1], method, config)] = task
+    
+    while pending:
+        done, _ = wait(pending, return_when=FIRST_COMPLETED)
+        collect(done)
+
+def _enhance_multipage_file(image_path, output_path, method, config, workers):
+    """
+    Обрабатывает многостраничный файл пакета в основном процессе: страницы
+    идут в пул параллельно. Возвращает то же, что _enhance_batch_file
+    """
+    import multipage
+    
+    start = time.perf_counter()
+    with profiling.collect() as profile:
+        input_hash = None
+        result = False
+        try:
+            input_hash = hash_file(image_path)
+            print(f"Обработка: {os.path.basename(image_path)}, страниц: {multipage.count_pages(image_path)}")
+            result = multipage.enhance_multipage(image_path, output_path, method, config, workers)
+        except Exception as e:
+            print(f"❌ Ошибка при обработке {image_path}: {str(e)}")
+    stages = profile.to_dict() if profiling.is_enabled() else None
+    return result, time.perf_counter() - start, '', input_hash, stages, (0, 0)
+
+def process_all_images(input_dir='/app/input', output_dir='/app/output', method='smooth_quality',
+                       workers=None, resume=True, recursive=False, profile_path=None,
+                       pages='tiff'):
+    """
+    Обрабатывает все изображения в директории, при recursive - и в
+    подкаталогах, повторяя их структуру в выходной директории.
+    При workers > 1 файлы обрабатываются пулом процессов. Результат каждого
+    файла записывается в журнал в выходной директории, и при resume
+    обрабатываются только новые и изменившиеся файлы.
+    profile_path - JSON-отчет с замерами стадий по всем обработанным файлам.
+    Многостраничные TIFF обрабатываются после остальных файлов, страницы
+    параллельно; результат - многостраничный TIFF (pages='tiff') или набор
+    enhanced_имя_p001.jpg... (pages='jpg').
+    """
+    import multipage
+    
+    if profile_path:
+        profiling.enable()
+    profile = profiling.Profile()
     config = load_config()
+    config_hash = hash_config(config)
+    if workers is None:
+        workers = get_worker_count(config)
     
     input_path = Path(input_dir)
     output_path = Path(output_dir)
     
-    output_path.mkdir(exist_ok=True)
+    output_path.mkdir(parents=True, exist_ok=True)
     
-    supported_formats = ['*.jpg', '*.jpeg', '*.png', '*.bmp', '.tiff', '.tif']
+    progress = BatchProgress()
+    # Многостраничные файлы: (вход, путь для журнала, stat, путь результата)
+    multipage_tasks = []
     
-    processed_count = 0
-    total_count = 0
+    with BatchJournal(output_path) as journal:
+        def iter_tasks():
+            # Файлы отдаются по мере обхода, список целиком не строится
+            created_dir = output_path
+            for entry in scan_images(input_path, recursive, exclude=output_path):
+                image_file = Path(entry.path)
+                output_dir_path = output_path / image_file.parent.relative_to(input_path)
+                output_file = output_dir_path / f"enhanced_{image_file.stem}.jpg"
+                # Возможные результаты: одностраничный и, для TIFF, многостраничный
+                outputs = [output_file]
+                if image_file.suffix.lower() in multipage.TIFF_EXTENSIONS:
+                    if pages == 'tiff':
+                        paged_target = paged_output = output_file.with_suffix('.tif')
+                    else:
+                        # В журнал пишется первая страница набора
+                        paged_target, paged_output = output_file, multipage.page_path(output_file, 1)
+                    outputs.append(paged_output)
+                stat = entry.stat()
+                # Журнал проверяется до открытия файла: страницы считаются
+                # только у TIFF, которые действительно нужно обработать
+                if resume and not all(journal.needs_processing(image_file, method, config_hash,
+                                                               candidate, stat)
+                                      for candidate in outputs):
+                    progress.skip()
+                    continue
+                target = None
+                if len(outputs) > 1 and multipage.is_multipage(image_file):
+                    target, output_file = paged_target, paged_output
+                # Файлы одного каталога идут подряд, создаем его один раз
+                if output_dir_path != created_dir:
+                    output_dir_path.mkdir(parents=True, exist_ok=True)
+                    created_dir = output_dir_path
+                if target is not None:
+                    multipage_tasks.append((str(image_file), str(output_file), stat, str(target)))
+                    continue
+                yield str(image_file), str(output_file), stat
+        
+        def on_done(task, result, seconds, log, input_hash, stages):
+            image_path, output_file, stat = task
+            profile.merge(stages)
+            journal.record(image_path, output_file, method, result, seconds,
+                           config_hash, stat, input_hash)
+            if not result:
+                print(log, end='')
+            progress.update(os.path.basename(image_path), result, seconds)
+        
+        print(f"⚙️ Процессов: {workers}")
+        if workers > 1:
+            process_batch_parallel(iter_tasks(), method, config, workers, on_done)
+        else:
+            # Обращения к кэшу в этом процессе уже учтены, отбрасываем их
+            for task in iter_tasks():
+                on_done(task, *_enhance_batch_file(task[0], task[1], method, config,
+                                                   capture=False)[:5])
+        
+        # Страницы многостраничных файлов занимают весь пул
+        for image_path, output_file, stat, target in multipage_tasks:
+            on_done((image_path, output_file, stat),
+                    *_enhance_multipage_file(image_path, target, method, config, workers)[:5])
     
-    for format in supported_formats:
-        for image_file in input_path.glob(format):
-            total_count += 1
-            output_file = output_path / f"enhanced_{image_file.stem}.jpg"
-            
-            if enhance_document_quality(str(image_file), str(output_file), method, config):
-                processed_count += 1
+    processed_count = progress.processed
+    total_count = progress.processed + progress.failed
     
     print(f"\n🎉 Обработка завершена!")
     print(f"📊 Успешно обработано: {processed_count}/{total_count} изображений")
+    progress.summary()
+    
+    if profile_path:
+        report = {
+            'method': method,
+            'workers': workers,
+            'processed': progress.processed,
+            'failed': progress.failed,
+            'seconds': round(progress.elapsed(), 3),
+            'stages': profile.to_dict(),
+        }
+        with open(profile_path, 'w', encoding='utf-8') as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+        print(f"⏱️ Замеры стадий сохранены: {profile_path}")
+    
+    cache = get_result_cache()
+    if cache is not None:
+        stats = cache.stats()
+        print(f"💾 Кэш: попаданий {stats['hits']}, промахов {stats['misses']}")
     return processed_count
 
 if __name__ == "__main__":
@@ -297,11 +1086,18 @@ if __name__ == "__main__":
     parser.add_argument('--input', '-i', default='/app/input', help='Входная директория')
     parser.add_argument('--output', '-o', default='/app/output', help='Выходная директория')
     parser.add_argument('--method', '-m', default='smooth_quality', 
-                       choices=['smooth_quality', 'natural_enhance', 'soft_contrast', 
-                               'professional_gentle', 'smooth_quality_2x', 'smooth_quality_3x',
-                               'natural_enhance_2x', 'natural_enhance_3x', 'soft_contrast_2x',
-                               'soft_contrast_3x', 'professional_gentle_2x', 'professional_gentle_3x'],
+                       choices=ALL_METHODS,
                        help='Метод улучшения')
+    parser.add_argument('--workers', '-w', type=int, default=None,
+                       help='Число процессов (по умолчанию ENHANCE_WORKERS или число ядер)')
+    parser.add_argument('--no-resume', dest='resume', action='store_false',
+                       help='Обработать все файлы заново, не сверяясь с журналом')
+    parser.add_argument('--recursive', '-r', action='store_true',
+                       help='Обрабатывать и подкаталоги, повторяя их структуру')
+    parser.add_argument('--profile', metavar='REPORT.json', default=None,
+                       help='Замерить время и память по стадиям и сохранить отчет в JSON')
+    parser.add_argument('--pages', choices=['tiff', 'jpg'], default='tiff',
+                       help='Результат для многостраничных TIFF: один TIFF или JPEG на каждую страницу')
     
     args = parser.parse_args()
     
@@ -321,4 +1117,5 @@ if __name__ == "__main__":
     print("🚀 professional_gentle_3x - профессиональное + 3x разрешение")
     print("=====================================")
     
-    process_all_images(args.input, args.output, args.method)
\ No newline at end of file
+    process_all_images(args.input, args.output, args.method, args.workers, args.resume,
+                       args.recursive, args.profile, args.pages)
\ No newline at end of file
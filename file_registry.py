@@ -0,0 +1,102 @@
+import json
+import logging
+import sqlite3
+import threading
+from collections import OrderedDict
+from itertools import islice
+
+logger = logging.getLogger(__name__)
+
+
+class FileRegistry:
+    """
+    Реестр обработанных файлов с доступом по id за O(1).
+    Записи - словари; наружу отдаются копии, изменения только через update.
+    Порядок записей - порядок добавления. Если задан db_path, реестр
+    сохраняется в SQLite и восстанавливается при перезапуске.
+    """
+
+    def __init__(self, db_path=None):
+        self._files = OrderedDict()
+        self._lock = threading.RLock()
+        self._db = None
+        if db_path:
+            self._open_db(db_path)
+
+    def _open_db(self, db_path):
+        self._db = sqlite3.connect(db_path, check_same_thread=False)
+        self._db.execute('PRAGMA journal_mode=WAL')
+        self._db.execute('CREATE TABLE IF NOT EXISTS files ('
+                         'seq INTEGER PRIMARY KEY AUTOINCREMENT, '
+                         'id TEXT UNIQUE NOT NULL, '
+                         'data TEXT NOT NULL)')
+        self._db.commit()
+        for file_id, data in self._db.execute('SELECT id, data FROM files ORDER BY seq'):
+            self._files[file_id] = json.loads(data)
+        logger.info(f"Реестр файлов загружен из {db_path}: {len(self._files)} записей")
+
+    def _execute(self, sql, params=()):
+        if self._db is None:
+            return
+        try:
+            self._db.execute(sql, params)
+            self._db.commit()
+        except sqlite3.Error as e:
+            logger.error(f"Ошибка записи реестра файлов: {str(e)}")
+
+    def add(self, record):
+        """Добавляет или заменяет запись с record['id']"""
+        record = dict(record)
+        with self._lock:
+            if record['id'] in self._files:
+                self._files[record['id']] = record
+                self._execute('UPDATE files SET data = ? WHERE id = ?',
+                              (json.dumps(record, ensure_ascii=False), record['id']))
+            else:
+                self._files[record['id']] = record
+                self._execute('INSERT INTO files (id, data) VALUES (?, ?)',
+                              (record['id'], json.dumps(record, ensure_ascii=False)))
+        return dict(record)
+
+    def get(self, file_id):
+        with self._lock:
+            record = self._files.get(file_id)
+            return dict(record) if record is not None else None
+
+    def update(self, file_id, **fields):
+        """Обновляет поля записи, возвращает новую запись или None"""
+        with self._lock:
+            record = self._files.get(file_id)
+            if record is None:
+                return None
+            record.update(fields)
+            self._execute('UPDATE files SET data = ? WHERE id = ?',
+                          (json.dumps(record, ensure_ascii=False), file_id))
+            return dict(record)
+
+    def remove(self, file_id):
+        with self._lock:
+            record = self._files.pop(file_id, None)
+            if record is not None:
+                self._execute('DELETE FROM files WHERE id = ?', (file_id,))
+            return record
+
+    def clear(self):
+        with self._lock:
+            self._files.clear()
+            self._execute('DELETE FROM files')
+
+    def list(self, offset=0, limit=None, newest_first=False):
+        """Страница записей в порядке добавления (или обратном)"""
+        with self._lock:
+            records = reversed(self._files.values()) if newest_first else iter(self._files.values())
+            stop = offset + limit if limit is not None else None
+            return [dict(record) for record in islice(records, offset, stop)]
+
+    def __len__(self):
+        with self._lock:
+            return len(self._files)
+
+    def __contains__(self, file_id):
+        with self._lock:
+            return file_id in self._files
@@ -0,0 +1,255 @@
+import logging
+import threading
+import uuid
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+
+logger = logging.getLogger(__name__)
+
+
+class JobQueueFull(Exception):
+    """Очередь фоновых задач заполнена"""
+
+
+class Job:
+    """Фоновая задача: обработка одного файла набором методов"""
+
+    def __init__(self, file_id, methods):
+        self.id = str(uuid.uuid4())
+        self.file_id = file_id
+        self.methods = list(methods)
+        self.status = 'queued'
+        self.progress = {method: 'pending' for method in self.methods}
+        self.result = None
+        self.error = None
+        self.created_time = datetime.now()
+        self.finished_time = None
+        self.lock = threading.Lock()
+        # Журнал событий для потоковой отдачи (SSE)
+        self.events = []
+        self.changed = threading.Condition(self.lock)
+
+    def set_method_result(self, method, success, variant=None):
+        """Отмечает завершение одного метода и публикует событие"""
+        with self.lock:
+            self.progress[method] = 'done' if success else 'error'
+            event = {'type': 'variant', 'method': method, 'success': bool(success)}
+            if variant:
+                event.update(variant)
+            self.events.append(event)
+            self.changed.notify_all()
+
+    def set_status(self, status, error=None):
+        """Меняет статус задачи, завершение публикуется событием"""
+        with self.lock:
+            self.status = status
+            self.error = error
+            if status in ('done', 'error'):
+                self.events.append({'type': status, 'error': error})
+            self.changed.notify_all()
+
+    def iter_events(self, start=0, keepalive=15):
+        """
+        Отдает события задачи начиная с номера start, дожидаясь новых.
+        Пока новых событий нет, раз в keepalive секунд отдает None.
+        Заканчивается после события завершения задачи.
+        """
+        index = start
+        while True:
+            with self.lock:
+                if index >= len(self.events) and not self.is_finished():
+                    self.changed.wait(timeout=keepalive)
+                pending = self.events[index:]
+                finished = self.is_finished()
+            if not pending:
+                if finished:
+                    return
+                yield index, None
+                continue
+            for event in pending:
+                yield index, event
+                index += 1
+
+    def is_finished(self):
+        return self.status in ('done', 'error')
+
+    def to_dict(self):
+        """Статус задачи для API"""
+        with self.lock:
+            progress = dict(self.progress)
+            completed = sum(1 for state in progress.values() if state != 'pending')
+            return {
+                'job_id': self.id,
+                'file_id': self.file_id,
+                'status': self.status,
+                'progress': progress,
+                'completed': completed,
+                'total': len(progress),
+                'error': self.error,
+                'created_time': self.created_time.strftime("%Y-%m-%d %H:%M:%S"),
+            }
+
+
+class Batch:
+    """
+    Пакет файлов: на каждый файл своя задача (Job), а обрабатываются они
+    вместе одним вызовом на общем пуле
+    """
+
+    def __init__(self, jobs):
+        self.id = str(uuid.uuid4())
+        self.jobs = list(jobs)
+        self.status = 'queued'
+        self.error = None
+        self.created_time = datetime.now()
+        self.finished_time = None
+
+    def is_finished(self):
+        return self.status in ('done', 'error')
+
+    def to_dict(self):
+        """Общий прогресс пакета и прогресс по каждому файлу"""
+        files = [job.to_dict() for job in self.jobs]
+        return {
+            'batch_id': self.id,
+            'status': self.status,
+            'completed': sum(item['completed'] for item in files),
+            'total': sum(item['total'] for item in files),
+            'files_done': sum(1 for item in files if item['status'] in ('done', 'error')),
+            'files_total': len(files),
+            'files': files,
+            'error': self.error,
+            'created_time': self.created_time.strftime("%Y-%m-%d %H:%M:%S"),
+        }
+
+
+class JobManager:
+    """
+    Ограниченный фоновый исполнитель задач.
+    Одновременно выполняется не больше max_workers задач, в очереди ждут
+    не больше max_pending. Завершенные задачи хранятся, пока их не больше
+    max_finished, затем самые старые забываются.
+    """
+
+    def __init__(self, max_workers=2, max_pending=16, max_finished=100):
+        self.max_workers = max_workers
+        self.max_pending = max_pending
+        self.max_finished = max_finished
+        self._executor = ThreadPoolExecutor(max_workers=max_workers,
+                                            thread_name_prefix='enhance-job')
+        self._slots = threading.BoundedSemaphore(max_workers + max_pending)
+        self._jobs = OrderedDict()
+        self._batches = OrderedDict()
+        self._lock = threading.Lock()
+
+    def submit(self, file_id, methods, fn):
+        """
+        Ставит задачу в очередь и сразу возвращает ее.
+        fn(job) выполняется в фоне, его результат сохраняется в job.result.
+        """
+        if not self._slots.acquire(blocking=False):
+            raise JobQueueFull("Очередь задач заполнена, попробуйте позже")
+
+        job = Job(file_id, methods)
+        with self._lock:
+            self._jobs[job.id] = job
+            self._forget_finished()
+
+        try:
+            self._executor.submit(self._run, job, fn)
+        except Exception:
+            self._slots.release()
+            raise
+        logger.info(f"Задача {job.id} поставлена в очередь для файла {file_id}")
+        return job
+
+    def _run(self, job, fn):
+        try:
+            job.set_status('running')
+            job.result = fn(job)
+            job.set_status('done')
+            logger.info(f"Задача {job.id} завершена")
+        except Exception as e:
+            job.set_status('error', str(e))
+            logger.error(f"Ошибка в задаче {job.id}: {str(e)}")
+        finally:
+            job.finished_time = datetime.now()
+            self._slots.release()
+
+    def submit_batch(self, files, fn):
+        """
+        Ставит в очередь пакет: files - список (file_id, methods).
+        Пакет занимает одно место в очереди. fn(batch) выполняется в фоне и
+        сам завершает задачи файлов по мере готовности; задачи, которые fn
+        не завершил, после него считаются выполненными (или ошибочными при
+        исключении).
+        """
+        if not self._slots.acquire(blocking=False):
+            raise JobQueueFull("Очередь задач заполнена, попробуйте позже")
+
+        batch = Batch(Job(file_id, methods) for file_id, methods in files)
+        with self._lock:
+            for job in batch.jobs:
+                self._jobs[job.id] = job
+            self._batches[batch.id] = batch
+            self._forget_finished()
+
+        try:
+            self._executor.submit(self._run_batch, batch, fn)
+        except Exception:
+            self._slots.release()
+            raise
+        logger.info(f"Пакет {batch.id} из {len(batch.jobs)} файлов поставлен в очередь")
+        return batch
+
+    def _run_batch(self, batch, fn):
+        try:
+            batch.status = 'running'
+            for job in batch.jobs:
+                job.set_status('running')
+            fn(batch)
+            for job in batch.jobs:
+                if not job.is_finished():
+                    job.set_status('done')
+            batch.status = 'done'
+            logger.info(f"Пакет {batch.id} завершен")
+        except Exception as e:
+            for job in batch.jobs:
+                if not job.is_finished():
+                    job.set_status('error', str(e))
+            batch.error = str(e)
+            batch.status = 'error'
+            logger.error(f"Ошибка в пакете {batch.id}: {str(e)}")
+        finally:
+            now = datetime.now()
+            batch.finished_time = now
+            for job in batch.jobs:
+                job.finished_time = job.finished_time or now
+            self._slots.release()
+
+    def _forget_finished(self):
+        """Удаляет самые старые завершенные задачи и пакеты сверх лимита"""
+        finished = [job_id for job_id, job in self._jobs.items() if job.is_finished()]
+        for job_id in finished[:max(0, len(finished) - self.max_finished)]:
+            del self._jobs[job_id]
+        finished = [batch_id for batch_id, batch in self._batches.items() if batch.is_finished()]
+        for batch_id in finished[:max(0, len(finished) - self.max_finished)]:
+            del self._batches[batch_id]
+
+    def get(self, job_id):
+        with self._lock:
+            return self._jobs.get(job_id)
+
+    def get_batch(self, batch_id):
+        with self._lock:
+            return self._batches.get(batch_id)
+
+    def stats(self):
+        """Количество задач в очереди и в работе"""
+        with self._lock:
+            statuses = [job.status for job in self._jobs.values()]
+        return {
+            'queued': statuses.count('queued'),
+            'running': statuses.count('running'),
+        }
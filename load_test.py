@@ -0,0 +1,265 @@
+"""
+Нагрузочный тест веб-сервиса.
+
+    python load_test.py --concurrency 4 --duration 60
+    python load_test.py --url http://localhost:5000 --mix upload=1,preview=6,download=2,files=1
+
+Без --url запускает web_app локально на свободном порту с временными
+папками UPLOAD_FOLDER/PROCESSED_FOLDER и без кэша результатов. Потоки
+выполняют смесь запросов: загрузку с обработкой (/process_all), просмотр и
+скачивание вариантов уже загруженных файлов и /api/files. В конце выводятся
+пропускная способность, p50/p95/p99 задержки и доля ошибок по операциям.
+"""
+import argparse
+import json
+import math
+import os
+import random
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import urllib.error
+import urllib.request
+import uuid
+
+import cv2
+
+from benchmark import make_document, parse_size
+from enhance_script import ALL_METHODS
+
+OPERATIONS = ('upload', 'preview', 'download', 'files')
+DEFAULT_MIX = 'upload=1,preview=6,download=2,files=1'
+
+
+def parse_mix(value):
+    mix = {}
+    for part in value.split(','):
+        name, weight = part.split('=')
+        if name not in OPERATIONS:
+            raise argparse.ArgumentTypeError(f"Неизвестная операция: {name}")
+        mix[name] = float(weight)
+    return mix
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def start_server(port, work_dir):
+    """Запускает web_app в отдельном процессе и ждет, пока он начнет отвечать"""
+    env = dict(os.environ,
+               UPLOAD_FOLDER=os.path.join(work_dir, 'uploads'),
+               PROCESSED_FOLDER=os.path.join(work_dir, 'processed'),
+               RESULT_CACHE_DIR='')
+    code = ("import logging, web_app; logging.disable(logging.INFO); "
+            f"web_app.app.run(host='127.0.0.1', port={port}, threaded=True)")
+    process = subprocess.Popen([sys.executable, '-c', code], env=env,
+                               cwd=os.path.dirname(os.path.abspath(__file__)),
+                               stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    url = f"http://127.0.0.1:{port}"
+    deadline = time.time() + 60
+    while time.time() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError("web_app завершился при запуске")
+        try:
+            with urllib.request.urlopen(f"{url}/health", timeout=2):
+                return process, url
+        except OSError:
+            time.sleep(0.2)
+    process.terminate()
+    raise RuntimeError("web_app не ответил за 60 секунд")
+
+
+def multipart_body(field, filename, content, content_type='image/jpeg'):
+    boundary = uuid.uuid4().hex
+    body = (f'--{boundary}\r\n'
+            f'Content-Disposition: form-data; name="{field}"; filename="{filename}"\r\n'
+            f'Content-Type: {content_type}\r\n\r\n').encode('utf-8') + content + \
+        f'\r\n--{boundary}--\r\n'.encode('utf-8')
+    return body, f'multipart/form-data; boundary={boundary}'
+
+
+class LoadTest:
+    def __init__(self, url, document, timeout):
+        self.url = url.rstrip('/')
+        self.document = document
+        self.timeout = timeout
+        self.file_ids = []
+        self.results = {name: {'latencies': [], 'errors': 0} for name in OPERATIONS}
+        self._lock = threading.Lock()
+
+    def request(self, path, data=None, headers=None):
+        """Выполняет запрос, возвращает (успех, тело)"""
+        req = urllib.request.Request(self.url + path, data=data, headers=headers or {})
+        try:
+            with urllib.request.urlopen(req, timeout=self.timeout) as response:
+                body = response.read()
+                if response.headers.get_content_type() == 'application/json':
+                    # Сервис сообщает об ошибках и с кодом 200
+                    payload = json.loads(body)
+                    if isinstance(payload, dict) and payload.get('success') is False:
+                        return False, payload
+                    return True, payload
+                return True, body
+        except (urllib.error.URLError, OSError, ValueError) as e:
+            return False, str(e)
+
+    def record(self, name, seconds, success):
+        with self._lock:
+            self.results[name]['latencies'].append(seconds)
+            if not success:
+                self.results[name]['errors'] += 1
+
+    def random_file_id(self):
+        with self._lock:
+            return random.choice(self.file_ids) if self.file_ids else None
+
+    def upload(self):
+        body, content_type = multipart_body('file', 'load_test.jpg', self.document)
+        success, payload = self.request('/process_all', body, {'Content-Type': content_type})
+        if success:
+            with self._lock:
+                self.file_ids.append(payload['file_id'])
+        return success
+
+    def preview(self, file_id):
+        return self.request(f"/preview-variant/{file_id}/{random.choice(ALL_METHODS)}")[0]
+
+    def download(self, file_id):
+        return self.request(f"/download-variant/{file_id}/{random.choice(ALL_METHODS)}")[0]
+
+    def files(self):
+        return self.request('/api/files')[0]
+
+    def worker(self, mix, deadline, stop):
+        names = list(mix)
+        weights = [mix[name] for name in names]
+        while time.time() < deadline and not stop.is_set():
+            name = random.choices(names, weights)[0]
+            args = ()
+            if name in ('preview', 'download'):
+                file_id = self.random_file_id()
+                # Пока ни один файл не загружен, смотреть нечего
+                if file_id is None:
+                    name = 'upload'
+                else:
+                    args = (file_id,)
+            start = time.perf_counter()
+            success = getattr(self, name)(*args)
+            self.record(name, time.perf_counter() - start, success)
+
+
+def percentile(sorted_values, q):
+    """Перцентиль по ближайшему рангу"""
+    if not sorted_values:
+        return 0.0
+    rank = math.ceil(q / 100 * len(sorted_values))
+    return sorted_values[max(0, min(len(sorted_values), rank) - 1)]
+
+
+def summarize(results, elapsed):
+    report = {}
+    for name, data in results.items():
+        latencies = sorted(data['latencies'])
+        if not latencies:
+            continue
+        report[name] = {
+            'requests': len(latencies),
+            'errors': data['errors'],
+            'error_rate': round(data['errors'] / len(latencies), 4),
+            'throughput': round(len(latencies) / elapsed, 3),
+            'p50': round(percentile(latencies, 50), 4),
+            'p95': round(percentile(latencies, 95), 4),
+            'p99': round(percentile(latencies, 99), 4),
+            'max': round(latencies[-1], 4),
+        }
+    all_latencies = sorted(l for data in results.values() for l in data['latencies'])
+    errors = sum(data['errors'] for data in results.values())
+    report['total'] = {
+        'requests': len(all_latencies),
+        'errors': errors,
+        'error_rate': round(errors / len(all_latencies), 4) if all_latencies else 0.0,
+        'throughput': round(len(all_latencies) / elapsed, 3),
+        'p50': round(percentile(all_latencies, 50), 4),
+        'p95': round(percentile(all_latencies, 95), 4),
+        'p99': round(percentile(all_latencies, 99), 4),
+        'max': round(all_latencies[-1], 4) if all_latencies else 0.0,
+    }
+    return report
+
+
+def print_report(report, concurrency, elapsed):
+    print(f"\n📊 Потоков: {concurrency}, длительность: {elapsed:.1f} с")
+    print(f"{'операция':<10} {'запросов':>9} {'ошибок':>8} {'запр/с':>8} "
+          f"{'p50, с':>8} {'p95, с':>8} {'p99, с':>8} {'max, с':>8}")
+    for name, stats in report.items():
+        print(f"{name:<10} {stats['requests']:>9} {stats['error_rate']:>7.1%} "
+              f"{stats['throughput']:>8.2f} {stats['p50']:>8.3f} {stats['p95']:>8.3f} "
+              f"{stats['p99']:>8.3f} {stats['max']:>8.3f}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Нагрузочный тест веб-сервиса')
+    parser.add_argument('--url', help='Адрес запущенного сервиса; без него web_app запускается локально')
+    parser.add_argument('--concurrency', '-c', type=int, default=4, help='Число параллельных клиентов')
+    parser.add_argument('--duration', '-d', type=float, default=30, help='Длительность, секунд')
+    parser.add_argument('--mix', type=parse_mix, default=parse_mix(DEFAULT_MIX),
+                        help=f'Веса операций, по умолчанию {DEFAULT_MIX}')
+    parser.add_argument('--size', type=parse_size, default=(1240, 1754),
+                        help='Размер загружаемого документа ШИРИНАxВЫСОТА или имя из benchmark.py')
+    parser.add_argument('--timeout', type=float, default=300, help='Таймаут запроса, секунд')
+    parser.add_argument('--seed', type=int, default=0, help='Зерно выбора операций')
+    parser.add_argument('--json', help='Сохранить результаты в JSON')
+    args = parser.parse_args()
+
+    random.seed(args.seed)
+    width, height = args.size
+    document = cv2.imencode('.jpg', make_document(width, height),
+                            [cv2.IMWRITE_JPEG_QUALITY, 90])[1].tobytes()
+
+    server = None
+    with tempfile.TemporaryDirectory(prefix='load_test_') as work_dir:
+        url = args.url
+        if url is None:
+            server, url = start_server(free_port(), work_dir)
+            print(f"🚀 web_app запущен: {url}")
+        try:
+            test = LoadTest(url, document, args.timeout)
+            stop = threading.Event()
+            start = time.perf_counter()
+            deadline = time.time() + args.duration
+            threads = [threading.Thread(target=test.worker, args=(args.mix, deadline, stop), daemon=True)
+                       for _ in range(args.concurrency)]
+            for thread in threads:
+                thread.start()
+            try:
+                for thread in threads:
+                    thread.join()
+            except KeyboardInterrupt:
+                # Дожидаемся запросов в работе и выводим то, что успели собрать
+                stop.set()
+                for thread in threads:
+                    thread.join()
+            elapsed = time.perf_counter() - start
+        finally:
+            if server is not None:
+                server.terminate()
+                server.wait(timeout=30)
+
+    report = summarize(test.results, elapsed)
+    print_report(report, args.concurrency, elapsed)
+    if args.json:
+        with open(args.json, 'w', encoding='utf-8') as f:
+            json.dump({'url': args.url or 'local', 'concurrency': args.concurrency,
+                       'duration': elapsed, 'mix': args.mix, 'size': [width, height],
+                       'results': report}, f, ensure_ascii=False, indent=2)
+        print(f"💾 Результаты сохранены: {args.json}")
+
+
+if __name__ == "__main__":
+    main()
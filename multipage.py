@@ -0,0 +1,208 @@
+"""
+Обработка многостраничных TIFF постранично.
+
+cv2.imread читает только первую страницу, поэтому страницы перебираются
+через PIL ImageSequence по одной, без чтения документа целиком. Каждая
+страница обрабатывается как отдельное изображение; при нескольких процессах
+страницы идут в общий пул вариантов через разделяемую память. Готовые
+страницы ждут своей очереди во временных файлах и дописываются в результат
+строго по порядку: в многостраничный TIFF (сжатие JPEG; временные страницы
+хранятся в PNG без потерь, чтобы сжатие было однократным) или набором файлов
+имя_p001.jpg, имя_p002.jpg... В памяти одновременно не больше двух страниц
+на процесс пула, независимо от длины документа.
+"""
+import os
+import shutil
+import tempfile
+import time
+from concurrent.futures import wait, FIRST_COMPLETED
+from concurrent.futures.process import BrokenProcessPool
+from pathlib import Path
+
+import cv2
+import numpy as np
+from PIL import Image, ImageSequence, TiffImagePlugin
+
+import profiling
+from profiling import stage
+from enhance_script import _enhance_image, _enhance_shared_image
+from variant_pool import _notify_method, _to_shared_memory, _reset_variant_pool, get_variant_pool
+
+TIFF_EXTENSIONS = ('.tif', '.tiff')
+
+
+def count_pages(image_path):
+    """Число страниц; для всего, кроме TIFF, и нечитаемых файлов - 1"""
+    if Path(image_path).suffix.lower() not in TIFF_EXTENSIONS:
+        return 1
+    try:
+        with Image.open(image_path) as img:
+            return getattr(img, 'n_frames', 1)
+    except Exception:
+        return 1
+
+
+def is_multipage(image_path):
+    return count_pages(image_path) > 1
+
+
+def iter_pages(image_path):
+    """Страницы документа по одной (BGR ndarray), предыдущая к этому времени уже не нужна"""
+    with Image.open(image_path) as img:
+        for page in ImageSequence.Iterator(img):
+            with stage('decode'):
+                rgb = np.asarray(page.convert('RGB'))
+            yield cv2.cvtColor(rgb, cv2.COLOR_RGB2BGR)
+            del rgb
+
+
+def page_path(output_path, number):
+    """Путь страницы в наборе: имя_p001.jpg"""
+    output_path = Path(output_path)
+    return output_path.with_name(f"{output_path.stem}_p{number:03d}{output_path.suffix}")
+
+
+class PageWriter:
+    """
+    Собирает готовые страницы по порядку: в многостраничный TIFF, если
+    output_path - .tif/.tiff, иначе набором файлов имя_p001... Результат
+    собирается во временном каталоге tmp_dir и переносится на место только
+    в commit, поэтому при ошибке не остается недописанного результата
+    """
+
+    def __init__(self, output_path, tmp_dir):
+        self.output_path = Path(output_path)
+        self.tmp_dir = tmp_dir
+        self.as_tiff = self.output_path.suffix.lower() in TIFF_EXTENSIONS
+        # Расширение временных страниц: в TIFF страница сжимается один раз при записи
+        self.page_suffix = '.png' if self.as_tiff else self.output_path.suffix
+        self.next_page = 0
+        self._ready = set()
+        self._tiff = None
+        if self.as_tiff:
+            self._tiff_path = os.path.join(tmp_dir, f"result{self.output_path.suffix}")
+            self._tiff = TiffImagePlugin.AppendingTiffWriter(self._tiff_path, new=True)
+
+    def page_tmp_path(self, index):
+        """Временный файл, в который записывается страница index"""
+        return os.path.join(self.tmp_dir, f"{index}{self.page_suffix}")
+
+    def add(self, index):
+        """Страница index готова в page_tmp_path(index)"""
+        self._ready.add(index)
+        while self.next_page in self._ready:
+            self._ready.discard(self.next_page)
+            if self._tiff is not None:
+                self._write(self.page_tmp_path(self.next_page))
+            self.next_page += 1
+
+    def _write(self, path):
+        with stage('encode'):
+            with Image.open(path) as page:
+                page.save(self._tiff, format='TIFF', compression='jpeg', quality=95)
+            self._tiff.newFrame()
+        os.remove(path)
+
+    def commit(self):
+        """Переносит собранный результат на место"""
+        self.close()
+        if self.as_tiff:
+            os.replace(self._tiff_path, self.output_path)
+            return
+        # Первая страница - последней: по ней журнал проверяет, что результат есть
+        for index in reversed(range(self.next_page)):
+            os.replace(self.page_tmp_path(index), page_path(self.output_path, index + 1))
+
+    def close(self):
+        if self._tiff is not None:
+            self._tiff.close()
+            self._tiff = None
+
+
+def enhance_multipage(image_path, output_path, method='smooth_quality', config=None, workers=1):
+    """
+    Улучшает все страницы многостраничного TIFF. При workers > 1 страницы
+    обрабатываются параллельно на общем пуле процессов. Возвращает True,
+    если обработаны все страницы. Если хоть одна страница не обработана,
+    результат не записывается
+    """
+    if config is None:
+        config = {}
+    output_path = Path(output_path)
+    tmp_dir = tempfile.mkdtemp(prefix='.pages_', dir=output_path.parent)
+    writer = PageWriter(output_path, tmp_dir)
+    pending = {}
+    segments = {}
+    failed = []
+
+    def finish(future):
+        index = pending.pop(future)
+        shm = segments.pop(index)
+        try:
+            result, stages, seconds = future.result()
+            profile = profiling.current()
+            if profile is not None:
+                profile.merge(stages)
+            _notify_method(method, result, seconds)
+        except BrokenProcessPool:
+            raise
+        except Exception as e:
+            print(f"❌ Ошибка в процессе для страницы {index + 1}: {str(e)}")
+            result = False
+        finally:
+            shm.close()
+            shm.unlink()
+        if result:
+            writer.add(index)
+        else:
+            failed.append(index)
+
+    try:
+        pool = get_variant_pool(workers) if workers > 1 else None
+        for index, page in enumerate(iter_pages(image_path)):
+            print(f"Страница {index + 1}: {method}")
+            tmp_path = writer.page_tmp_path(index)
+            if pool is None:
+                start = time.perf_counter()
+                result = _enhance_image(page, tmp_path, method, config)
+                _notify_method(method, result, time.perf_counter() - start)
+                if result:
+                    writer.add(index)
+                else:
+                    failed.append(index)
+                continue
+
+            while len(pending) >= workers * 2:
+                done, _ = wait(list(pending), return_when=FIRST_COMPLETED)
+                for future in done:
+                    finish(future)
+            shm = _to_shared_memory(page)
+            segments[index] = shm
+            future = pool.submit(_enhance_shared_image, shm.name, page.shape,
+                                 page.dtype.str, method, tmp_path, config)
+            pending[future] = index
+            del page
+
+        while pending:
+            done, _ = wait(list(pending), return_when=FIRST_COMPLETED)
+            for future in done:
+                finish(future)
+        if not failed:
+            writer.commit()
+    except BrokenProcessPool:
+        # Процесс пула упал: следующий вызов создаст новый пул
+        _reset_variant_pool()
+        raise
+    finally:
+        # Без commit недописанный результат удаляется вместе с временным каталогом
+        writer.close()
+        for shm in segments.values():
+            shm.close()
+            shm.unlink()
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+
+    if failed:
+        print(f"❌ Не обработаны страницы: {', '.join(str(index + 1) for index in sorted(failed))}")
+        return False
+    print(f"✅ Обработано страниц: {writer.next_page}")
+    return True
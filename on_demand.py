@@ -0,0 +1,81 @@
+import threading
+from collections import OrderedDict
+from concurrent.futures import Future
+
+import cv2
+
+
+class SingleFlight:
+    """
+    Объединяет одновременные вызовы с одним ключом: работа выполняется
+    один раз, остальные вызовы дожидаются и получают тот же результат.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._calls = {}
+
+    def do(self, key, fn):
+        with self._lock:
+            future = self._calls.get(key)
+            leader = future is None
+            if leader:
+                future = Future()
+                self._calls[key] = future
+
+        if not leader:
+            return future.result()
+
+        try:
+            future.set_result(fn())
+        except BaseException as e:
+            future.set_exception(e)
+        finally:
+            with self._lock:
+                del self._calls[key]
+        return future.result()
+
+    def in_flight(self):
+        """Количество выполняемых сейчас вызовов"""
+        with self._lock:
+            return len(self._calls)
+
+
+class DecodedImageCache:
+    """LRU-кэш декодированных оригиналов, чтобы не декодировать файл заново"""
+
+    def __init__(self, max_items=8):
+        self.max_items = max_items
+        self._items = OrderedDict()
+        self._lock = threading.Lock()
+
+    def put(self, key, img):
+        with self._lock:
+            self._items[key] = img
+            self._items.move_to_end(key)
+            while len(self._items) > self.max_items:
+                self._items.popitem(last=False)
+
+    def get(self, key, path=None):
+        """Возвращает изображение из кэша, а при промахе декодирует path"""
+        with self._lock:
+            img = self._items.get(key)
+            if img is not None:
+                self._items.move_to_end(key)
+                return img
+
+        if path is None:
+            return None
+        img = cv2.imread(path)
+        if img is None:
+            raise ValueError(f"Не удалось загрузить изображение: {path}")
+        self.put(key, img)
+        return img
+
+    def discard(self, key):
+        with self._lock:
+            self._items.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._items.clear()
@@ -0,0 +1,134 @@
+"""
+Замеры времени и памяти по стадиям обработки.
+
+Включается переменной окружения ENHANCE_PROFILE=1 или вызовом enable().
+Стадии размечаются блоками `with stage('имя'):` и собираются в Profile,
+активный в текущем потоке (`with collect() as profile:`). Для каждой
+стадии считаются вызовы, суммарное время, пик памяти Python/numpy
+(tracemalloc) и RSS процесса после стадии. tracemalloc общий для процесса,
+поэтому при параллельной обработке в потоках пики памяти приблизительные.
+"""
+import os
+import threading
+import time
+import tracemalloc
+from contextlib import contextmanager
+
+_enabled = os.environ.get('ENHANCE_PROFILE', '').lower() in ('1', 'true', 'yes')
+_local = threading.local()
+
+
+def enable(enabled=True):
+    """Включает замеры; процессы пула наследуют настройку через окружение"""
+    global _enabled
+    _enabled = enabled
+    os.environ['ENHANCE_PROFILE'] = '1' if enabled else '0'
+
+
+def is_enabled():
+    return _enabled
+
+
+def current_rss():
+    """Текущий RSS процесса в байтах"""
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError, IndexError):
+        import resource
+        # ru_maxrss - пик за время жизни процесса, в КБ
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+class Profile:
+    """Сводка по стадиям: вызовы, время, пик памяти"""
+
+    def __init__(self):
+        self.stages = {}
+        self._lock = threading.Lock()
+
+    def add(self, name, seconds, peak_bytes, rss_bytes, calls=1):
+        with self._lock:
+            stats = self.stages.setdefault(name, {
+                'calls': 0, 'seconds': 0.0, 'peak_mb': 0.0, 'rss_mb': 0.0})
+            stats['calls'] += calls
+            stats['seconds'] += seconds
+            stats['peak_mb'] = max(stats['peak_mb'], peak_bytes / (1024 * 1024))
+            stats['rss_mb'] = max(stats['rss_mb'], rss_bytes / (1024 * 1024))
+
+    def merge(self, stages):
+        """Добавляет сводку из to_dict(), например полученную из процесса пула"""
+        for name, stats in (stages or {}).items():
+            self.add(name, stats['seconds'], stats['peak_mb'] * 1024 * 1024,
+                     stats['rss_mb'] * 1024 * 1024, stats['calls'])
+
+    def to_dict(self):
+        with self._lock:
+            return {
+                name: {
+                    'calls': stats['calls'],
+                    'seconds': round(stats['seconds'], 4),
+                    'peak_mb': round(stats['peak_mb'], 2),
+                    'rss_mb': round(stats['rss_mb'], 2),
+                }
+                for name, stats in self.stages.items()
+            }
+
+
+def current():
+    """Profile, активный в текущем потоке, или None"""
+    return getattr(_local, 'profile', None) if _enabled else None
+
+
+@contextmanager
+def attach(profile):
+    """Делает profile активным в текущем потоке (например, в потоке пула)"""
+    previous = getattr(_local, 'profile', None)
+    _local.profile = profile
+    try:
+        yield profile
+    finally:
+        _local.profile = previous
+
+
+@contextmanager
+def collect():
+    """Собирает стадии, выполненные в текущем потоке внутри блока"""
+    if _enabled and not tracemalloc.is_tracing():
+        tracemalloc.start()
+    with attach(Profile()) as profile:
+        yield profile
+
+
+@contextmanager
+def stage(name):
+    """Замер одной стадии; без активного Profile ничего не делает"""
+    profile = current()
+    if profile is None:
+        yield
+        return
+
+    # Пик tracemalloc сбрасывается на каждую стадию, поэтому пик внешней
+    # стадии сохраняется до начала вложенной и восстанавливается после
+    stack = getattr(_local, 'stack', None)
+    if stack is None:
+        stack = _local.stack = []
+    tracing = tracemalloc.is_tracing()
+    if tracing:
+        if stack:
+            stack[-1] = max(stack[-1], tracemalloc.get_traced_memory()[1])
+        tracemalloc.reset_peak()
+        start_memory = tracemalloc.get_traced_memory()[0]
+    stack.append(0)
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        seconds = time.perf_counter() - start
+        peak = stack.pop()
+        if tracing:
+            peak = max(peak, tracemalloc.get_traced_memory()[1])
+            if stack:
+                stack[-1] = max(stack[-1], peak)
+            peak -= start_memory
+        profile.add(name, seconds, max(peak, 0), current_rss())
@@ -0,0 +1,170 @@
+import hashlib
+import json
+import logging
+import os
+import shutil
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from pathlib import Path
+
+logger = logging.getLogger(__name__)
+
+# Меняется при изменении алгоритмов обработки, чтобы старые результаты не использовались
+CACHE_VERSION = 1
+
+# Как часто индекс сверяется с диском, чтобы учесть записи других процессов
+RESCAN_SECONDS = 60
+
+
+def hash_file(path, chunk_size=1024 * 1024):
+    """SHA-256 содержимого файла"""
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def hash_config(config):
+    """Хэш конфигурации, не зависящий от порядка ключей"""
+    data = json.dumps(config or {}, sort_keys=True, ensure_ascii=False)
+    return hashlib.sha256(data.encode('utf-8')).hexdigest()
+
+
+class ResultCache:
+    """
+    Дисковый кэш результатов обработки с адресацией по содержимому.
+    Ключ - хэш входного файла, метод, конфигурация и формат результата
+    (расширение), файл записи хранится с тем же расширением. Общий объем
+    ограничен max_bytes, при превышении удаляются давно не использованные записи.
+    Каталог может использоваться несколькими процессами сразу: порядок LRU
+    хранится во времени изменения файлов, и индекс перечитывается с диска
+    перед очисткой и раз в RESCAN_SECONDS.
+    """
+
+    def __init__(self, cache_dir, max_bytes=1024 * 1024 * 1024):
+        self.cache_dir = Path(cache_dir)
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+
+        self.cache_dir.mkdir(parents=True, exist_ok=True)
+        self._entries, self._total_bytes = self._scan()
+        self._scanned_at = time.monotonic()
+
+    def _scan(self):
+        """Восстанавливает порядок LRU по времени изменения файлов"""
+        entries = []
+        for path in self.cache_dir.glob('*/*'):
+            # Пропускаем недописанные временные файлы
+            if path.name.startswith('.'):
+                continue
+            try:
+                stat = path.stat()
+            except OSError:
+                continue
+            entries.append((stat.st_mtime, path.name, stat.st_size))
+        index = OrderedDict()
+        total_bytes = 0
+        for _, name, size in sorted(entries):
+            index[name] = size
+            total_bytes += size
+        return index, total_bytes
+
+    def make_key(self, input_hash, method, config=None, suffix='.jpg'):
+        """Ключ записи; suffix - расширение результата, от него зависит кодек"""
+        data = f"{CACHE_VERSION}:{input_hash}:{method}:{hash_config(config)}:{suffix.lower()}"
+        return hashlib.sha256(data.encode('utf-8')).hexdigest()
+
+    @staticmethod
+    def _name(key, path):
+        """Имя файла записи: ключ с расширением результата"""
+        return key + Path(path).suffix.lower()
+
+    def _path(self, name):
+        return self.cache_dir / name[:2] / name
+
+    def get(self, key, output_path):
+        """Копирует результат из кэша в output_path. Возвращает True при попадании"""
+        name = self._name(key, output_path)
+        path = self._path(name)
+        try:
+            # Только копия: жесткая ссылка позволила бы испортить кэш записью в output_path
+            shutil.copyfile(path, output_path)
+            os.utime(path)
+        except FileNotFoundError:
+            with self._lock:
+                self.misses += 1
+                size = self._entries.pop(name, None)
+                if size is not None:
+                    self._total_bytes -= size
+            return False
+
+        with self._lock:
+            self.hits += 1
+            if name in self._entries:
+                self._entries.move_to_end(name)
+        return True
+
+    def put(self, key, source_path):
+        """Сохраняет готовый результат в кэш"""
+        name = self._name(key, source_path)
+        path = self._path(name)
+        try:
+            path.parent.mkdir(exist_ok=True)
+            # Пишем во временный файл и переименовываем, чтобы не отдать недописанный
+            tmp_path = path.with_name(f".{key}.{uuid.uuid4().hex}.tmp")
+            shutil.copyfile(source_path, tmp_path)
+            os.replace(tmp_path, path)
+            size = path.stat().st_size
+        except OSError as e:
+            logger.error(f"Не удалось сохранить результат в кэш: {str(e)}")
+            return
+
+        with self._lock:
+            self._total_bytes += size - self._entries.pop(name, 0)
+            self._entries[name] = size
+            stale = time.monotonic() - self._scanned_at > RESCAN_SECONDS
+            if self._total_bytes <= self.max_bytes and not stale:
+                return
+
+        # Записи могли добавить или удалить другие процессы: перед очисткой
+        # индекс сверяется с диском, обход каталога идет без блокировки
+        entries, total_bytes = self._scan()
+        with self._lock:
+            self._entries, self._total_bytes = entries, total_bytes
+            self._scanned_at = time.monotonic()
+            self._evict()
+
+    def _evict(self):
+        """Удаляет давно не использованные записи, пока кэш не уложится в лимит"""
+        while self._total_bytes > self.max_bytes and len(self._entries) > 1:
+            name, size = self._entries.popitem(last=False)
+            self._total_bytes -= size
+            try:
+                self._path(name).unlink()
+            except FileNotFoundError:
+                pass
+            logger.debug(f"Удалена запись кэша {name}")
+
+    def add_lookups(self, hits, misses):
+        """Учитывает обращения к кэшу, выполненные в другом процессе"""
+        with self._lock:
+            self.hits += hits
+            self.misses += misses
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': round(self.hits / lookups, 4) if lookups else 0.0,
+                'entries': len(self._entries),
+                'bytes': self._total_bytes,
+                'max_bytes': self.max_bytes,
+            }
+
@@ -0,0 +1,261 @@
+import logging
+import multiprocessing
+import os
+import threading
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+
+try:
+    import fcntl
+except ImportError:  # Windows: блокировки файла нет, остается проверка процесса пула
+    fcntl = None
+
+logger = logging.getLogger(__name__)
+
+
+class FileEvicted(LookupError):
+    """Записи нет в хранилище: ее файлы уже удалены по сроку или лимиту объема"""
+
+
+class StorageManager:
+    """
+    Учет файлов сервиса (оригинал и варианты) по file_id с владельцем-сессией.
+    Записи хранятся в порядке последнего обращения. Фоновый поток удаляет
+    записи, к которым не обращались дольше ttl_seconds, а затем самые давние,
+    пока общий объем больше max_bytes. Записи в работе (using) не удаляются.
+    on_evict(file_id) вызывается после удаления файлов записи.
+
+    Закрепления (acquire, using) видны только в своем процессе, поэтому
+    удалять по сроку и лимиту может только один процесс - владелец: тот,
+    кто в start() захватил файл блокировки в первой папке. В процессах
+    multiprocessing и при занятой блокировке фоновая очистка не запускается,
+    а sweep ничего не удаляет.
+    """
+
+    def __init__(self, max_bytes, ttl_seconds, sweep_interval=60, on_evict=None):
+        self.max_bytes = max_bytes
+        self.ttl_seconds = ttl_seconds
+        self.sweep_interval = sweep_interval
+        self.on_evict = on_evict
+        self.evicted = 0
+        self._entries = OrderedDict()
+        self._total_bytes = 0
+        self._lock = threading.Lock()
+        self._wake = threading.Event()
+        self._thread = None
+        self._owner = False
+        self._lock_file = None
+
+    def start(self, folders=()):
+        """
+        Один раз учитывает файлы, оставшиеся в папках от прошлого запуска,
+        и запускает фоновую очистку. Повторные вызовы ничего не делают.
+        """
+        with self._lock:
+            if self._thread is not None:
+                return
+            self._thread = threading.Thread(target=self._run, name='storage-sweeper', daemon=True)
+        for folder in folders:
+            self._scan(folder)
+        self._owner = self._acquire_ownership(folders)
+        if self._owner:
+            self._thread.start()
+        logger.info(f"Хранилище: {len(self._entries)} файлов, {self._total_bytes} байт")
+
+    def _acquire_ownership(self, folders):
+        """Захватывает право удалять файлы: не в процессе пула и только одним процессом"""
+        if multiprocessing.parent_process() is not None:
+            logger.warning("Хранилище: очистка не запускается в процессе multiprocessing")
+            return False
+        if fcntl is None or not folders:
+            return True
+        lock_file = open(os.path.join(folders[0], '.storage.lock'), 'a+')
+        try:
+            fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            lock_file.close()
+            logger.warning("Хранилище: очистку уже ведет другой процесс, здесь она не запускается")
+            return False
+        # Блокировка держится, пока файл открыт, то есть до конца процесса
+        self._lock_file = lock_file
+        return True
+
+    def _scan(self, folder):
+        """Имена файлов начинаются с file_id (uuid из 36 символов)"""
+        try:
+            entries = os.scandir(folder)
+        except OSError:
+            return
+        with entries:
+            for entry in entries:
+                if len(entry.name) <= 36 or entry.name[36] != '_':
+                    continue
+                try:
+                    if not entry.is_file(follow_symlinks=False):
+                        continue
+                    stat = entry.stat(follow_symlinks=False)
+                except OSError:
+                    continue
+                file_id = entry.name[:36]
+                with self._lock:
+                    record = self._entries.get(file_id)
+                    if record is None:
+                        record = self._new_record(file_id, None, stat.st_mtime)
+                    record['last_access'] = max(record['last_access'], stat.st_mtime)
+                    self._add_size(record, entry.path, stat.st_size)
+        with self._lock:
+            # Порядок LRU по времени изменения файлов
+            for file_id, _ in sorted(self._entries.items(), key=lambda item: item[1]['last_access']):
+                self._entries.move_to_end(file_id)
+
+    def _new_record(self, file_id, owner, now):
+        record = {'owner': owner, 'paths': {}, 'bytes': 0,
+                  'last_access': now, 'in_use': 0}
+        self._entries[file_id] = record
+        return record
+
+    def _add_size(self, record, path, size):
+        old_size = record['paths'].get(path, 0)
+        record['paths'][path] = size
+        record['bytes'] += size - old_size
+        self._total_bytes += size - old_size
+
+    def register(self, file_id, owner=None):
+        with self._lock:
+            if file_id not in self._entries:
+                self._new_record(file_id, owner, time.time())
+
+    def add_path(self, file_id, path):
+        """Учитывает файл записи; при превышении лимита будит фоновую очистку"""
+        try:
+            size = os.path.getsize(path)
+        except OSError:
+            return
+        with self._lock:
+            record = self._entries.get(file_id)
+            if record is None:
+                record = self._new_record(file_id, None, time.time())
+            self._add_size(record, str(path), size)
+            over_budget = self._total_bytes > self.max_bytes
+        if over_budget:
+            self._wake.set()
+
+    def touch(self, file_id):
+        """Отмечает обращение к файлу"""
+        with self._lock:
+            record = self._entries.get(file_id)
+            if record is not None:
+                record['last_access'] = time.time()
+                self._entries.move_to_end(file_id)
+
+    def owner(self, file_id):
+        with self._lock:
+            record = self._entries.get(file_id)
+            return record['owner'] if record is not None else None
+
+    def __contains__(self, file_id):
+        with self._lock:
+            return file_id in self._entries
+
+    def acquire(self, file_id):
+        """
+        Закрепляет запись: пока не вызван release, она не удаляется.
+        Если записи уже нет, бросает FileEvicted
+        """
+        with self._lock:
+            record = self._entries.get(file_id)
+            if record is None:
+                raise FileEvicted(file_id)
+            record['in_use'] += 1
+
+    def release(self, file_id):
+        """Снимает закрепление acquire и отмечает обращение к записи"""
+        with self._lock:
+            record = self._entries.get(file_id)
+            if record is None:
+                return
+            record['in_use'] -= 1
+            record['last_access'] = time.time()
+            self._entries.move_to_end(file_id)
+
+    @contextmanager
+    def using(self, file_id):
+        """Пока блок выполняется, запись не удаляется. Если записи нет - FileEvicted"""
+        self.acquire(file_id)
+        try:
+            yield
+        finally:
+            self.release(file_id)
+
+    def remove(self, file_id):
+        """Удаляет файлы записи. Возвращает False, если запись в работе или ее нет"""
+        with self._lock:
+            record = self._entries.get(file_id)
+            if record is None or record['in_use']:
+                return False
+            del self._entries[file_id]
+            self._total_bytes -= record['bytes']
+        for path in record['paths']:
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            except OSError as e:
+                logger.error(f"Ошибка при удалении файла {path}: {str(e)}")
+        if self.on_evict is not None:
+            try:
+                self.on_evict(file_id)
+            except Exception as e:
+                logger.error(f"Ошибка при удалении записи {file_id}: {str(e)}")
+        return True
+
+    def remove_owner(self, owner):
+        """Удаляет все файлы владельца, возвращает число удаленных записей"""
+        with self._lock:
+            file_ids = [file_id for file_id, record in self._entries.items()
+                        if record['owner'] == owner]
+        return sum(1 for file_id in file_ids if self.remove(file_id))
+
+    def sweep(self, now=None):
+        """Удаляет устаревшие записи, затем давние, пока объем больше лимита"""
+        if not self._owner:
+            return 0
+        if now is None:
+            now = time.time()
+        removed = 0
+        with self._lock:
+            expired = [file_id for file_id, record in self._entries.items()
+                       if not record['in_use'] and now - record['last_access'] > self.ttl_seconds]
+        for file_id in expired:
+            removed += self.remove(file_id)
+
+        while True:
+            with self._lock:
+                if self._total_bytes <= self.max_bytes:
+                    break
+                victim = next((file_id for file_id, record in self._entries.items()
+                               if not record['in_use']), None)
+            if victim is None or not self.remove(victim):
+                break
+            removed += 1
+
+        if removed:
+            with self._lock:
+                self.evicted += removed
+            logger.info(f"Хранилище: удалено записей {removed}, занято {self._total_bytes} байт")
+        return removed
+
+    def _run(self):
+        while True:
+            self._wake.wait(self.sweep_interval)
+            self._wake.clear()
+            try:
+                self.sweep()
+            except Exception as e:
+                logger.error(f"Ошибка фоновой очистки хранилища: {str(e)}")
+
+    def stats(self):
+        with self._lock:
+            return {'files': len(self._entries), 'bytes': self._total_bytes,
+                    'evicted': self.evicted, 'owner': self._owner}
@@ -0,0 +1,374 @@
+"""
+Обработка больших изображений по тайлам с ограниченным потреблением памяти.
+
+Каждый метод разбит на локальные шаги, которые выполняются по
+перекрывающимся тайлам (с запасом halo под окна фильтров), и глобальные
+шаги (перцентили, средняя яркость, CLAHE), для которых сначала собирается
+статистика или одноканальная плоскость. Полноразмерные промежуточные буферы
+при необходимости лежат в файлах на диске (np.memmap), а кодировщик JPEG
+читает результат из такого буфера построчно.
+"""
+import math
+import os
+import tempfile
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+import cv2
+import numpy as np
+from PIL import Image
+
+import profiling
+from profiling import stage
+from enhance_script import (
+    smooth_denoise_lab, smooth_clahe, smooth_finish,
+    natural_unsharp, natural_contrast, natural_sharpen,
+    soft_contrast_apply,
+    gentle_luma, gentle_clahe, gentle_finish,
+)
+
+# Запас вокруг тайла под окна фильтров
+NLM_HALO = 15 // 2 + 5 // 2       # searchWindowSize/2 + templateWindowSize/2
+GAUSSIAN_1_HALO = 3               # GaussianBlur sigma=1.0 для 8U - ядро 7x7
+GAUSSIAN_05_HALO = 2              # GaussianBlur sigma=0.5 для 8U - ядро 5x5
+FILTER2D_HALO = 1                 # ядро 3x3
+UNSHARP_HALO = 4                  # UnsharpMask radius=0.5 (три прохода box blur)
+SMOOTH_FILTER_HALO = 1            # ImageFilter.SMOOTH 3x3
+
+# Оценка рабочей памяти метода в байтах на пиксель обрабатываемого окна
+BYTES_PER_PIXEL = {
+    'smooth_quality': 48,
+    'natural_enhance': 32,
+    'soft_contrast': 40,
+    'professional_gentle': 24,
+}
+
+MIN_TILE_SIZE = 128
+MAX_TILE_SIZE = 4096
+
+
+def get_memory_limit_mb(config=None):
+    """Лимит памяти на обработку: config['memory_limit_mb'] или ENHANCE_MEMORY_LIMIT_MB"""
+    if config and config.get('memory_limit_mb') is not None:
+        return int(config['memory_limit_mb'])
+    return int(os.environ.get('ENHANCE_MEMORY_LIMIT_MB', 2048))
+
+
+def get_intra_workers(config=None):
+    """
+    Число потоков для обработки одного изображения полосами:
+    config['intra_workers'] или ENHANCE_INTRA_WORKERS, по умолчанию 1 (выключено)
+    """
+    if config and config.get('intra_workers'):
+        return max(1, int(config['intra_workers']))
+    return max(1, int(os.environ.get('ENHANCE_INTRA_WORKERS', 1)))
+
+
+def estimate_memory(shape, base_method):
+    """Оценка пиковой памяти при обработке изображения целиком, в байтах"""
+    pixels = shape[0] * shape[1]
+    return pixels * BYTES_PER_PIXEL.get(base_method, 48)
+
+
+def should_tile(shape, base_method, config=None):
+    """Нужна ли обработка по тайлам, чтобы уложиться в лимит памяти"""
+    limit_mb = get_memory_limit_mb(config)
+    if limit_mb <= 0:
+        return False
+    return estimate_memory(shape, base_method) > limit_mb * 1024 * 1024
+
+
+def choose_tile_size(base_method, memory_limit_mb, halo):
+    """Размер стороны тайла: окно с запасом должно занимать не больше половины лимита"""
+    budget = memory_limit_mb * 1024 * 1024 // 2
+    side = int(math.sqrt(budget / BYTES_PER_PIXEL.get(base_method, 48))) - 2 * halo
+    return max(MIN_TILE_SIZE, min(MAX_TILE_SIZE, side))
+
+
+def choose_band_height(shape, base_method, memory_limit_mb, halo, workers):
+    """
+    Высота полосы во всю ширину для параллельной обработки: по две полосы
+    на поток для балансировки, но не больше, чем позволяет лимит памяти
+    """
+    height, width = shape[:2]
+    band_height = math.ceil(height / (workers * 2))
+    if memory_limit_mb > 0:
+        # Все потоки обрабатывают свои полосы одновременно
+        budget = memory_limit_mb * 1024 * 1024 // 2 // workers
+        max_pixels = budget // BYTES_PER_PIXEL.get(base_method, 48)
+        band_height = min(band_height, max_pixels // (width + 2 * halo) - 2 * halo)
+    return max(MIN_TILE_SIZE // 2, band_height)
+
+
+def iter_tiles(height, width, tile_size):
+    """
+    Координаты тайлов без перекрытия: (y0, y1, x0, x1).
+    tile_size - сторона квадрата или пара (высота, ширина)
+    """
+    tile_height, tile_width = tile_size if isinstance(tile_size, tuple) else (tile_size, tile_size)
+    for y0 in range(0, height, tile_height):
+        for x0 in range(0, width, tile_width):
+            yield y0, min(y0 + tile_height, height), x0, min(x0 + tile_width, width)
+
+
+def run_tiles(height, width, tile_size, halo, fn, sink, executor=None, workers=1):
+    """
+    Выполняет fn по окнам тайлов с запасом halo и передает в sink только
+    центральную часть результата: sink((y0, y1, x0, x1), tile).
+    fn получает срез окна (slice по y, slice по x).
+    С executor тайлы обрабатываются параллельно: в работе не больше двух
+    тайлов на каждый из workers потоков, sink вызывается в исходном порядке тайлов.
+    """
+    # Замеры стадий из потоков пула идут в Profile вызывающего потока
+    profile = profiling.current()
+
+    def process(coords):
+        y0, y1, x0, x1 = coords
+        wy0, wy1 = max(0, y0 - halo), min(height, y1 + halo)
+        wx0, wx1 = max(0, x0 - halo), min(width, x1 + halo)
+        with profiling.attach(profile):
+            result = fn((slice(wy0, wy1), slice(wx0, wx1)))
+        return result[y0 - wy0:y1 - wy0, x0 - wx0:x1 - wx0]
+
+    if executor is None:
+        for coords in iter_tiles(height, width, tile_size):
+            sink(coords, process(coords))
+        return
+
+    window = workers * 2
+    pending = deque()
+    for coords in iter_tiles(height, width, tile_size):
+        pending.append((coords, executor.submit(process, coords)))
+        if len(pending) >= window:
+            done_coords, future = pending.popleft()
+            sink(done_coords, future.result())
+    while pending:
+        done_coords, future = pending.popleft()
+        sink(done_coords, future.result())
+
+
+class TileBuffers:
+    """
+    Полноразмерные промежуточные буферы. Если их суммарный объем не
+    помещается в четверть лимита, они создаются в файлах на диске
+    """
+
+    def __init__(self, memory_limit_mb, directory=None):
+        self.memory_limit = memory_limit_mb * 1024 * 1024
+        self.directory = directory
+        self._allocated = 0
+        self._files = []
+
+    def allocate(self, shape, dtype=np.uint8):
+        nbytes = int(np.prod(shape)) * np.dtype(dtype).itemsize
+        self._allocated += nbytes
+        if self.memory_limit <= 0 or self._allocated <= self.memory_limit // 4:
+            return np.empty(shape, dtype=dtype)
+        f = tempfile.TemporaryFile(dir=self.directory, prefix='enhance_tiles_')
+        self._files.append(f)
+        return np.memmap(f, dtype=dtype, mode='w+', shape=shape)
+
+    def close(self):
+        for f in self._files:
+            f.close()
+        self._files = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def sink_into(buffer):
+    """sink для run_tiles, записывающий тайлы в буфер"""
+    def sink(coords, tile):
+        y0, y1, x0, x1 = coords
+        buffer[y0:y1, x0:x1] = tile
+    return sink
+
+
+def percentile_from_histogram(hist, q):
+    """
+    Перцентиль по гистограмме 8-битных значений, в масштабе 0..1.
+    Совпадает с np.percentile (линейная интерполяция) по тем же данным
+    """
+    cumulative = np.cumsum(hist)
+    total = int(cumulative[-1])
+    rank = (total - 1) * q / 100.0
+    lower = int(math.floor(rank))
+    upper = min(lower + 1, total - 1)
+    value_lower = int(np.searchsorted(cumulative, lower, side='right'))
+    value_upper = int(np.searchsorted(cumulative, upper, side='right'))
+    value = value_lower + (value_upper - value_lower) * (rank - lower)
+    return np.float32(value / 255.0)
+
+
+def upscale_tiled(img, scale_factor, buffer, band_height=256):
+    """
+    LANCZOS-увеличение полосами: каждая полоса результата считается из
+    соответствующей области оригинала (resize с box), полный результат
+    в памяти не собирается
+    """
+    height, width = img.shape[:2]
+    out_height, out_width = buffer.shape[:2]
+    source = Image.fromarray(img)
+    for y0 in range(0, out_height, band_height):
+        y1 = min(y0 + band_height, out_height)
+        box = (0, y0 * height / out_height, width, y1 * height / out_height)
+        with stage('upscale'):
+            band = source.resize((out_width, y1 - y0), Image.LANCZOS, box=box)
+            buffer[y0:y1] = np.asarray(band)
+
+
+def render_smooth_quality(img, out, tile_size, buffers, executor=None, workers=1):
+    height, width = img.shape[:2]
+
+    # Проход 1: шумоподавление по тайлам, результат в LAB
+    lab = buffers.allocate(img.shape)
+    run_tiles(height, width, tile_size, NLM_HALO,
+              lambda win: smooth_denoise_lab(img[win]), sink_into(lab), executor, workers)
+
+    # Глобальный шаг: CLAHE по всей плоскости яркости
+    l_enhanced = smooth_clahe(cv2.extractChannel(lab, 0))
+
+    # Проход 2: смешивание, резкость и гамма
+    run_tiles(height, width, tile_size, GAUSSIAN_1_HALO,
+              lambda win: smooth_finish(lab[win], l_enhanced[win]), sink_into(out), executor, workers)
+
+
+def render_soft_contrast(img, out, tile_size, buffers, executor=None, workers=1):
+    height, width = img.shape[:2]
+
+    # Проход 1: гистограммы каналов для перцентилей
+    hists = np.zeros((3, 256), dtype=np.int64)
+    for y0, y1, x0, x1 in iter_tiles(height, width, tile_size):
+        tile = img[y0:y1, x0:x1]
+        with stage('soft_contrast.levels'):
+            for channel in range(3):
+                hists[channel] += np.bincount(tile[:, :, channel].ravel(), minlength=256)
+
+    levels = []
+    for channel in range(3):
+        p2 = percentile_from_histogram(hists[channel], 2)
+        p98 = percentile_from_histogram(hists[channel], 98)
+        levels.append((p2, p98) if p98 - p2 > 0.1 else None)
+
+    # Проход 2: растяжение и резкость
+    run_tiles(height, width, tile_size, FILTER2D_HALO,
+              lambda win: soft_contrast_apply(img[win], levels), sink_into(out), executor, workers)
+
+
+def render_professional_gentle(img, out, tile_size, buffers, executor=None, workers=1):
+    height, width = img.shape[:2]
+
+    # Проход 1: плоскость скорректированной яркости
+    y_plane = buffers.allocate((height, width))
+    run_tiles(height, width, tile_size, 0,
+              lambda win: gentle_luma(img[win])[0], sink_into(y_plane), executor, workers)
+
+    # Глобальный шаг: CLAHE по всей плоскости
+    y_final = gentle_clahe(y_plane)
+
+    # Проход 2: резкость и цвет, U и V пересчитываются по тайлу
+    def finish(win):
+        _, u, v = gentle_luma(img[win])
+        return gentle_finish(y_final[win], u, v)
+
+    run_tiles(height, width, tile_size, FILTER2D_HALO + GAUSSIAN_05_HALO,
+              finish, sink_into(out), executor, workers)
+
+
+def render_natural_enhance(img, out, tile_size, buffers, executor=None, workers=1):
+    height, width = img.shape[:2]
+
+    def unsharp(win):
+        rgb = cv2.cvtColor(img[win], cv2.COLOR_BGR2RGB)
+        return natural_unsharp(Image.fromarray(rgb))
+
+    # Проход 1: средняя яркость после Unsharp Mask для ImageEnhance.Contrast
+    luma_hist = np.zeros(256, dtype=np.int64)
+
+    def collect(coords, tile):
+        luma_hist[:] += np.bincount(tile.ravel(), minlength=256)
+
+    run_tiles(height, width, tile_size, UNSHARP_HALO,
+              lambda win: np.asarray(unsharp(win).convert('L')), collect, executor, workers)
+    mean = int((luma_hist * np.arange(256)).sum() / luma_hist.sum() + 0.5)
+
+    # Проход 2: контраст с общей средней и резкость
+    def enhance(win):
+        pil_img = natural_sharpen(natural_contrast(unsharp(win), mean))
+        return cv2.cvtColor(np.asarray(pil_img), cv2.COLOR_RGB2BGR)
+
+    run_tiles(height, width, tile_size, UNSHARP_HALO + SMOOTH_FILTER_HALO,
+              enhance, sink_into(out), executor, workers)
+
+
+TILED_METHODS = {
+    'smooth_quality': (render_smooth_quality, NLM_HALO),
+    'natural_enhance': (render_natural_enhance, UNSHARP_HALO + SMOOTH_FILTER_HALO),
+    'soft_contrast': (render_soft_contrast, FILTER2D_HALO),
+    'professional_gentle': (render_professional_gentle, FILTER2D_HALO + GAUSSIAN_05_HALO),
+}
+
+# Параметры кодировщика: natural_enhance сохраняется через PIL с 4:4:4 и optimize
+JPEG_PARAMS = {
+    'natural_enhance': [cv2.IMWRITE_JPEG_QUALITY, 95,
+                        cv2.IMWRITE_JPEG_OPTIMIZE, 1,
+                        cv2.IMWRITE_JPEG_SAMPLING_FACTOR, cv2.IMWRITE_JPEG_SAMPLING_FACTOR_444],
+}
+DEFAULT_JPEG_PARAMS = [cv2.IMWRITE_JPEG_QUALITY, 95]
+
+
+def enhance_array_tiled(img, output_path, base_method, config=None, scale_factor=1.0,
+                        tile_size=None, workers=1):
+    """
+    Выполняет базовый метод по тайлам и сохраняет результат.
+    При scale_factor > 1 изображение сначала увеличивается полосами в буфер.
+    При workers > 1 изображение режется на полосы во всю ширину, которые
+    обрабатывает пул потоков (OpenCV, PIL и numpy отпускают GIL).
+    """
+    executor = None
+    try:
+        memory_limit_mb = get_memory_limit_mb(config)
+        render, halo = TILED_METHODS.get(base_method, TILED_METHODS['smooth_quality'])
+
+        directory = os.path.dirname(os.path.abspath(output_path))
+        with TileBuffers(memory_limit_mb, directory) as buffers:
+            if scale_factor > 1.0:
+                height, width = img.shape[:2]
+                scaled = buffers.allocate((int(height * scale_factor),
+                                           int(width * scale_factor), img.shape[2]))
+                upscale_tiled(img, scale_factor, scaled)
+                img = scaled
+
+            if tile_size is None and workers > 1:
+                tile_size = (choose_band_height(img.shape, base_method, memory_limit_mb,
+                                                halo, workers), img.shape[1])
+            elif tile_size is None:
+                tile_size = choose_tile_size(base_method, memory_limit_mb, halo)
+            if workers > 1:
+                executor = ThreadPoolExecutor(max_workers=workers,
+                                              thread_name_prefix='enhance-tile')
+
+            out = buffers.allocate(img.shape)
+            print(f"🧩 Обработка по тайлам {tile_size}: {img.shape[1]}x{img.shape[0]}, "
+                  f"потоков: {workers}")
+            render(img, out, tile_size, buffers, executor, workers)
+
+            # Кодировщик читает результат из буфера построчно
+            params = JPEG_PARAMS.get(base_method, DEFAULT_JPEG_PARAMS)
+            with stage('encode'):
+                saved = cv2.imwrite(output_path, out, params)
+            if not saved:
+                raise IOError(f"Не удалось сохранить {output_path}")
+            del out, img
+        return True
+
+    except Exception as e:
+        print(f"❌ Ошибка в обработке по тайлам ({base_method}): {str(e)}")
+        return False
+    finally:
+        if executor is not None:
+            executor.shutdown()
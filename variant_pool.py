@@ -0,0 +1,111 @@
+"""
+Общий пул процессов для вариантов, страниц и пакетов.
+
+Состояние пула и подписчики на завершение методов живут в отдельном модуле,
+а не в enhance_script: при запуске enhance_script.py как __main__ импорт
+enhance_script из других модулей загружает вторую копию модуля, и у нее
+был бы свой пул рядом с пулом CLI.
+"""
+import multiprocessing
+import os
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import shared_memory
+
+import cv2
+import numpy as np
+
+import profiling
+
+_variant_pool = None
+_variant_pool_workers = 0
+_variant_pool_lock = threading.Lock()
+_method_listeners = []
+
+
+def get_worker_count(config=None):
+    """Число процессов для вариантов: config['workers'], ENHANCE_WORKERS или число ядер"""
+    if config and config.get('workers'):
+        return max(1, int(config['workers']))
+    env_workers = os.environ.get('ENHANCE_WORKERS')
+    if env_workers:
+        return max(1, int(env_workers))
+    return os.cpu_count() or 1
+
+
+def _init_variant_worker():
+    """Инициализация процесса пула: параллелим по вариантам, а не внутри OpenCV"""
+    cv2.setNumThreads(1)
+    # И не делим изображение на полосы, если это не задано в конфигурации явно
+    os.environ['ENHANCE_INTRA_WORKERS'] = '1'
+
+
+def get_variant_pool(workers):
+    """Возвращает общий пул процессов, пересоздавая его при смене размера"""
+    global _variant_pool, _variant_pool_workers
+    with _variant_pool_lock:
+        if _variant_pool is None or _variant_pool_workers != workers:
+            if _variant_pool is not None:
+                _variant_pool.shutdown(wait=False)
+            # spawn, а не fork: веб-сервер многопоточный
+            _variant_pool = ProcessPoolExecutor(
+                max_workers=workers,
+                mp_context=multiprocessing.get_context('spawn'),
+                initializer=_init_variant_worker)
+            _variant_pool_workers = workers
+        return _variant_pool
+
+
+def _reset_variant_pool():
+    """Сбрасывает пул после падения процесса, следующий вызов создаст новый"""
+    global _variant_pool
+    with _variant_pool_lock:
+        if _variant_pool is not None:
+            _variant_pool.shutdown(wait=False)
+        _variant_pool = None
+
+
+def _to_shared_memory(img):
+    """Копирует изображение в разделяемую память, чтобы не пиклить его в процессы"""
+    shm = shared_memory.SharedMemory(create=True, size=max(img.nbytes, 1))
+    shared = np.ndarray(img.shape, dtype=img.dtype, buffer=shm.buf)
+    shared[:] = img
+    del shared
+    return shm
+
+
+def _run_shared(shm_name, shape, dtype, fn, *args):
+    """
+    Выполняется в процессе пула: вызывает fn(img, *args) над изображением из
+    разделяемой памяти. Возвращает результат, замеры стадий (None, если
+    замеры выключены) и время
+    """
+    shm = shared_memory.SharedMemory(name=shm_name)
+    try:
+        img = np.ndarray(shape, dtype=dtype, buffer=shm.buf)
+        start = time.perf_counter()
+        with profiling.collect() as profile:
+            result = fn(img, *args)
+        seconds = time.perf_counter() - start
+        # Ссылка на буфер должна исчезнуть до закрытия сегмента
+        del img
+        return result, profile.to_dict() if profiling.is_enabled() else None, seconds
+    finally:
+        shm.close()
+
+
+def add_method_listener(fn):
+    """
+    Подписывает fn(method, success, seconds) на завершение каждого варианта.
+    Вызывается в вызывающем процессе, в том числе для вариантов из пула
+    """
+    _method_listeners.append(fn)
+
+
+def _notify_method(method, success, seconds):
+    for fn in _method_listeners:
+        try:
+            fn(method, success, seconds)
+        except Exception as e:
+            print(f"⚠️ Ошибка в обработчике завершения метода: {str(e)}")
@@ -1,30 +1,58 @@
-from flask import Flask, request, redirect, url_for, flash, send_file, render_template_string, jsonify, get_flashed_messages
+from flask import Flask, Request, request, redirect, url_for, flash, send_file, render_template_string, jsonify, get_flashed_messages, Response, g, session
 import os
 import uuid
+import threading
+import time
 from pathlib import Path
-from enhance_script import enhance_document_quality
+from enhance_script import (enhance_document_variants, enhance_batch_variants,
+                            enhance_image, get_result_cache,
+                            load_config, add_method_listener, ALL_METHODS,
+                            load_preview_proxy, enhance_preview)
+from result_cache import hash_file
+from jobs import JobManager, JobQueueFull
+from on_demand import SingleFlight, DecodedImageCache
+from file_registry import FileRegistry
+from werkzeug.datastructures import FileStorage
+from storage import StorageManager, FileEvicted
+import profiling
+import metrics
 import cv2
 from PIL import Image
 import io
 import logging
 from datetime import datetime
+from functools import lru_cache
 import base64
 import shutil
+import json
+import zipfile
+from urllib.parse import quote
 
 # Настройка логирования
 logging.basicConfig(level=logging.DEBUG)
 logger = logging.getLogger(__name__)
 
+class UploadRequest(Request):
+    """Пакетной загрузке (/batch) разрешен запрос больше, чем остальным маршрутам"""
+    
+    @property
+    def max_content_length(self):
+        if self.endpoint == 'submit_batch':
+            return app.config['MAX_BATCH_CONTENT_LENGTH']
+        return super().max_content_length
+
 app = Flask(__name__)
+app.request_class = UploadRequest
 app.secret_key = 'dev-key-change-in-production'
-app.config['MAX_CONTENT_LENGTH'] = 16 * 1024 * 1024  # 16MB max file
+app.config['MAX_CONTENT_LENGTH'] = int(os.environ.get('MAX_UPLOAD_MB', 16)) * 1024 * 1024  # MAX_UPLOAD_MB, по умолчанию 16MB
+app.config['MAX_BATCH_CONTENT_LENGTH'] = int(os.environ.get('MAX_BATCH_UPLOAD_MB', 256)) * 1024 * 1024  # только /batch
 
-# Директории
-UPLOAD_FOLDER = '/app/uploads'
-PROCESSED_FOLDER = '/app/processed'
+# Директории (переопределяются окружением, например для нагрузочного теста)
+UPLOAD_FOLDER = os.environ.get('UPLOAD_FOLDER', '/app/uploads')
+PROCESSED_FOLDER = os.environ.get('PROCESSED_FOLDER', '/app/processed')
 
 for folder in [UPLOAD_FOLDER, PROCESSED_FOLDER]:
-    Path(folder).mkdir(exist_ok=True)
+    Path(folder).mkdir(parents=True, exist_ok=True)
 
 ALLOWED_EXTENSIONS = {'png', 'jpg', 'jpeg', 'bmp', 'tiff', 'tif'}
 
@@ -41,60 +69,55 @@ def get_image_dimensions(image_path):
         logger.error(f"Error getting image dimensions: {str(e)}")
         return (0, 0)
 
+@lru_cache(maxsize=int(os.environ.get('FILE_INFO_CACHE_SIZE', 256)))
+def _read_file_info(file_path, size_bytes, mtime_ns):
+    """Разрешение файла; размер и время изменения входят в ключ кэша"""
+    width, height = get_image_dimensions(file_path)
+    return {
+        'size_bytes': size_bytes,
+        'width': width,
+        'height': height
+    }
+
 def get_file_info(file_path):
-    """Получить информацию о файле: размер и разрешение"""
+    """
+    Получить информацию о файле: размер и разрешение.
+    Результат кэшируется (LRU), файл заново открывается, только если изменился
+    """
     try:
-        # Размер файла
-        size_bytes = os.path.getsize(file_path)
-        
-        # Размеры изображения
-        width, height = get_image_dimensions(file_path)
-        
-        return {
-            'size_bytes': size_bytes,
-            'width': width,
-            'height': height
-        }
+        stat = os.stat(file_path)
+        return dict(_read_file_info(str(file_path), stat.st_size, stat.st_mtime_ns))
     except Exception as e:
         logger.error(f"Error getting file info: {str(e)}")
         return {'size_bytes': 0, 'width': 0, 'height': 0}
 
-def cleanup_folders():
-    """Очистка папок uploads и processed"""
-    try:
-        logger.info("Начинаем очистку папок...")
-        
-        # Очистка папки uploads
-        if os.path.exists(UPLOAD_FOLDER):
-            for file_path in Path(UPLOAD_FOLDER).glob("*"):
-                try:
-                    if file_path.is_file():
-                        file_path.unlink()
-                        logger.debug(f"Удален файл из uploads: {file_path.name}")
-                except Exception as e:
-                    logger.error(f"Ошибка при удалении файла {file_path}: {str(e)}")
-        
-        # Очистка папки processed
-        if os.path.exists(PROCESSED_FOLDER):
-            for file_path in Path(PROCESSED_FOLDER).glob("*"):
-                try:
-                    if file_path.is_file():
-                        file_path.unlink()
-                        logger.debug(f"Удален файл из processed: {file_path.name}")
-                except Exception as e:
-                    logger.error(f"Ошибка при удалении файла {file_path}: {str(e)}")
-        
-        # Очистка глобальных переменных
-        global processed_files_db, file_variants
-        processed_files_db.clear()
-        file_variants.clear()
-        
-        logger.info("Очистка папок завершена успешно")
-        return True
-        
-    except Exception as e:
-        logger.error(f"Ошибка при очистке папок: {str(e)}")
-        return False
+@lru_cache(maxsize=int(os.environ.get('FILE_INFO_CACHE_SIZE', 256)))
+def _content_etag(file_path, size_bytes, mtime_ns):
+    return hash_file(file_path)
+
+def get_file_etag(file_path):
+    """Сильный ETag - хэш содержимого; файл читается заново, только если изменился"""
+    stat = os.stat(file_path)
+    return _content_etag(str(file_path), stat.st_size, stat.st_mtime_ns)
+
+# Срок кэширования в браузере для URL, содержимое которых не меняется
+IMMUTABLE_MAX_AGE = 365 * 24 * 3600
+
+def send_image(file_path, immutable=True, **kwargs):
+    """
+    send_file с валидаторами: ETag по содержимому и Last-Modified, ответ 304
+    на условный запрос и поддержка Range. Неизменяемые URL (варианты,
+    оригинал) браузер кэширует надолго, остальные (основной вариант, который
+    можно сменить, и превью сетки) перепроверяет при каждом показе
+    """
+    response = send_file(file_path, etag=get_file_etag(file_path), conditional=True,
+                         max_age=IMMUTABLE_MAX_AGE if immutable else 0, **kwargs)
+    if immutable:
+        # Файлы пользователя не должны оседать в общих кэшах
+        response.cache_control.public = False
+        response.cache_control.private = True
+        response.cache_control.immutable = True
+    return response
 
 # HTML шаблон главной страницы
 MAIN_PAGE = '''
@@ -319,9 +342,10 @@ MAIN_PAGE = '''
             <div class="spinner-border text-primary mb-3" style="width: 3rem; height: 3rem;"></div>
             <h5>Обработка изображения...</h5>
             <p class="text-muted">Создаем все варианты улучшения</p>
+            <p class="small mb-0" id="processingProgress"></p>
             <div class="cleanup-info mt-3">
                 <i class="fas fa-info-circle text-warning"></i>
-                <small>Выполняется очистка предыдущих файлов и создание новых вариантов</small>
+                <small>Загруженные файлы хранятся ограниченное время и удаляются автоматически</small>
             </div>
         </div>
     </div>
@@ -387,6 +411,9 @@ MAIN_PAGE = '''
                         <button class="btn btn-success" id="confirmSelection" onclick="confirmSelection()" style="display: none;">
                             <i class="fas fa-check"></i> Подтвердить выбор
                         </button>
+                        <a class="btn btn-outline-success" id="downloadAll" href="#">
+                            <i class="fas fa-file-archive"></i> Скачать все (ZIP)
+                        </a>
                     </div>
                 </div>
 
@@ -541,23 +568,41 @@ MAIN_PAGE = '''
             `;
         }
 
-        function showVariantsSelection(fileId, variants) {
-            currentFileId = fileId;
-            processedVariants = variants;
-            
-            const selectionSection = document.getElementById('selectionSection');
-            const variantsGrid = document.getElementById('variantsGrid');
-            
-            selectionSection.style.display = 'block';
-            selectionSection.scrollIntoView({ behavior: 'smooth' });
-            
-            let variantsHtml = '';
-            
-            // Добавляем оригинал для сравнения
-            variantsHtml += `
+        const METHOD_NAMES = {
+            'smooth_quality': 'Плавное качество',
+            'natural_enhance': 'Естественное улучшение', 
+            'soft_contrast': 'Мягкий контраст',
+            'professional_gentle': 'Профессиональная',
+            'smooth_quality_2x': 'Плавное качество + 2x',
+            'smooth_quality_3x': 'Плавное качество + 3x',
+            'natural_enhance_2x': 'Естественное + 2x',
+            'natural_enhance_3x': 'Естественное + 3x',
+            'soft_contrast_2x': 'Мягкий контраст + 2x',
+            'soft_contrast_3x': 'Мягкий контраст + 3x',
+            'professional_gentle_2x': 'Профессиональная + 2x',
+            'professional_gentle_3x': 'Профессиональная + 3x'
+        };
+
+        const METHOD_DESCRIPTIONS = {
+            'smooth_quality': 'Лучше для документов',
+            'natural_enhance': 'Сохраняет натуральность',
+            'soft_contrast': 'Без резких переходов', 
+            'professional_gentle': 'Максимальное качество',
+            'smooth_quality_2x': 'Плавное качество + увеличение разрешения 2x',
+            'smooth_quality_3x': 'Плавное качество + увеличение разрешения 3x',
+            'natural_enhance_2x': 'Естественное улучшение + увеличение разрешения 2x',
+            'natural_enhance_3x': 'Естественное улучшение + увеличение разрешения 3x',
+            'soft_contrast_2x': 'Мягкий контраст + увеличение разрешения 2x',
+            'soft_contrast_3x': 'Мягкий контраст + увеличение разрешения 3x',
+            'professional_gentle_2x': 'Профессиональная обработка + увеличение разрешения 2x',
+            'professional_gentle_3x': 'Профессиональная обработка + увеличение разрешения 3x'
+        };
+
+        function renderOriginalCard(fileId) {
+            return `
                 <div class="variant-card" onclick="selectVariant('original')">
                     <input type="radio" class="variant-checkbox" name="selectedVariant" value="original">
-                    <img src="/preview-original/${fileId}" class="variant-image" alt="Оригинал">
+                    <img src="/preview-thumb/${fileId}/original" class="variant-image" alt="Оригинал">
                     <h6>Оригинал</h6>
                     <div class="method-description">Исходное изображение без изменений</div>
                     <div class="file-stats" id="originalStats">
@@ -570,94 +615,135 @@ MAIN_PAGE = '''
                     </div>
                 </div>
             `;
-            
-            // Добавляем все обработанные варианты
-            Object.entries(variants).forEach(([method, variant]) => {
-                const methodNames = {
-                    'smooth_quality': 'Плавное качество',
-                    'natural_enhance': 'Естественное улучшение', 
-                    'soft_contrast': 'Мягкий контраст',
-                    'professional_gentle': 'Профессиональная',
-                    'smooth_quality_2x': 'Плавное качество + 2x',
-                    'smooth_quality_3x': 'Плавное качество + 3x',
-                    'natural_enhance_2x': 'Естественное + 2x',
-                    'natural_enhance_3x': 'Естественное + 3x',
-                    'soft_contrast_2x': 'Мягкий контраст + 2x',
-                    'soft_contrast_3x': 'Мягкий контраст + 3x',
-                    'professional_gentle_2x': 'Профессиональная + 2x',
-                    'professional_gentle_3x': 'Профессиональная + 3x'
-                };
-
-                const descriptions = {
-                    'smooth_quality': 'Лучше для документов',
-                    'natural_enhance': 'Сохраняет натуральность',
-                    'soft_contrast': 'Без резких переходов', 
-                    'professional_gentle': 'Максимальное качество',
-                    'smooth_quality_2x': 'Плавное качество + увеличение разрешения 2x',
-                    'smooth_quality_3x': 'Плавное качество + увеличение разрешения 3x',
-                    'natural_enhance_2x': 'Естественное улучшение + увеличение разрешения 2x',
-                    'natural_enhance_3x': 'Естественное улучшение + увеличение разрешения 3x',
-                    'soft_contrast_2x': 'Мягкий контраст + увеличение разрешения 2x',
-                    'soft_contrast_3x': 'Мягкий контраст + увеличение разрешения 3x',
-                    'professional_gentle_2x': 'Профессиональная обработка + увеличение разрешения 2x',
-                    'professional_gentle_3x': 'Профессиональная обработка + увеличение разрешения 3x'
-                };
-                
-                variantsHtml += `
-                    <div class="variant-card" onclick="selectVariant('${method}')">
-                        <input type="radio" class="variant-checkbox" name="selectedVariant" value="${method}">
-                        <img src="/preview-variant/${fileId}/${method}" class="variant-image" alt="${methodNames[method]}">
-                        <h6>${methodNames[method]}</h6>
-                        <div class="method-description">${descriptions[method]}</div>
-                        <div class="file-stats" id="stats-${method}">
-                            <i class="fas fa-spinner fa-spin"></i> Загрузка информации...
-                        </div>
-                        <div class="variant-actions">
-                            <a href="/preview-variant/${fileId}/${method}" class="btn btn-outline-primary btn-sm" target="_blank">
-                                <i class="fas fa-eye"></i> Просмотр
-                            </a>
-                            <a href="/download-variant/${fileId}/${method}" class="btn btn-outline-success btn-sm">
-                                <i class="fas fa-download"></i> Скачать
-                            </a>
-                        </div>
+        }
+
+        function renderVariantCard(fileId, method) {
+            return `
+                <div class="variant-card" id="card-${method}" onclick="selectVariant('${method}')">
+                    <input type="radio" class="variant-checkbox" name="selectedVariant" value="${method}">
+                    <img src="/preview-thumb/${fileId}/${method}" class="variant-image" alt="${METHOD_NAMES[method]}"
+                         loading="lazy" onload="loadVariantStats('${fileId}', '${method}')">
+                    <h6>${METHOD_NAMES[method]}</h6>
+                    <div class="method-description">${METHOD_DESCRIPTIONS[method]}</div>
+                    <div class="file-stats" id="stats-${method}">
+                        <i class="fas fa-spinner fa-spin"></i> Загрузка информации...
+                    </div>
+                    <div class="variant-actions">
+                        <a href="/preview-variant/${fileId}/${method}" class="btn btn-outline-primary btn-sm" target="_blank">
+                            <i class="fas fa-eye"></i> Просмотр
+                        </a>
+                        <a href="/download-variant/${fileId}/${method}" class="btn btn-outline-success btn-sm">
+                            <i class="fas fa-download"></i> Скачать
+                        </a>
+                    </div>
+                </div>
+            `;
+        }
+
+        function renderPendingCard(method) {
+            return `
+                <div class="variant-card" id="card-${method}">
+                    <div class="variant-image d-flex align-items-center justify-content-center py-5">
+                        <i class="fas fa-spinner fa-spin fa-2x text-primary"></i>
                     </div>
-                `;
+                    <h6>${METHOD_NAMES[method]}</h6>
+                    <div class="method-description">${METHOD_DESCRIPTIONS[method]}</div>
+                    <div class="file-stats" id="stats-${method}">Обработка...</div>
+                </div>
+            `;
+        }
+
+        function renderStats(stats) {
+            return `
+                <span class="file-size-badge">${formatFileSize(stats.size_bytes)}</span>
+                <span class="resolution-badge">${formatResolution(stats.width, stats.height)}</span>
+            `;
+        }
+
+        function openVariantsSection(fileId) {
+            currentFileId = fileId;
+            const selectionSection = document.getElementById('selectionSection');
+            selectionSection.style.display = 'block';
+            selectionSection.scrollIntoView({ behavior: 'smooth' });
+            document.getElementById('confirmSelection').style.display = 'none';
+            document.getElementById('downloadAll').href = `/download-all/${fileId}`;
+        }
+
+        function showVariantsSelection(fileId, variants) {
+            processedVariants = variants;
+            openVariantsSection(fileId);
+            
+            // Добавляем оригинал для сравнения и все обработанные варианты
+            let variantsHtml = renderOriginalCard(fileId);
+            Object.keys(variants).forEach(method => {
+                variantsHtml += renderVariantCard(fileId, method);
+            });
+            
+            document.getElementById('variantsGrid').innerHTML = variantsHtml;
+            
+            // Информация о вариантах загружается, когда загрузится превью
+            loadOriginalStats(fileId);
+        }
+
+        function showPendingVariants(fileId) {
+            // Сетка заполняется по мере готовности вариантов
+            processedVariants = {};
+            openVariantsSection(fileId);
+            
+            let variantsHtml = renderOriginalCard(fileId);
+            Object.keys(METHOD_NAMES).forEach(method => {
+                variantsHtml += renderPendingCard(method);
             });
             
-            variantsGrid.innerHTML = variantsHtml;
+            document.getElementById('variantsGrid').innerHTML = variantsHtml;
+            loadOriginalStats(fileId);
+        }
+
+        function showVariantReady(fileId, event) {
+            const card = document.getElementById(`card-${event.method}`);
+            if (!card) return;
+            
+            if (!event.success) {
+                card.remove();
+                return;
+            }
             
-            // Загружаем информацию о размерах файлов
-            loadFileStats(fileId, variants);
+            processedVariants[event.method] = event.filename;
+            card.outerHTML = renderVariantCard(fileId, event.method);
+            setStats(`stats-${event.method}`, event.info);
         }
 
-        function loadFileStats(fileId, variants) {
-            // Загружаем информацию для оригинала
+        function setStats(elementId, stats) {
+            const element = document.getElementById(elementId);
+            if (!element) return;
+            element.innerHTML = renderStats(stats);
+            element.dataset.loaded = '1';
+        }
+
+        function loadOriginalStats(fileId) {
             fetch(`/file-info/original/${fileId}`)
                 .then(response => response.json())
                 .then(data => {
                     if (data.success) {
-                        const stats = data.info;
-                        document.getElementById('originalStats').innerHTML = `
-                            <span class="file-size-badge">${formatFileSize(stats.size_bytes)}</span>
-                            <span class="resolution-badge">${formatResolution(stats.width, stats.height)}</span>
-                        `;
+                        setStats('originalStats', data.info);
                     }
                 });
+        }
+
+        function loadVariantStats(fileId, method) {
+            const element = document.getElementById(`stats-${method}`);
+            if (!element || element.dataset.loaded) return;
             
-            // Загружаем информацию для каждого варианта
-            Object.keys(variants).forEach(method => {
-                fetch(`/file-info/variant/${fileId}/${method}`)
-                    .then(response => response.json())
-                    .then(data => {
-                        if (data.success) {
-                            const stats = data.info;
-                            document.getElementById(`stats-${method}`).innerHTML = `
-                                <span class="file-size-badge">${formatFileSize(stats.size_bytes)}</span>
-                                <span class="resolution-badge">${formatResolution(stats.width, stats.height)}</span>
-                            `;
-                        }
-                    });
-            });
+            fetch(`/file-info/variant/${fileId}/${method}`)
+                .then(response => response.json())
+                .then(data => {
+                    if (data.success) {
+                        setStats(`stats-${method}`, data.info);
+                    } else if (data.pending) {
+                        // Полное разрешение строится только при просмотре или скачивании
+                        element.innerHTML = '<small class="text-muted">Полный размер - при скачивании</small>';
+                    }
+                });
         }
 
         function selectVariant(method) {
@@ -722,10 +808,9 @@ MAIN_PAGE = '''
                 behavior: 'smooth' 
             });
             
-            fetch('/api/files')
-                .then(response => response.json())
-                .then(files => {
-                    const file = files.find(f => f.id === fileId);
+            fetch(`/api/files/${fileId}`)
+                .then(response => response.ok ? response.json() : null)
+                .then(file => {
                     if (file) {
                         displayComparison(file);
                     }
@@ -748,8 +833,8 @@ MAIN_PAGE = '''
                     </div>
                     <div class="mt-2 text-center">
                         <small class="text-muted">
-                            <strong>Метод:</strong> <span class="badge bg-primary method-badge">${file.method}</span><br>
-                            <strong>Обработано:</strong> ${file.processed_time}
+                            <strong>Метод:</strong> <span class="badge bg-primary method-badge">${file.method || 'в обработке'}</span><br>
+                            <strong>${file.processed_time ? 'Обработано' : 'Загружено'}:</strong> ${file.processed_time || file.uploaded_time}
                         </small>
                     </div>
                 </div>
@@ -757,7 +842,7 @@ MAIN_PAGE = '''
         }
 
         function loadFilesList() {
-            fetch('/api/files')
+            fetch('/api/files?order=desc&limit=10')
                 .then(response => response.json())
                 .then(files => {
                     const filesListDiv = document.getElementById('filesList');
@@ -768,7 +853,7 @@ MAIN_PAGE = '''
                     }
 
                     let filesHtml = '';
-                    files.slice(-10).reverse().forEach(file => {
+                    files.forEach(file => {
                         filesHtml += `
                             <div class="card file-card">
                                 <div class="card-body py-2">
@@ -779,8 +864,8 @@ MAIN_PAGE = '''
                                                 ${file.original_name}
                                             </h6>
                                             <p class="text-muted mb-0 small">
-                                                <span class="badge bg-primary method-badge">${file.method}</span>
-                                                <span class="ms-2">${file.processed_time}</span>
+                                                <span class="badge bg-primary method-badge">${file.method || 'в обработке'}</span>
+                                                <span class="ms-2">${file.processed_time || file.uploaded_time}</span>
                                             </p>
                                         </div>
                                         <div class="col-md-5 text-end">
@@ -827,34 +912,115 @@ MAIN_PAGE = '''
             submitBtn.innerHTML = '<i class="fas fa-spinner fa-spin"></i> Обработка...';
             processingOverlay.style.display = 'flex';
             
-            // Отправляем форму через fetch
+            // Ставим обработку в очередь и следим за прогрессом
             const formData = new FormData(document.getElementById('uploadForm'));
+            document.getElementById('processingProgress').textContent = 'В очереди...';
             
-            fetch('/process_all', {
+            fetch('/jobs', {
                 method: 'POST',
                 body: formData
             })
             .then(response => response.json())
             .then(data => {
-                processingOverlay.style.display = 'none';
-                submitBtn.disabled = false;
-                submitBtn.innerHTML = '<i class="fas fa-bolt"></i> Создать все варианты улучшения';
-                
-                if (data.success) {
+                if (data.success && data.lazy) {
+                    // Варианты строятся при первом просмотре
+                    finishProcessing();
                     showVariantsSelection(data.file_id, data.variants);
+                } else if (data.success) {
+                    if (window.EventSource) {
+                        streamJob(data.job_id, data.file_id);
+                    } else {
+                        pollJob(data.job_id);
+                    }
                 } else {
+                    finishProcessing();
                     showMessage(data.message || 'Ошибка при обработке', 'error');
                 }
             })
             .catch(error => {
                 console.error('Error:', error);
-                processingOverlay.style.display = 'none';
-                submitBtn.disabled = false;
-                submitBtn.innerHTML = '<i class="fas fa-bolt"></i> Создать все варианты улучшения';
+                finishProcessing();
                 showMessage('Ошибка при обработке файла', 'error');
             });
         });
 
+        function streamJob(jobId, fileId) {
+            // Варианты появляются в сетке по мере готовности
+            finishProcessing();
+            showPendingVariants(fileId);
+            
+            const source = new EventSource(`/jobs/${jobId}/events`);
+            source.addEventListener('variant', e => {
+                showVariantReady(fileId, JSON.parse(e.data));
+            });
+            source.addEventListener('done', () => {
+                source.close();
+                document.querySelectorAll('.variant-card').forEach(card => {
+                    if (!card.querySelector('.variant-checkbox')) card.remove();
+                });
+            });
+            source.addEventListener('error', e => {
+                // Событие ошибки задачи несет данные, ошибка соединения - нет
+                if (e.data) {
+                    source.close();
+                    showMessage(JSON.parse(e.data).error || 'Ошибка при обработке', 'error');
+                }
+            });
+        }
+
+        function pollJob(jobId) {
+            fetch(`/jobs/${jobId}`)
+                .then(response => response.json())
+                .then(data => {
+                    if (!data.success) {
+                        finishProcessing();
+                        showMessage(data.message || 'Ошибка при обработке', 'error');
+                        return;
+                    }
+                    
+                    document.getElementById('processingProgress').textContent =
+                        `Готово вариантов: ${data.completed} из ${data.total}`;
+                    
+                    if (data.status === 'done') {
+                        loadJobResult(jobId);
+                    } else if (data.status === 'error') {
+                        finishProcessing();
+                        showMessage(data.error || 'Ошибка при обработке', 'error');
+                    } else {
+                        setTimeout(() => pollJob(jobId), 1000);
+                    }
+                })
+                .catch(error => {
+                    console.error('Error polling job:', error);
+                    setTimeout(() => pollJob(jobId), 2000);
+                });
+        }
+
+        function loadJobResult(jobId) {
+            fetch(`/jobs/${jobId}/result`)
+                .then(response => response.json())
+                .then(data => {
+                    finishProcessing();
+                    if (data.success) {
+                        showVariantsSelection(data.file_id, data.variants);
+                    } else {
+                        showMessage(data.message || 'Ошибка при обработке', 'error');
+                    }
+                })
+                .catch(error => {
+                    console.error('Error:', error);
+                    finishProcessing();
+                    showMessage('Ошибка при обработке файла', 'error');
+                });
+        }
+
+        function finishProcessing() {
+            const submitBtn = document.getElementById('submitBtn');
+            document.getElementById('processingOverlay').style.display = 'none';
+            submitBtn.disabled = false;
+            submitBtn.innerHTML = '<i class="fas fa-bolt"></i> Создать все варианты улучшения';
+        }
+
         // Глобальные функции
         window.showComparison = function(fileId) {
             document.getElementById('comparisonSection').style.display = 'block';
@@ -862,10 +1028,9 @@ MAIN_PAGE = '''
                 behavior: 'smooth' 
             });
             
-            fetch('/api/files')
-                .then(response => response.json())
-                .then(files => {
-                    const file = files.find(f => f.id === fileId);
+            fetch(`/api/files/${fileId}`)
+                .then(response => response.ok ? response.json() : null)
+                .then(file => {
                     if (file) {
                         displayComparison(file);
                     }
@@ -879,10 +1044,188 @@ MAIN_PAGE = '''
 </html>
 '''
 
-# Глобальный список для хранения информации о файлах
-processed_files_db = []
+# Реестр обработанных файлов (FILE_REGISTRY_DB - файл SQLite, чтобы он переживал перезапуск)
+# Процессы пула (spawn) заново импортируют web_app как __mp_main__:
+# реестр и хранилище в них не нужны
+processed_files_db = FileRegistry(
+    os.environ.get('FILE_REGISTRY_DB') or None if __name__ != '__mp_main__' else None)
+# Наибольший размер страницы /api/files
+MAX_FILES_PAGE = 1000
 # Словарь для хранения всех вариантов обработки
 file_variants = {}
+# Построенные превью по файлам: множество методов ('original' - оригинал)
+file_previews = {}
+# Фоновые задачи обработки
+job_manager = JobManager(
+    max_workers=int(os.environ.get('JOB_WORKERS', 2)),
+    max_pending=int(os.environ.get('JOB_QUEUE_SIZE', 16)))
+# Ленивый режим: при загрузке варианты только регистрируются,
+# а строятся при первом запросе просмотра или скачивания
+LAZY_VARIANTS = os.environ.get('LAZY_VARIANTS', '0') == '1'
+# Наибольшая сторона превью в сетке вариантов
+PREVIEW_MAX_SIDE = int(os.environ.get('PREVIEW_MAX_SIDE', 480))
+decoded_originals = DecodedImageCache(max_items=int(os.environ.get('DECODED_CACHE_SIZE', 8)))
+variant_flights = SingleFlight()
+
+def forget_file(file_id):
+    """Убирает из памяти сервиса файл, удаленный из хранилища"""
+    file_variants.pop(file_id, None)
+    file_previews.pop(file_id, None)
+    processed_files_db.remove(file_id)
+    decoded_originals.discard(file_id)
+    decoded_originals.discard((file_id, 'preview'))
+
+# Файлы хранятся STORAGE_TTL_HOURS после последнего обращения, общий объем
+# ограничен STORAGE_MAX_MB; удаляет их фоновый поток, а не запросы
+storage = StorageManager(
+    max_bytes=int(os.environ.get('STORAGE_MAX_MB', 2048)) * 1024 * 1024,
+    ttl_seconds=float(os.environ.get('STORAGE_TTL_HOURS', 24)) * 3600,
+    sweep_interval=float(os.environ.get('STORAGE_SWEEP_SECONDS', 60)),
+    on_evict=forget_file)
+
+def restore_files():
+    """
+    Восстанавливает варианты и превью файлов, переживших перезапуск в реестре
+    (FILE_REGISTRY_DB), по файлам в PROCESSED_FOLDER. Недостающие варианты
+    регистрируются для построения по запросу, если оригинал на месте;
+    записи, от которых не осталось файлов, удаляются из реестра.
+    """
+    if not len(processed_files_db):
+        return
+    
+    # Имена файлов: <file_id>_<метод>.jpg и <file_id>_<метод>_preview.jpg
+    names_by_id = {}
+    with os.scandir(PROCESSED_FOLDER) as entries:
+        for entry in entries:
+            if len(entry.name) > 37 and entry.name[36] == '_':
+                names_by_id.setdefault(entry.name[:36], set()).add(entry.name[37:])
+    
+    for record in processed_files_db.list():
+        file_id = record['id']
+        names = names_by_id.get(file_id, set())
+        original_path = record.get('original_path')
+        has_original = bool(original_path) and os.path.exists(original_path)
+        variants = {}
+        for method in ALL_METHODS:
+            processed_path = os.path.join(PROCESSED_FOLDER, f"{file_id}_{method}.jpg")
+            ready = f"{method}.jpg" in names
+            if not ready and not has_original:
+                continue
+            variants[method] = {
+                'path': processed_path,
+                'filename': os.path.basename(processed_path),
+                'info': get_file_info(processed_path) if ready else None,
+                'ready': ready,
+                'original_path': original_path,
+                'input_hash': None
+            }
+        if not variants:
+            processed_files_db.remove(file_id)
+            continue
+        file_variants[file_id] = variants
+        file_previews[file_id] = {name[:-len('_preview.jpg')] for name in names
+                                  if name.endswith('_preview.jpg')}
+    logger.info(f"Восстановлены варианты файлов: {len(file_variants)}")
+
+_started = False
+_start_lock = threading.Lock()
+
+def start_service():
+    """
+    Один раз при первом запросе: восстанавливает файлы реестра и запускает
+    учет хранилища с фоновой очисткой. Не при импорте, потому что модуль
+    импортируют и процессы, которые не обслуживают запросы: процессы пула
+    (spawn) и родительский процесс перезагрузчика в режиме debug
+    """
+    global _started
+    with _start_lock:
+        if _started:
+            return
+        storage.start((UPLOAD_FOLDER, PROCESSED_FOLDER))
+        restore_files()
+        _started = True
+
+def get_owner():
+    """Идентификатор сессии пользователя - владельца загруженных файлов"""
+    if 'owner' not in session:
+        session['owner'] = uuid.uuid4().hex
+    return session['owner']
+
+# Метрики для /metrics
+metrics_registry = metrics.Registry()
+http_requests = metrics_registry.counter(
+    'document_enhancer_http_requests_total', 'HTTP-запросы по маршрутам',
+    ('route', 'method', 'status'))
+http_request_duration = metrics_registry.histogram(
+    'document_enhancer_http_request_duration_seconds', 'Время ответа по маршрутам',
+    ('route', 'method'))
+method_duration = metrics_registry.histogram(
+    'document_enhancer_method_duration_seconds', 'Время построения варианта по методам',
+    ('method', 'result'))
+uploaded_bytes = metrics_registry.counter(
+    'document_enhancer_uploaded_bytes_total', 'Принято байт в загрузках')
+served_bytes = metrics_registry.counter(
+    'document_enhancer_served_bytes_total', 'Отдано байт по маршрутам', ('route',))
+metrics_registry.gauge(
+    'document_enhancer_jobs', 'Фоновые задачи по состояниям',
+    lambda: {(state,): count for state, count in job_manager.stats().items()}, ('state',))
+metrics_registry.gauge(
+    'document_enhancer_variant_renders_in_flight', 'Варианты, которые строятся по запросу',
+    lambda: variant_flights.in_flight())
+metrics_registry.gauge(
+    'document_enhancer_processed_files', 'Обработанные файлы в памяти сервиса',
+    lambda: len(processed_files_db))
+
+def _cache_stat(name):
+    cache = get_result_cache()
+    return cache.stats()[name] if cache is not None else None
+
+metrics_registry.counter_func(
+    'document_enhancer_result_cache_hits_total', 'Попадания в кэш результатов',
+    lambda: _cache_stat('hits'))
+metrics_registry.counter_func(
+    'document_enhancer_result_cache_misses_total', 'Промахи кэша результатов',
+    lambda: _cache_stat('misses'))
+metrics_registry.gauge(
+    'document_enhancer_result_cache_hit_ratio', 'Доля попаданий в кэш результатов',
+    lambda: _cache_stat('hit_rate'))
+metrics_registry.gauge(
+    'document_enhancer_result_cache_bytes', 'Объем кэша результатов',
+    lambda: _cache_stat('bytes'))
+metrics_registry.gauge(
+    'document_enhancer_storage_bytes', 'Объем файлов, учтенных хранилищем',
+    lambda: storage.stats()['bytes'])
+metrics_registry.counter_func(
+    'document_enhancer_storage_evicted_total', 'Записи, удаленные по сроку или лимиту объема',
+    lambda: storage.stats()['evicted'])
+metrics_registry.gauge(
+    'document_enhancer_folder_bytes', 'Объем файлов в рабочих папках',
+    lambda: {('uploads',): metrics.directory_size(UPLOAD_FOLDER),
+             ('processed',): metrics.directory_size(PROCESSED_FOLDER)}, ('folder',))
+
+add_method_listener(lambda method, success, seconds: method_duration.observe(
+    seconds, method=method, result='success' if success else 'error'))
+
+@app.before_request
+def start_request_timer():
+    g.request_start = time.perf_counter()
+    start_service()
+
+@app.after_request
+def record_request_metrics(response):
+    """Счетчики и время ответа; маршрут берется по шаблону, а не по URL"""
+    route = request.url_rule.rule if request.url_rule else 'unmatched'
+    http_requests.inc(route=route, method=request.method, status=str(response.status_code))
+    start = g.get('request_start')
+    if start is not None:
+        # Для потоковых ответов (SSE) это время до начала отдачи
+        http_request_duration.observe(time.perf_counter() - start,
+                                      route=route, method=request.method)
+    if request.mimetype == 'multipart/form-data' and request.content_length:
+        uploaded_bytes.inc(request.content_length)
+    if response.content_length:
+        served_bytes.inc(response.content_length, route=route)
+    return response
 
 @app.route('/')
 def index():
@@ -918,10 +1261,9 @@ def index():
 def file_info_original(file_id):
     """Информация о оригинальном файле"""
     try:
-        original_files = list(Path(UPLOAD_FOLDER).glob(f"{file_id}_original.*"))
-        if original_files:
-            info = get_file_info(original_files[0])
-            return jsonify({'success': True, 'info': info})
+        file_info = processed_files_db.get(file_id)
+        if file_info and file_info.get('original_info'):
+            return jsonify({'success': True, 'info': file_info['original_info']})
         return jsonify({'success': False, 'message': 'Файл не найден'})
     except Exception as e:
         logger.error(f"Error getting original file info: {str(e)}")
@@ -932,118 +1274,540 @@ def file_info_variant(file_id, method):
     """Информация о варианте обработки"""
     try:
         if file_id in file_variants and method in file_variants[file_id]:
-            variant_path = file_variants[file_id][method]['path']
-            if os.path.exists(variant_path):
-                info = get_file_info(variant_path)
-                return jsonify({'success': True, 'info': info})
+            variant = file_variants[file_id][method]
+            # Информация не должна запускать ленивую обработку
+            if not variant['ready']:
+                return jsonify({'success': False, 'pending': True,
+                                'message': 'Вариант еще не построен'})
+            # Информация снята один раз при регистрации варианта
+            if variant['info']:
+                return jsonify({'success': True, 'info': variant['info']})
         return jsonify({'success': False, 'message': 'Вариант не найден'})
     except Exception as e:
         logger.error(f"Error getting variant file info: {str(e)}")
         return jsonify({'success': False, 'message': str(e)})
 
+def save_upload(file, file_size=None):
+    """
+    Проверяет и сохраняет загруженный файл, владелец - текущая сессия.
+    file_size - размер, если он уже известен (файл из ZIP-архива).
+    Возвращает (file_id, original_path, None) или (None, None, сообщение об ошибке).
+    Запись хранилища возвращается закрепленной (storage.acquire), чтобы
+    оригинал не удалили, пока обработка ждет в очереди: закрепление
+    снимает storage.release после обработки.
+    """
+    if file.filename == '':
+        return None, None, 'Файл не выбран'
+    
+    if not allowed_file(file.filename):
+        return None, None, f'Недопустимый формат файла: {file.filename}'
+    
+    # Проверяем, что файл действительно был загружен
+    if file_size is None:
+        file.seek(0, 2)
+        file_size = file.tell()
+        file.seek(0)
+    
+    if file_size == 0:
+        return None, None, 'Файл пустой или не был загружен'
+    
+    file_id = str(uuid.uuid4())
+    original_ext = Path(file.filename).suffix
+    original_filename = f"{file_id}_original{original_ext}"
+    
+    # Сохраняем оригинальный файл
+    original_path = os.path.join(UPLOAD_FOLDER, original_filename)
+    storage.register(file_id, get_owner())
+    storage.acquire(file_id)
+    try:
+        file.save(original_path)
+        storage.add_path(file_id, original_path)
+        logger.info(f"Файл сохранен: {original_path}, размер: {file_size} байт")
+        
+        # Путь, размер и разрешение оригинала запоминаем сразу, чтобы просмотр
+        # и информация об оригинале не искали файл в папке загрузок
+        width, height = get_image_dimensions(original_path)
+        processed_files_db.add({
+            'id': file_id,
+            'original_name': file.filename,
+            'original_path': original_path,
+            'original_info': {'size_bytes': file_size, 'width': width, 'height': height},
+            'processed_path': None,
+            'method': None,
+            'uploaded_time': datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+        })
+    except Exception:
+        storage.release(file_id)
+        raise
+    
+    return file_id, original_path, None
+
+def prepare_variants(file_id, on_result=None):
+    """
+    Выходные пути всех вариантов файла, словарь готовых вариантов (он же
+    file_variants[file_id]) и register_variant(method, success), которая
+    заносит готовый вариант в словарь и сообщает о нем on_result
+    """
+    outputs = {
+        method: os.path.join(PROCESSED_FOLDER, f"{file_id}_{method}.jpg")
+        for method in ALL_METHODS
+    }
+    variants = {}
+    file_variants[file_id] = variants
+    
+    def register_variant(method, success):
+        processed_path = outputs[method]
+        if success and os.path.exists(processed_path):
+            # Получаем информацию о файле
+            variants[method] = {
+                'path': processed_path,
+                'filename': os.path.basename(processed_path),
+                'info': get_file_info(processed_path),
+                'ready': True
+            }
+            storage.add_path(file_id, processed_path)
+            logger.info(f"Успешно обработан методом {method}")
+        else:
+            success = False
+            logger.error(f"Ошибка обработки методом {method}")
+        if on_result is not None:
+            variant = variants.get(method)
+            on_result(method, success, {
+                'filename': variant['filename'],
+                'info': variant['info']
+            } if variant else None)
+    
+    return outputs, variants, register_variant
+
+def finish_variants(file_id, variants):
+    """Выбирает основной вариант и возвращает имена файлов готовых вариантов"""
+    # По умолчанию выбираем первый успешный метод как основной
+    default_method = next((method for method in ALL_METHODS if method in variants), None)
+    if default_method:
+        processed_files_db.update(
+            file_id,
+            processed_path=variants[default_method]['path'],
+            method=default_method,
+            processed_time=datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+        )
+    
+    return {method: variants[method]['filename'] for method in ALL_METHODS if method in variants}
+
+def process_variants(file_id, original_name, original_path, on_result=None):
+    """
+    Строит все варианты для сохраненного оригинала.
+    Каждый готовый вариант сразу попадает в file_variants, поэтому его можно
+    просматривать, пока остальные еще обрабатываются. Запись хранилища
+    закреплена с загрузки (save_upload), вызывающий снимает закрепление.
+    """
+    outputs, variants, register_variant = prepare_variants(file_id, on_result)
+    
+    # Декодируем оригинал один раз и строим все варианты (готовые берутся из кэша)
+    enhance_document_variants(original_path, outputs, config=load_config(),
+                              on_result=register_variant)
+    
+    return finish_variants(file_id, variants)
+
+def process_batch_variants(batch, uploads):
+    """
+    Строит варианты всех файлов пакета на общем пуле процессов.
+    uploads - список (file_id, original_name, original_path) в порядке batch.jobs.
+    Задача файла завершается, как только готовы все его варианты.
+    Закрепления файлов с загрузки снимаются по окончании пакета.
+    """
+    documents = []
+    states = []
+    for job, (file_id, _, original_path) in zip(batch.jobs, uploads):
+        outputs, variants, register_variant = prepare_variants(file_id, job.set_method_result)
+        documents.append((original_path, outputs))
+        states.append((job, file_id, variants, register_variant, set(outputs)))
+    
+    def on_result(index, method, success):
+        job, file_id, variants, register_variant, remaining = states[index]
+        register_variant(method, success)
+        remaining.discard(method)
+        if not remaining:
+            job.result = finish_variants(file_id, variants)
+            job.set_status('done')
+    
+    try:
+        enhance_batch_variants(documents, config=load_config(), on_result=on_result)
+    finally:
+        release_uploads(uploads)
+
+def release_uploads(uploads):
+    """Снимает закрепления save_upload с файлов (file_id, ...)"""
+    for file_id, *_ in uploads:
+        storage.release(file_id)
+
+def register_lazy_variants(file_id, original_name, original_path):
+    """
+    Ленивый режим: декодирует оригинал, кладет его в кэш и регистрирует
+    все варианты без обработки. Варианты строит ensure_variant.
+    """
+    img = cv2.imread(original_path)
+    if img is None:
+        raise ValueError(f"Не удалось загрузить изображение: {original_path}")
+    decoded_originals.put(file_id, img)
+    
+    input_hash = hash_file(original_path) if get_result_cache() is not None else None
+    variants = {}
+    for method in ALL_METHODS:
+        processed_path = os.path.join(PROCESSED_FOLDER, f"{file_id}_{method}.jpg")
+        variants[method] = {
+            'path': processed_path,
+            'filename': os.path.basename(processed_path),
+            'info': None,
+            'ready': False,
+            'original_path': original_path,
+            'input_hash': input_hash
+        }
+    file_variants[file_id] = variants
+    
+    default_method = ALL_METHODS[0]
+    processed_files_db.update(
+        file_id,
+        processed_path=variants[default_method]['path'],
+        method=default_method,
+        processed_time=datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+    )
+    
+    return {method: variant['filename'] for method, variant in variants.items()}
+
+def ensure_variant(file_id, method):
+    """
+    Возвращает запись варианта, при необходимости построив его.
+    Одновременные запросы одного варианта выполняют обработку один раз.
+    Возвращает None, если варианта нет или его не удалось построить.
+    """
+    variant = file_variants.get(file_id, {}).get(method)
+    if variant is None:
+        return None
+    storage.touch(file_id)
+    if variant['ready']:
+        return variant
+    
+    def render():
+        if variant['ready']:
+            return True
+        
+        config = load_config()
+        cache = get_result_cache()
+        cache_key = None
+        if cache is not None and variant['input_hash']:
+            cache_key = cache.make_key(variant['input_hash'], method, config,
+                                       os.path.splitext(variant['path'])[1])
+        
+        if cache_key and cache.get(cache_key, variant['path']):
+            logger.info(f"Вариант {method} для файла {file_id} взят из кэша")
+        else:
+            logger.info(f"Построение варианта {method} для файла {file_id} по запросу")
+            img = decoded_originals.get(file_id, variant['original_path'])
+            if not enhance_image(img, variant['path'], method, config):
+                return False
+            if cache_key:
+                cache.put(cache_key, variant['path'])
+        
+        if os.path.exists(variant['path']):
+            variant['info'] = get_file_info(variant['path'])
+            variant['ready'] = True
+            storage.add_path(file_id, variant['path'])
+        return variant['ready']
+    
+    try:
+        with storage.using(file_id):
+            ready = variant_flights.do((file_id, method), render)
+    except FileEvicted:
+        return None
+    return variant if ready else None
+
+def ensure_preview(file_id, method):
+    """
+    Возвращает путь к превью варианта (или оригинала, method='original'),
+    при необходимости построив его. Готовый вариант просто уменьшается,
+    иначе метод выполняется над уменьшенной копией оригинала, и полное
+    разрешение не строится. Возвращает None, если построить не удалось.
+    """
+    file_info = processed_files_db.get(file_id)
+    if file_info is None:
+        return None
+    variant = file_variants.get(file_id, {}).get(method)
+    if method != 'original' and variant is None:
+        return None
+    storage.touch(file_id)
+    preview_path = os.path.join(PROCESSED_FOLDER, f"{file_id}_{method}_preview.jpg")
+    previews = file_previews.setdefault(file_id, set())
+    if method in previews:
+        return preview_path
+    
+    def render():
+        if method in previews:
+            return True
+        if variant is not None and variant['ready']:
+            success = cv2.imwrite(preview_path, load_preview_proxy(variant['path'], PREVIEW_MAX_SIDE),
+                                  [cv2.IMWRITE_JPEG_QUALITY, 90])
+        else:
+            # Уменьшенный оригинал общий для превью всех вариантов
+            proxy = decoded_originals.get((file_id, 'preview'))
+            if proxy is None:
+                proxy = load_preview_proxy(file_info['original_path'], PREVIEW_MAX_SIDE)
+                decoded_originals.put((file_id, 'preview'), proxy)
+            if method == 'original':
+                success = cv2.imwrite(preview_path, proxy, [cv2.IMWRITE_JPEG_QUALITY, 90])
+            else:
+                success = enhance_preview(proxy, preview_path, method, load_config())
+        if success:
+            storage.add_path(file_id, preview_path)
+            previews.add(method)
+        return success
+    
+    try:
+        with storage.using(file_id):
+            ready = variant_flights.do((file_id, method, 'preview'), render)
+    except FileEvicted:
+        return None
+    return preview_path if ready else None
+
 @app.route('/process_all', methods=['POST'])
 def process_all_variants():
-    """Обработка файла всеми методами с предварительной очисткой"""
+    """Обработка файла всеми методами"""
     try:
         if 'file' not in request.files:
             return jsonify({'success': False, 'message': 'Файл не выбран'})
         
         file = request.files['file']
+        file_id, original_path, error = save_upload(file)
+        if error:
+            return jsonify({'success': False, 'message': error})
         
-        if file.filename == '':
-            return jsonify({'success': False, 'message': 'Файл не выбран'})
-        
-        if file and allowed_file(file.filename):
-            # Выполняем очистку перед обработкой
-            cleanup_success = cleanup_folders()
-            if not cleanup_success:
-                logger.warning("Очистка папок завершена с предупреждениями, но продолжаем обработку")
-            
-            # Проверяем, что файл действительно был загружен
-            file.seek(0, 2)
-            file_size = file.tell()
-            file.seek(0)
-            
-            if file_size == 0:
-                return jsonify({'success': False, 'message': 'Файл пустой или не был загружен'})
-            
-            file_id = str(uuid.uuid4())
-            original_ext = Path(file.filename).suffix
-            original_filename = f"{file_id}_original{original_ext}"
-            
-            # Сохраняем оригинальный файл
-            original_path = os.path.join(UPLOAD_FOLDER, original_filename)
-            file.save(original_path)
-            logger.info(f"Файл сохранен: {original_path}, размер: {file_size} байт")
-            
-            # Методы обработки
-            methods = [
-            'smooth_quality', 'natural_enhance', 'soft_contrast', 'professional_gentle',
-            'smooth_quality_2x', 'smooth_quality_3x',
-            'natural_enhance_2x', 'natural_enhance_3x', 
-            'soft_contrast_2x', 'soft_contrast_3x',
-            'professional_gentle_2x', 'professional_gentle_3x']
-            variants = {}
-            
-            # Обрабатываем каждым методом
-            for method in methods:
-                processed_filename = f"{file_id}_{method}.jpg"
-                processed_path = os.path.join(PROCESSED_FOLDER, processed_filename)
-                
-                logger.info(f"Обработка методом: {method}")
-                success = enhance_document_quality(original_path, processed_path, method)
-                
-                if success and os.path.exists(processed_path):
-                    # Получаем информацию о файле
-                    file_info = get_file_info(processed_path)
-                    variants[method] = {
-                        'path': processed_path,
-                        'filename': processed_filename,
-                        'info': file_info
-                    }
-                    logger.info(f"Успешно обработан методом {method}")
+        # Замеры стадий (ENHANCE_PROFILE=1) возвращаются вместе с результатом
+        try:
+            with profiling.collect() as profile:
+                if LAZY_VARIANTS:
+                    variants = register_lazy_variants(file_id, file.filename, original_path)
                 else:
-                    logger.error(f"Ошибка обработки методом {method}")
-            
-            # Сохраняем информацию о вариантах
-            file_variants[file_id] = variants
-            
-            # По умолчанию выбираем первый успешный метод как основной
-            default_method = next(iter(variants.keys())) if variants else 'smooth_quality'
-            if variants:
-                file_info = {
-                    'id': file_id,
-                    'original_name': file.filename,
-                    'original_path': original_path,
-                    'processed_path': variants[default_method]['path'],
-                    'method': default_method,
-                    'processed_time': datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-                }
-                processed_files_db.append(file_info)
-            
-            return jsonify({
-                'success': True,
-                'file_id': file_id,
-                'variants': {method: data['filename'] for method, data in variants.items()}
-            })
-            
-        else:
-            return jsonify({'success': False, 'message': f'Недопустимый формат файла: {file.filename}'})
+                    variants = process_variants(file_id, file.filename, original_path)
+        finally:
+            storage.release(file_id)
+        
+        response = {
+            'success': True,
+            'file_id': file_id,
+            'variants': variants,
+            'lazy': LAZY_VARIANTS
+        }
+        if profiling.is_enabled():
+            response['profile'] = profile.to_dict()
+        return jsonify(response)
             
     except Exception as e:
         error_msg = f'Ошибка при обработке: {str(e)}'
         logger.error(f"Ошибка в process_all_variants: {str(e)}")
         return jsonify({'success': False, 'message': error_msg})
 
+@app.route('/jobs', methods=['POST'])
+def submit_job():
+    """Ставит обработку файла всеми методами в фоновую очередь"""
+    try:
+        if 'file' not in request.files:
+            return jsonify({'success': False, 'message': 'Файл не выбран'})
+        
+        file = request.files['file']
+        file_id, original_path, error = save_upload(file)
+        if error:
+            return jsonify({'success': False, 'message': error})
+        
+        original_name = file.filename
+        
+        # В ленивом режиме задача не нужна: варианты строятся по запросу
+        if LAZY_VARIANTS:
+            try:
+                variants = register_lazy_variants(file_id, original_name, original_path)
+            finally:
+                storage.release(file_id)
+            return jsonify({'success': True, 'file_id': file_id,
+                            'variants': variants, 'lazy': True})
+        
+        # Закрепление оригинала переходит к задаче и снимается по ее окончании
+        def run(job):
+            try:
+                return process_variants(file_id, original_name, original_path,
+                                        on_result=job.set_method_result)
+            finally:
+                storage.release(file_id)
+        
+        try:
+            job = job_manager.submit(file_id, ALL_METHODS, run)
+        except Exception:
+            storage.release(file_id)
+            raise
+        return jsonify({'success': True, 'job_id': job.id, 'file_id': file_id}), 202
+        
+    except JobQueueFull as e:
+        return jsonify({'success': False, 'message': str(e)}), 503
+    except Exception as e:
+        logger.error(f"Ошибка при постановке задачи: {str(e)}")
+        return jsonify({'success': False, 'message': f'Ошибка при обработке: {str(e)}'})
+
+# Наибольшее число файлов в одном пакете
+MAX_BATCH_FILES = int(os.environ.get('MAX_BATCH_FILES', 100))
+
+def iter_batch_files(files, rejected):
+    """
+    Файлы пакета по одному, как пары (файл, размер или None); ZIP-архивы
+    раскрываются в изображения без распаковки на диск, размер берется из
+    оглавления архива. Отклоненные файлы добавляются в rejected
+    """
+    max_size = app.config['MAX_CONTENT_LENGTH']
+    for file in files:
+        if not file.filename.lower().endswith('.zip'):
+            yield file, None
+            continue
+        try:
+            archive = zipfile.ZipFile(file.stream)
+        except zipfile.BadZipFile:
+            rejected.append({'name': file.filename, 'message': 'Поврежденный ZIP-архив'})
+            continue
+        with archive:
+            for info in archive.infolist():
+                name = os.path.basename(info.filename)
+                if info.is_dir() or info.filename.startswith('__MACOSX/') or not allowed_file(name):
+                    continue
+                if max_size and info.file_size > max_size:
+                    rejected.append({'name': name, 'message': 'Файл больше допустимого размера'})
+                    continue
+                with archive.open(info) as stream:
+                    yield FileStorage(stream=stream, filename=name), info.file_size
+
+@app.route('/batch', methods=['POST'])
+def submit_batch():
+    """
+    Пакетная загрузка: несколько файлов в поле files или ZIP-архив с
+    изображениями. Все пары файл-метод обрабатываются одним пакетом на общем
+    пуле, сначала дешевые варианты без увеличения у всех файлов
+    """
+    try:
+        files = request.files.getlist('files') + request.files.getlist('file')
+        if not files:
+            return jsonify({'success': False, 'message': 'Файлы не выбраны'})
+        
+        uploads = []
+        rejected = []
+        try:
+            for file, file_size in iter_batch_files(files, rejected):
+                if len(uploads) >= MAX_BATCH_FILES:
+                    rejected.append({'name': file.filename,
+                                     'message': f'В пакете не больше {MAX_BATCH_FILES} файлов'})
+                    continue
+                file_id, original_path, error = save_upload(file, file_size)
+                if error:
+                    rejected.append({'name': file.filename, 'message': error})
+                    continue
+                uploads.append((file_id, file.filename, original_path))
+        except Exception:
+            release_uploads(uploads)
+            raise
+        
+        if not uploads:
+            return jsonify({'success': False, 'message': 'Нет подходящих изображений',
+                            'rejected': rejected})
+        
+        # В ленивом режиме пакет не нужен: варианты строятся по запросу
+        if LAZY_VARIANTS:
+            try:
+                return jsonify({'success': True, 'lazy': True, 'rejected': rejected, 'files': [
+                    {'file_id': file_id, 'name': name,
+                     'variants': register_lazy_variants(file_id, name, original_path)}
+                    for file_id, name, original_path in uploads
+                ]})
+            finally:
+                release_uploads(uploads)
+        
+        # Закрепления оригиналов переходят к пакету
+        try:
+            batch = job_manager.submit_batch(
+                [(file_id, ALL_METHODS) for file_id, _, _ in uploads],
+                lambda batch: process_batch_variants(batch, uploads))
+        except Exception:
+            release_uploads(uploads)
+            raise
+        return jsonify({
+            'success': True,
+            'batch_id': batch.id,
+            'files': [{'file_id': file_id, 'job_id': job.id, 'name': name}
+                      for job, (file_id, name, _) in zip(batch.jobs, uploads)],
+            'rejected': rejected
+        }), 202
+        
+    except JobQueueFull as e:
+        return jsonify({'success': False, 'message': str(e)}), 503
+    except Exception as e:
+        logger.error(f"Ошибка при постановке пакета: {str(e)}")
+        return jsonify({'success': False, 'message': f'Ошибка при обработке: {str(e)}'})
+
+@app.route('/batch/<batch_id>')
+def batch_status(batch_id):
+    """Общий прогресс пакета и прогресс по каждому файлу"""
+    batch = job_manager.get_batch(batch_id)
+    if batch is None:
+        return jsonify({'success': False, 'message': 'Пакет не найден'}), 404
+    return jsonify({'success': True, **batch.to_dict()})
+
+@app.route('/jobs/<job_id>')
+def job_status(job_id):
+    """Статус фоновой задачи с прогрессом по каждому методу"""
+    job = job_manager.get(job_id)
+    if job is None:
+        return jsonify({'success': False, 'message': 'Задача не найдена'}), 404
+    return jsonify({'success': True, **job.to_dict()})
+
+@app.route('/jobs/<job_id>/events')
+def job_events(job_id):
+    """Поток событий задачи (SSE): каждый вариант отправляется сразу после записи"""
+    job = job_manager.get(job_id)
+    if job is None:
+        return jsonify({'success': False, 'message': 'Задача не найдена'}), 404
+    
+    # При переподключении браузер присылает номер последнего полученного события
+    last_event_id = request.headers.get('Last-Event-ID', '')
+    start = int(last_event_id) + 1 if last_event_id.isdigit() else 0
+    
+    def stream():
+        yield 'retry: 2000\n\n'
+        for index, event in job.iter_events(start):
+            if event is None:
+                yield ': keepalive\n\n'
+                continue
+            yield f"id: {index}\nevent: {event['type']}\ndata: {json.dumps(event)}\n\n"
+    
+    return Response(stream(), mimetype='text/event-stream', headers={
+        'Cache-Control': 'no-cache',
+        'X-Accel-Buffering': 'no'
+    })
+
+@app.route('/jobs/<job_id>/result')
+def job_result(job_id):
+    """Результат фоновой задачи в том же формате, что и /process_all"""
+    job = job_manager.get(job_id)
+    if job is None:
+        return jsonify({'success': False, 'message': 'Задача не найдена'}), 404
+    if job.status == 'error':
+        return jsonify({'success': False, 'message': f'Ошибка при обработке: {job.error}'})
+    if job.status != 'done':
+        return jsonify({'success': False, 'message': 'Задача еще выполняется',
+                        **job.to_dict()}), 202
+    return jsonify({
+        'success': True,
+        'file_id': job.file_id,
+        'variants': job.result
+    })
+
 @app.route('/cleanup', methods=['POST'])
 def cleanup_files():
-    """API для очистки всех файлов"""
+    """API для удаления всех файлов текущей сессии"""
     try:
-        success = cleanup_folders()
-        if success:
-            return jsonify({'success': True, 'message': 'Все файлы успешно удалены'})
-        else:
-            return jsonify({'success': False, 'message': 'Ошибка при удалении файлов'})
+        removed = storage.remove_owner(get_owner())
+        return jsonify({'success': True, 'message': f'Удалено файлов: {removed}'})
     except Exception as e:
         logger.error(f"Ошибка при очистке файлов: {str(e)}")
         return jsonify({'success': False, 'message': str(e)})
@@ -1053,18 +1817,13 @@ def cleanup_files():
 def save_selected_variant(file_id, method):
     """Сохраняет выбранный вариант как основной"""
     try:
-        # Находим файл в базе
-        file_info = None
-        for i, f in enumerate(processed_files_db):
-            if f['id'] == file_id:
-                file_info = f
-                break
-        
-        if file_info and file_id in file_variants and method in file_variants[file_id]:
+        if file_id in processed_files_db and method in file_variants.get(file_id, {}):
             # Обновляем информацию о файле
-            file_info['processed_path'] = file_variants[file_id][method]['path']
-            file_info['method'] = method
-            file_info['processed_time'] = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+            processed_files_db.update(
+                file_id,
+                processed_path=file_variants[file_id][method]['path'],
+                method=method,
+                processed_time=datetime.now().strftime("%Y-%m-%d %H:%M:%S"))
             
             logger.info(f"Выбран вариант {method} для файла {file_id}")
             return jsonify({'success': True})
@@ -1075,14 +1834,29 @@ def save_selected_variant(file_id, method):
         logger.error(f"Ошибка при сохранении варианта: {str(e)}")
         return jsonify({'success': False, 'message': str(e)})
 
+@app.route('/preview-thumb/<file_id>/<method>')
+def preview_thumb(file_id, method):
+    """Уменьшенное превью варианта или оригинала для сетки выбора"""
+    try:
+        preview_path = ensure_preview(file_id, method)
+        if preview_path and os.path.exists(preview_path):
+            # Превью строится из уменьшенного оригинала или из готового варианта,
+            # смотря что есть к моменту запроса, поэтому URL не неизменяемый
+            return send_image(preview_path, immutable=False, mimetype='image/jpeg')
+        
+        return "Превью не найдено", 404
+            
+    except Exception as e:
+        logger.error(f"Ошибка при построении превью: {str(e)}")
+        return f"Ошибка: {str(e)}", 500
+
 @app.route('/preview-variant/<file_id>/<method>')
 def preview_variant(file_id, method):
     """Просмотр варианта обработки"""
     try:
-        if file_id in file_variants and method in file_variants[file_id]:
-            variant_path = file_variants[file_id][method]['path']
-            if os.path.exists(variant_path):
-                return send_file(variant_path)
+        variant = ensure_variant(file_id, method)
+        if variant and os.path.exists(variant['path']):
+            return send_image(variant['path'])
         
         return "Вариант не найден", 404
             
@@ -1094,17 +1868,17 @@ def preview_variant(file_id, method):
 def download_variant(file_id, method):
     """Скачать вариант обработки"""
     try:
-        if file_id in file_variants and method in file_variants[file_id]:
-            variant_path = file_variants[file_id][method]['path']
+        variant = ensure_variant(file_id, method)
+        if variant:
+            variant_path = variant['path']
             if os.path.exists(variant_path):
                 original_name = "enhanced_image.jpg"
-                for file_info in processed_files_db:
-                    if file_info['id'] == file_id:
-                        name_without_ext = Path(file_info['original_name']).stem
-                        original_name = f"enhanced_{name_without_ext}_{method}.jpg"
-                        break
+                file_info = processed_files_db.get(file_id)
+                if file_info:
+                    name_without_ext = Path(file_info['original_name']).stem
+                    original_name = f"enhanced_{name_without_ext}_{method}.jpg"
                 
-                return send_file(
+                return send_image(
                     variant_path,
                     as_attachment=True,
                     download_name=original_name
@@ -1120,11 +1894,13 @@ def download_variant(file_id, method):
 def preview_original(file_id):
     """Просмотр оригинального файла"""
     try:
-        original_files = list(Path(UPLOAD_FOLDER).glob(f"{file_id}_original.*"))
-        if original_files:
-            return send_file(original_files[0])
-        else:
-            return "Файл не найден", 404
+        file_info = processed_files_db.get(file_id)
+        if file_info and file_info.get('original_path'):
+            storage.touch(file_id)
+            return send_image(file_info['original_path'])
+        return "Файл не найден", 404
+    except FileNotFoundError:
+        return "Файл не найден", 404
     except Exception as e:
         logger.error(f"Ошибка при preview оригинала: {str(e)}")
         return f"Ошибка: {str(e)}", 500
@@ -1133,10 +1909,11 @@ def preview_original(file_id):
 def preview_file(file_id):
     """Просмотр основного обработанного файла"""
     try:
-        for file_info in processed_files_db:
-            if file_info['id'] == file_id:
-                if os.path.exists(file_info['processed_path']):
-                    return send_file(file_info['processed_path'])
+        file_info = processed_files_db.get(file_id)
+        if file_info and file_info['method']:
+            ensure_variant(file_id, file_info['method'])
+            if os.path.exists(file_info['processed_path']):
+                return send_image(file_info['processed_path'], immutable=False)
         return "Файл не найден", 404
     except Exception as e:
         logger.error(f"Ошибка при preview: {str(e)}")
@@ -1146,36 +1923,133 @@ def preview_file(file_id):
 def download_file(file_id):
     """Скачать основной обработанный файл"""
     try:
-        for file_info in processed_files_db:
-            if file_info['id'] == file_id:
-                if os.path.exists(file_info['processed_path']):
-                    name_without_ext = Path(file_info['original_name']).stem
-                    original_name = f"enhanced_{name_without_ext}.jpg"
-                    return send_file(
-                        file_info['processed_path'],
-                        as_attachment=True,
-                        download_name=original_name
-                    )
+        file_info = processed_files_db.get(file_id)
+        if file_info and file_info['method']:
+            ensure_variant(file_id, file_info['method'])
+            if os.path.exists(file_info['processed_path']):
+                name_without_ext = Path(file_info['original_name']).stem
+                original_name = f"enhanced_{name_without_ext}.jpg"
+                return send_image(
+                    file_info['processed_path'],
+                    immutable=False,
+                    as_attachment=True,
+                    download_name=original_name
+                )
         return "Файл не найден", 404
     except Exception as e:
         logger.error(f"Ошибка при скачивании: {str(e)}")
         return f"Ошибка: {str(e)}", 500
 
+# Размер блока при чтении файлов в ZIP-архив
+ZIP_CHUNK_SIZE = 256 * 1024
+
+class ZipStream:
+    """Приемник для zipfile без seek и tell: записанное забирает генератор ответа"""
+    
+    def __init__(self):
+        self._chunks = []
+    
+    def write(self, data):
+        self._chunks.append(bytes(data))
+        return len(data)
+    
+    def flush(self):
+        pass
+    
+    def take(self):
+        data = b''.join(self._chunks)
+        self._chunks = []
+        return data
+
+def iter_variants_zip(file_id, methods, name_stem):
+    """
+    Отдает ZIP-архив вариантов по частям. JPEG уже сжаты, поэтому режим
+    STORED: файлы читаются с диска блоками и сразу уходят клиенту, архив
+    целиком не собирается ни в памяти, ни на диске. Недостроенные варианты
+    строятся по очереди по ходу отдачи.
+    """
+    stream = ZipStream()
+    with storage.using(file_id), zipfile.ZipFile(stream, 'w', zipfile.ZIP_STORED) as archive:
+        for method in methods:
+            variant = ensure_variant(file_id, method)
+            if variant is None or not os.path.exists(variant['path']):
+                logger.error(f"Вариант {method} для файла {file_id} не попал в архив")
+                continue
+            info = zipfile.ZipInfo.from_file(variant['path'], f"enhanced_{name_stem}_{method}.jpg")
+            with open(variant['path'], 'rb') as src, archive.open(info, 'w') as dest:
+                for chunk in iter(lambda: src.read(ZIP_CHUNK_SIZE), b''):
+                    dest.write(chunk)
+                    yield stream.take()
+            yield stream.take()
+    yield stream.take()
+
+@app.route('/download-all/<file_id>')
+def download_all(file_id):
+    """Скачать все варианты (или перечисленные в ?methods=a,b) одним ZIP-архивом"""
+    try:
+        file_info = processed_files_db.get(file_id)
+        if file_info is None or file_id not in storage:
+            return "Файл не найден", 404
+        
+        variants = file_variants.get(file_id, {})
+        requested = [method for method in request.args.get('methods', '').split(',') if method]
+        methods = [method for method in (requested or ALL_METHODS) if method in variants]
+        if not methods:
+            return "Варианты не найдены", 404
+        
+        name_stem = Path(file_info['original_name']).stem
+        download_name = f"enhanced_{name_stem}.zip"
+        return Response(iter_variants_zip(file_id, methods, name_stem), mimetype='application/zip', headers={
+            'Content-Disposition': f"attachment; filename=\"enhanced_variants.zip\"; "
+                                   f"filename*=UTF-8''{quote(download_name)}",
+            'Cache-Control': 'no-cache'
+        })
+    except Exception as e:
+        logger.error(f"Ошибка при скачивании архива: {str(e)}")
+        return f"Ошибка: {str(e)}", 500
+
 @app.route('/api/files')
 def api_files():
-    """API для получения списка файлов"""
-    return jsonify(processed_files_db)
+    """
+    API для получения списка файлов постранично:
+    ?offset=0&limit=100&order=asc|desc, общее число - в заголовке X-Total-Count
+    """
+    try:
+        offset = max(0, int(request.args.get('offset', 0)))
+        limit = min(MAX_FILES_PAGE, max(1, int(request.args.get('limit', MAX_FILES_PAGE))))
+    except ValueError:
+        return jsonify({'success': False, 'message': 'Неверные параметры страницы'}), 400
+    newest_first = request.args.get('order') == 'desc'
+    
+    response = jsonify(processed_files_db.list(offset, limit, newest_first))
+    response.headers['X-Total-Count'] = str(len(processed_files_db))
+    return response
+
+@app.route('/api/files/<file_id>')
+def api_file(file_id):
+    """API для получения одного файла"""
+    file_info = processed_files_db.get(file_id)
+    if file_info is None:
+        return jsonify({'success': False, 'message': 'Файл не найден'}), 404
+    return jsonify(file_info)
 
 @app.route('/health')
 def health_check():
     """Health check endpoint"""
+    cache = get_result_cache()
     return jsonify({
         'status': 'healthy', 
         'service': 'document_enhancer',
         'processed_files': len(processed_files_db),
+        'result_cache': cache.stats() if cache is not None else None,
         'timestamp': datetime.now().isoformat()
     })
 
+@app.route('/metrics')
+def metrics_endpoint():
+    """Метрики в текстовом формате Prometheus"""
+    return Response(metrics_registry.expose(), content_type=metrics.CONTENT_TYPE)
+
 if __name__ == '__main__':
     print("🚀 Starting Document Enhancer Web Server...")
     print("📍 Web interface: http://localhost:5000")